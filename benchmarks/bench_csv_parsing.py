@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+'''Micro-benchmark: legacy untyped CSV parsing and merge vs. the typed fast path of Downloader.get_history
+
+Uses the Yahoo-format CSV fixtures in benchmarks/fixtures (history, div, split).
+Run from the repository root: python benchmarks/bench_csv_parsing.py'''
+
+import argparse
+import io
+import os
+import sys
+import timeit
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'datahandler'))
+
+from lib.yahoo_downloader import Downloader
+
+
+def load_fixtures(directory):
+    fixtures = {}
+    for data_type in ('history', 'div', 'split'):
+        with open(os.path.join(directory, data_type + '.csv'), 'rb') as f:
+            fixtures[data_type] = f.read()
+    return fixtures
+
+
+def format_split(value):
+    if value != 1:
+        numbers = value.split('/')
+        return int(numbers[0]) / int(numbers[1])
+    return value
+
+
+def legacy_parse(fixtures):
+    '''The parsing done before the fast path: untyped read_csv, string dates, concat, per-row split apply'''
+    frames = []
+    for data_type in ('history', 'div', 'split'):
+        df = pd.read_csv(io.BytesIO(fixtures[data_type]))
+        df.set_index(pd.DatetimeIndex(df['Date']), inplace=True)
+        df.drop('Date', axis=1, inplace=True)
+        frames.append(df)
+    full_data = pd.concat(frames, axis=1)
+    full_data['Dividends'] = full_data['Dividends'].fillna(0)
+    full_data['Stock Splits'] = full_data['Stock Splits'].fillna(1)
+    full_data['Stock Splits'] = full_data['Stock Splits'].apply(format_split)
+    full_data['Adj Close'] = pd.to_numeric(full_data['Adj Close'], errors='coerce')
+    return full_data
+
+
+def fast_parse(downloader, fixtures, fields=('Adj Close',)):
+    history = downloader._parse_csv(fixtures['history'], 'history', list(fields))
+    dividends = downloader._parse_csv(fixtures['div'], 'div')
+    splits = downloader._parse_csv(fixtures['split'], 'split')
+    return downloader._merge_frames(history, dividends, splits)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fixtures', default=os.path.join(BENCH_DIR, 'fixtures'))
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures)
+    downloader = Downloader(auth_cache=None)
+
+    legacy = legacy_parse(fixtures)
+    fast = fast_parse(downloader, fixtures)
+    columns = ['Adj Close', 'Dividends', 'Stock Splits']
+    pd.testing.assert_frame_equal(legacy[columns].astype(float), fast[columns], check_names=False)
+
+    cases = [
+        ('legacy (untyped, concat, apply)', lambda: legacy_parse(fixtures)),
+        ('typed, all price columns', lambda: fast_parse(downloader, fixtures, fields=())),
+        ('typed, Adj Close only', lambda: fast_parse(downloader, fixtures))
+    ]
+    print('{0} price rows, best of {1} runs'.format(len(legacy), args.repeat))
+    baseline = None
+    for name, function in cases:
+        best = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print('{0:<34} {1:8.2f} ms  {2:5.2f}x'.format(name, best * 1000, baseline / best))
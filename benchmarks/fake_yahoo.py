@@ -0,0 +1,94 @@
+#-*- coding: utf-8 -*-
+
+'''Local stand-in for the 2017 Yahoo Finance endpoints used by Downloader:
+the quote page carrying the crumb and the CSV download endpoint'''
+
+from datetime import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import random
+
+CRUMB = 'benchCrumb'
+COOKIE = 'B=benchcookie'
+EVENTS = {'history': 'history', 'div': 'div', 'split': 'split'}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeYahoo:
+    '''Serve CSV data of {ticker: {'history'|'div'|'split': bytes}} on a free local port'''
+    def __init__(self, data, auth_failure_rate=0.0, latency=0.0, seed=0):
+        self.data = data
+        self.auth_failure_rate = auth_failure_rate
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    @property
+    def quote_url(self):
+        return self.base_url + '/quote/^GSPC'
+
+    @property
+    def download_url(self):
+        return self.base_url + '/v7/finance/download/{}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b'', content_type='text/csv', headers=()):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                fake.requests += 1
+                if fake.latency:
+                    threading.Event().wait(fake.latency)
+                url = urlparse(self.path)
+                if url.path.startswith('/quote/'):
+                    page = '<script>{{"CrumbStore":{{"crumb":"{0}"}},"QuotePageStore":{{}}}}</script>'.format(CRUMB)
+                    return self._send(200, page.encode('utf-8'), 'text/html', [('Set-Cookie', COOKIE + '; Path=/')])
+
+                if not url.path.startswith('/v7/finance/download/'):
+                    return self._send(404)
+                query = parse_qs(url.query)
+                if query.get('crumb') != [CRUMB] or COOKIE not in self.headers.get('Cookie', '') or \
+                        fake.random.random() < fake.auth_failure_rate:
+                    return self._send(401, b'Unauthorized')
+                ticker = url.path.rsplit('/', 1)[1]
+                event = EVENTS.get(query.get('events', ['history'])[0])
+                if ticker not in fake.data or event is None:
+                    return self._send(404, b'Not found')
+                start = datetime.utcfromtimestamp(int(query.get('period1', [0])[0])).strftime('%Y-%m-%d')
+                end = datetime.utcfromtimestamp(int(query.get('period2', [2 ** 31])[0])).strftime('%Y-%m-%d')
+                lines = fake.data[ticker][event].decode('utf-8').splitlines()
+                rows = [line for line in lines[1:] if start <= line[:10] <= end]
+                self._send(200, ('\n'.join([lines[0]] + rows) + '\n').encode('utf-8'))
+
+        return Handler
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+'''Offline benchmark of the data pipeline and the dataserver endpoints.
+
+Generates N tickers x Y years of synthetic history, serves it from a local fake Yahoo server,
+runs the data_pipeline flow (company list, history, profiles) into a local MongoDB or an
+in-memory stand-in (mongomock), then hits the Flask endpoints. Reports throughput, per-stage
+latency percentiles and peak memory, and compares them with a stored baseline.
+mongomock emulates aggregations in Python (and deep-copies every document they touch), so without
+--mongo the defaults are small and the endpoints backed by aggregations (details, history) are skipped.
+Only runs against MongoDB give meaningful numbers.
+
+    python benchmarks/harness.py --tickers 50 --years 20
+    python benchmarks/harness.py --mongo mongodb://localhost:27017 --save-baseline'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT, 'datahandler'))
+sys.path.insert(0, os.path.join(ROOT, 'dataserver'))
+
+from fake_yahoo import FakeYahoo
+from synthetic import generate_universe
+
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+PERCENTILES = (50, 90, 99)
+# (tickers, years, requests per endpoint) defaults against MongoDB and mongomock
+DEFAULTS = {'mongodb': (20, 20, 50), 'mongomock': (5, 3, 5)}
+# Endpoints answered from history aggregations, far too slow on mongomock
+AGGREGATION_ENDPOINTS = ('details', 'history_json', 'history_columnar', 'history_points', 'dividends')
+
+
+class StageTimer:
+    '''Collect latencies per stage name'''
+    def __init__(self):
+        self.samples = {}
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+        return timed
+
+    def summary(self):
+        return {stage: latency_summary(samples) for stage, samples in self.samples.items()}
+
+
+def latency_summary(samples):
+    values = np.array(samples) * 1000
+    summary = {'count': len(values), 'mean_ms': float(values.mean())}
+    for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary['p{0}_ms'.format(p)] = float(value)
+    return summary
+
+
+def connect(uri, name):
+    if uri:
+        from pymongo import MongoClient
+        client = MongoClient(uri)
+        client.drop_database(name)
+        return client[name]
+    import mongomock
+    return mongomock.MongoClient()[name]
+
+
+def run_pipeline(database, yahoo, companies, args):
+    '''Run the data_pipeline flow twice: a cold full download and an incremental run with no new data'''
+    from lib.data_wrapper import DividendData
+    from lib.yahoo_downloader import Downloader
+    import data_pipeline
+
+    database.companies.insert_many([dict(company) for company in companies])
+    database.meta.update_one({'_id': 'historyLayout'}, {'$set': {'layout': args.layout}}, upsert=True)
+    # Mark the company list as checked this month, the DRIP sheet is not part of the benchmark
+    database.meta.update_one({'_id': 'dripSheet'}, {'$set': {'checked': datetime.today()}}, upsert=True)
+
+    downloader = Downloader(rate_limit=args.rate, auth_cache=None, quote_url=yahoo.quote_url, download_url=yahoo.download_url)
+    data = DividendData(downloader=downloader, panel_path=os.path.join(args.workdir, 'panel'), db=database)
+    timer = StageTimer()
+    data.update_company_history = timer.wrap('history', data.update_company_history)
+    data.update_company_profile = timer.wrap('profile', data.update_company_profile)
+    data.update_company_profiles = timer.wrap('profiles_bulk', data.update_company_profiles)
+
+    runs = {}
+    for run in ('cold', 'incremental'):
+        timer.samples = {}
+        start = time.perf_counter()
+        tickers = timer.wrap('company_list', data.update_basic_company_data)()
+        results = data_pipeline.refresh_all(data, tickers, workers=args.workers, bulk=args.bulk)
+        elapsed = time.perf_counter() - start
+        runs[run] = {
+            'tickers': len(tickers),
+            'failed': sorted(ticker for ticker, error in results.items() if error),
+            'seconds': elapsed,
+            'tickers_per_second': len(tickers) / elapsed,
+            'stages': timer.summary()
+        }
+    runs['downloader'] = downloader.get_stats()
+    return runs
+
+
+def run_server(database, tickers, args):
+    '''Hit every dataserver endpoint through the Flask test client'''
+    # Always answer live, not from materialized payloads
+    os.environ['PAYLOAD_DIR'] = ''
+    import db
+    import server
+    db.db = database
+    db._history_layout = None
+    server.cache.clear()
+    server.app.config['PROPAGATE_EXCEPTIONS'] = True
+    client = server.app.test_client()
+
+    endpoints = {
+        'companies': lambda ticker: '/data/companies',
+        'info': lambda ticker: '/info/{0}'.format(ticker),
+        'details': lambda ticker: '/details/{0}'.format(ticker),
+        'history_json': lambda ticker: '/data/history/{0}?type=price&range={1}'.format(ticker, args.years),
+        'history_columnar': lambda ticker: '/data/history/{0}?type=price&range={1}&format=columnar'.format(ticker, args.years),
+        'history_points': lambda ticker: '/data/history/{0}?type=price&range={1}&points=500'.format(ticker, args.years),
+        'dividends': lambda ticker: '/data/history/{0}?type=dividend&range={1}'.format(ticker, args.years)
+    }
+    if not args.mongo:
+        for name in AGGREGATION_ENDPOINTS:
+            del endpoints[name]
+    results = {}
+    for name, url in endpoints.items():
+        samples, sizes = [], []
+        for i in range(args.requests):
+            server.cache.clear()
+            start = time.perf_counter()
+            response = client.get(url(tickers[i % len(tickers)]), headers={'Accept-Encoding': 'gzip'})
+            samples.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError('{0} returned {1}'.format(url(tickers[i % len(tickers)]), response.status_code))
+            sizes.append(len(response.get_data()))
+        results[name] = dict(latency_summary(samples), bytes=int(np.mean(sizes)))
+    return results
+
+
+def compare(report, baseline, tolerance):
+    '''List of metrics that regressed by more than tolerance relative to the baseline'''
+    regressions = []
+    checks = []
+    for run in ('cold', 'incremental'):
+        checks.append(('pipeline.{0}.tickers_per_second'.format(run),
+                       report['pipeline'][run]['tickers_per_second'], baseline['pipeline'][run]['tickers_per_second'], False))
+        for stage, summary in report['pipeline'][run]['stages'].items():
+            previous = baseline['pipeline'][run]['stages'].get(stage)
+            if previous:
+                checks.append(('pipeline.{0}.{1}.p50_ms'.format(run, stage), summary['p50_ms'], previous['p50_ms'], True))
+    for name, summary in report['server'].items():
+        previous = baseline['server'].get(name)
+        if previous:
+            checks.append(('server.{0}.p50_ms'.format(name), summary['p50_ms'], previous['p50_ms'], True))
+    checks.append(('pipeline_peak_memory_mb', report['pipeline_peak_memory_mb'], baseline['pipeline_peak_memory_mb'], True))
+
+    for name, value, previous, lower_is_better in checks:
+        if lower_is_better and value > previous * (1 + tolerance):
+            regressions.append('{0}: {1:.2f} vs {2:.2f}'.format(name, value, previous))
+        elif not lower_is_better and value < previous * (1 - tolerance):
+            regressions.append('{0}: {1:.2f} vs {2:.2f}'.format(name, value, previous))
+    return regressions
+
+
+def print_report(report):
+    print('Pipeline ({tickers} tickers x {years} years, {workers} workers)'.format(**report['config']))
+    for run in ('cold', 'incremental'):
+        result = report['pipeline'][run]
+        print('  {0:<12} {1:8.2f} s  {2:8.2f} tickers/s  failed: {3}'.format(
+            run, result['seconds'], result['tickers_per_second'], len(result['failed'])))
+        for stage, summary in sorted(result['stages'].items()):
+            print('    {0:<14} p50 {1:9.2f} ms  p90 {2:9.2f} ms  p99 {3:9.2f} ms'.format(
+                stage, summary['p50_ms'], summary['p90_ms'], summary['p99_ms']))
+    print('Server')
+    for name, summary in sorted(report['server'].items()):
+        print('  {0:<18} p50 {1:8.2f} ms  p90 {2:8.2f} ms  p99 {3:8.2f} ms  {4:>9} bytes'.format(
+            name, summary['p50_ms'], summary['p90_ms'], summary['p99_ms'], summary['bytes']))
+    print('Pipeline peak memory: {0:.1f} MB'.format(report['pipeline_peak_memory_mb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tickers', type=int, default=None, help='20 against MongoDB, 5 on mongomock')
+    parser.add_argument('--years', type=int, default=None, help='20 against MongoDB, 3 on mongomock')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--bulk', action='store_true', help='update profiles with bulk writes')
+    parser.add_argument('--rate', type=float, default=None, help='Yahoo requests per second limit')
+    parser.add_argument('--requests', type=int, default=None,
+                        help='requests per dataserver endpoint, 50 against MongoDB, 5 on mongomock')
+    parser.add_argument('--layout', default='single', choices=['single', 'bucketed'], help='history storage layout')
+    parser.add_argument('--mongo', default=None, help='MongoDB URI, in-memory mongomock if not given')
+    parser.add_argument('--database', default='dividend_benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    parser.add_argument('--output', default=None, help='write the JSON report to this file')
+    args = parser.parse_args()
+    defaults = DEFAULTS['mongodb' if args.mongo else 'mongomock']
+    args.tickers = args.tickers or defaults[0]
+    args.years = args.years or defaults[1]
+    args.requests = args.requests or defaults[2]
+    args.workdir = tempfile.mkdtemp(prefix='dividend-bench-')
+    os.chdir(args.workdir)
+
+    companies, data = generate_universe(args.tickers, args.years, args.seed)
+    yahoo = FakeYahoo(data).start()
+    database = connect(args.mongo, args.database)
+
+    report = {
+        'config': {
+            'tickers': args.tickers, 'years': args.years, 'requests': args.requests, 'workers': args.workers,
+            'bulk': args.bulk, 'layout': args.layout, 'mongo': 'mongodb' if args.mongo else 'mongomock',
+            'python': platform.python_version()
+        }
+    }
+    try:
+        # Memory is traced around the pipeline only, tracing would distort the server latencies
+        tracemalloc.start()
+        try:
+            report['pipeline'] = run_pipeline(database, yahoo, companies, args)
+            report['pipeline_peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    finally:
+        yahoo.stop()
+    report['server'] = run_server(database, [company['ticker'] for company in companies], args)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Baseline saved to {0}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != report['config']:
+            print('Baseline was recorded with a different configuration, not comparing')
+        else:
+            regressions = compare(report, baseline, args.tolerance)
+            if regressions:
+                print('Regressions against baseline:')
+                for regression in regressions:
+                    print('  ' + regression)
+                sys.exit(1)
+            print('No regressions against baseline')
@@ -0,0 +1,81 @@
+#-*- coding: utf-8 -*-
+
+'''Reproducible synthetic price, dividend and split history for N tickers x Y years,
+in the CSV format of the Yahoo download endpoint, plus matching company list records'''
+
+from datetime import date, datetime
+import zlib
+import numpy as np
+
+CATEGORIES = ((25, 'champion'), (10, 'contender'), (5, 'challenger'))
+
+
+def trading_days(years, end=None):
+    end = end or date.today()
+    start = end.replace(year=end.year - years)
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+    # 1970-01-01 was a Thursday, so (days + 3) % 7 gives Monday = 0
+    return days[(days.astype('int64') + 3) % 7 < 5]
+
+
+def ticker_names(count):
+    return ['T{0:04d}'.format(i) for i in range(count)]
+
+
+def generate_ticker(ticker, years, seed=0):
+    '''Return {'history', 'div', 'split'} CSV bytes for one ticker'''
+    rng = np.random.RandomState((zlib.crc32(ticker.encode('utf-8')) + seed * 7919) % 2 ** 32)
+    days = trading_days(years)
+    close = rng.uniform(20, 120) * np.exp(np.cumsum(rng.normal(0.0003, 0.012, len(days))))
+    adj_close = close * np.linspace(0.6, 1.0, len(days))
+    opening = close * (1 + rng.normal(0, 0.004, len(days)))
+    volume = rng.randint(100000, 10000000, len(days))
+    dates = days.astype(str)
+
+    history = ['Date,Open,High,Low,Close,Adj Close,Volume']
+    for i in range(len(days)):
+        high, low = max(opening[i], close[i]) * 1.005, min(opening[i], close[i]) * 0.995
+        history.append('{0},{1:.6f},{2:.6f},{3:.6f},{4:.6f},{5:.6f},{6}'.format(
+            dates[i], opening[i], high, low, close[i], adj_close[i], volume[i]))
+
+    dividend = rng.uniform(0.1, 0.8)
+    div = ['Date,Dividends']
+    for i in range(len(days) - 1 - rng.randint(0, 63), 0, -63):
+        div.append('{0},{1:.6f}'.format(dates[i], dividend))
+        if rng.rand() < 0.25:
+            dividend *= 0.95
+
+    split = ['Date,Stock Splits']
+    if rng.rand() < 0.3:
+        split.append('{0},2/1'.format(dates[rng.randint(0, len(days))]))
+
+    return {name: ('\n'.join(lines) + '\n').encode('utf-8') for name, lines in
+            (('history', history), ('div', div), ('split', split))}
+
+
+def generate_companies(tickers, seed=0):
+    '''Company list records as stored by DividendData.update_basic_company_data'''
+    rng = np.random.RandomState(seed)
+    companies = []
+    for ticker in tickers:
+        years = int(rng.randint(5, 60))
+        companies.append({
+            'ticker': ticker,
+            'name': 'Company {0}'.format(ticker),
+            'industry': 'Industry {0}'.format(rng.randint(0, 20)),
+            'divRaiseYrs': years,
+            'category': next(name for limit, name in CATEGORIES if years >= limit),
+            'divg1y': float(rng.uniform(0, 15)),
+            'divg3y': float(rng.uniform(0, 15)),
+            'divg5y': float(rng.uniform(0, 15)),
+            'divg10y': float(rng.uniform(0, 15)),
+            'EPS': float(rng.uniform(0.5, 8)),
+            'downloaded': datetime.today()
+        })
+    return companies
+
+
+def generate_universe(count, years, seed=0):
+    '''Return (companies, {ticker: csv data}) for count tickers'''
+    tickers = ticker_names(count)
+    return (generate_companies(tickers, seed), {ticker: generate_ticker(ticker, years, seed) for ticker in tickers})
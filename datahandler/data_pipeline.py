@@ -1,12 +1,149 @@
 #!/usr/bin/env python3
 #-*- coding: utf-8 -*-
 
+import argparse
+import logging
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from lib.data_wrapper import DividendData
+from lib.metrics import Metrics
+from lib.storage import open_storage
+from lib.work_queue import WorkQueue
+from lib.yahoo_downloader import Downloader
+
+DATASERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataserver')
+
+
+def refresh_ticker(data, ticker, profile=True):
+    '''Update history and profile of one ticker, returning (ticker, error message or None)'''
+    try:
+        if not data.update_company_history(ticker):
+            return (ticker, 'history update failed')
+        if profile and not data.update_company_profile(ticker):
+            return (ticker, 'profile update failed')
+    except Exception as e:
+        return (ticker, str(e))
+    return (ticker, None)
+
+
+def refresh_all(data, tickers, workers=1, bulk=False, chunk_size=500):
+    '''Refresh every ticker, fanning out over a thread pool when workers > 1.
+    In bulk mode profiles are updated afterwards in one batch instead of per ticker.'''
+    refresh = lambda ticker: refresh_ticker(data, ticker, profile=not bulk)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = dict(executor.map(refresh, tickers))
+    else:
+        results = dict(refresh(ticker) for ticker in tickers)
+
+    if bulk:
+        updated = [ticker for ticker, error in results.items() if error is None]
+        for ticker, error in data.update_company_profiles(updated, chunk_size=chunk_size).items():
+            if error:
+                results[ticker] = 'profile update failed: {0}'.format(error)
+    return results
+
+
+def refresh_due(data, queue, tickers, workers=1, bulk=False, chunk_size=500, batch_size=50):
+    '''Refresh only the tickers that are due, in batches claimed from the work queue,
+    recording the outcome of every batch so an interrupted run resumes where it stopped'''
+    results = {}
+    try:
+        for batch in queue.batches(tickers, batch_size):
+            batch_results = refresh_all(data, batch, workers=workers, bulk=bulk, chunk_size=chunk_size)
+            queue.complete(batch_results)
+            results.update(batch_results)
+    finally:
+        queue.release()
+    return results
+
+
+def materialize_payloads(directory, storage=None):
+    '''Render the precompressed dashboard payloads of the current data into directory
+    with the dataserver's own templates and routes (dataserver/payloads.py)'''
+    env = dict(os.environ)
+    if storage:
+        if storage.startswith('sqlite:///'):
+            # The dataserver resolves relative paths from its own directory
+            storage = 'sqlite:///' + os.path.abspath(storage[len('sqlite:///'):])
+        env['DIVIDEND_STORAGE'] = storage
+    subprocess.run([sys.executable, 'payloads.py', os.path.abspath(directory)], cwd=DATASERVER_DIR, env=env, check=True)
+
+
+def report(results, downloader, metrics=None):
+    '''Log and print per-ticker outcome of the refresh, the download counters and the stage timings'''
+    failed = {ticker: error for ticker, error in results.items() if error}
+    for ticker, error in sorted(failed.items()):
+        logging.error('Refresh failed for {0}: {1}'.format(ticker, error))
+    print('Refreshed {0} of {1} tickers'.format(len(results) - len(failed), len(results)))
+    if failed:
+        print('Failed: {0}'.format(', '.join('{0} ({1})'.format(t, e) for t, e in sorted(failed.items()))))
+    stats = downloader.get_stats()
+    logging.info('Download stats: {0}'.format(stats))
+    print('Requests: {requests}, retries: {retries}, auth errors: {auth_errors}'.format(**stats))
+    if metrics is not None and metrics.enabled:
+        for stage, summary in metrics.summary()['stages'].items():
+            print('{0:<16} {1:>6} calls {2:10.2f} s total {3:8.3f} s max'.format(
+                stage, summary['count'], summary['totalSeconds'], summary['maxSeconds']))
+
+
+def export_metrics(metrics, directory):
+    '''Save the run summary as run-<timestamp>.json and the Prometheus text as pipeline.prom'''
+    os.makedirs(directory, exist_ok=True)
+    metrics.write_json(os.path.join(directory, 'run-{0:%Y%m%d-%H%M%S}.json'.format(metrics.started)))
+    metrics.write_prometheus(os.path.join(directory, 'pipeline.prom'))
+    logging.info('Run metrics saved to {0}'.format(directory))
 
 
 if __name__ == '__main__':
-    data = DividendData()
-    tickers = data.update_basic_company_data()
-    for ticker in tickers:
-        data.update_company_history(ticker)
-        data.update_company_profile(ticker)
+    parser = argparse.ArgumentParser(description='Refresh company list, price history and profiles')
+    parser.add_argument('--workers', type=int, default=1, help='number of tickers refreshed concurrently')
+    parser.add_argument('--bulk', action='store_true', help='update profiles in one batch with bulk writes')
+    parser.add_argument('--chunk-size', type=int, default=500, help='operations per bulk write')
+    parser.add_argument('--panel', action='store_true', help='append new days to the local price panel')
+    parser.add_argument('--rate', type=float, default=4.0, help='max. Yahoo requests per second across all workers')
+    parser.add_argument('--storage', metavar='URI', default=os.environ.get('DIVIDEND_STORAGE'),
+                        help='mongodb://... or sqlite:///file.db, the local MongoDB server by default')
+    parser.add_argument('--all', action='store_true',
+                        help='refresh every ticker in list order instead of the due ones from the work queue')
+    parser.add_argument('--batch-size', type=int, default=50, help='tickers claimed from the work queue at a time')
+    parser.add_argument('--payloads', metavar='DIR', default=None,
+                        help='finally materialize precompressed dashboard payloads for the dataserver into DIR')
+    parser.add_argument('--metrics', metavar='DIR', default=None,
+                        help='record stage timings and counters, saved as JSON and Prometheus text to DIR')
+    args = parser.parse_args()
+
+    metrics = Metrics(enabled=args.metrics is not None)
+    downloader = Downloader(rate_limit=args.rate, pool_size=max(args.workers, 10), metrics=metrics)
+    data = DividendData(downloader=downloader, metrics=metrics, storage=open_storage(args.storage))
+    with metrics.timer('company_list'):
+        tickers = data.update_basic_company_data()
+    if args.all:
+        results = refresh_all(data, tickers, workers=args.workers, bulk=args.bulk, chunk_size=args.chunk_size)
+    else:
+        results = refresh_due(data, WorkQueue(data.storage), tickers, workers=args.workers, bulk=args.bulk,
+                              chunk_size=args.chunk_size, batch_size=args.batch_size)
+    metrics.count('tickers_skipped', len(tickers) - len(results))
+    failed = sum(1 for error in results.values() if error)
+    metrics.count('tickers_refreshed', len(results) - failed)
+    metrics.count('tickers_failed', failed)
+    try:
+        with metrics.timer('growth_refresh'):
+            data.update_dividend_growth(tickers)
+    except Exception as e:
+        logging.error('Cannot update dividend growth: {0}'.format(e))
+    if args.panel:
+        with metrics.timer('panel_refresh'):
+            data.refresh_panel(tickers)
+    if args.payloads:
+        try:
+            with metrics.timer('payloads'):
+                materialize_payloads(args.payloads, args.storage)
+        except (subprocess.CalledProcessError, OSError) as e:
+            # The dataserver answers live until the next run materializes them
+            logging.error('Cannot materialize payloads: {0}'.format(e))
+    report(results, downloader, metrics)
+    if args.metrics:
+        export_metrics(metrics, args.metrics)
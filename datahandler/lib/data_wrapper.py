@@ -6,20 +6,37 @@ import numpy as np
 from datetime import datetime
 import pandas as pd
 from lib.yahoo_downloader import Downloader
+from lib.metrics import Metrics
+from lib.storage import MongoStorage
+from lib.price_panel import PricePanel
+from lib import dividend_growth, yield_stats
 import math
+import hashlib
+import json
 import logging
+import os
+import requests
 import sys
 
 
 class DividendData:
     '''Class for saving, retrieving and updating company data in aristocrats database'''
-    def __init__(self):
-        logging.basicConfig(filename='datahandler.log', filemode='w', level=logging.INFO, format='%(asctime)s;%(levelname)s;%(message)s')
+    # Removals from the company list are only applied if the parsed DRIP sheet has at least this share of the stored companies
+    MIN_LIST_RATIO = 0.5
+
+    def __init__(self, downloader=None, panel_path='panel', db=None, metrics=None, storage=None):
+        logging.basicConfig(filename='datahandler.log', filemode='a', level=logging.INFO, format='%(asctime)s;%(levelname)s;%(message)s')
         logging.debug('Setting up data wrapper')
-        self.db = MongoClient().dividend_investing
-        self.downloader = Downloader()
+        # Any backend from lib.storage, by default the MongoDB database given or the local server
+        self.storage = storage or MongoStorage(db if db is not None else MongoClient().dividend_investing)
+        self.metrics = metrics or Metrics(enabled=False)
+        self.downloader = downloader or Downloader(metrics=self.metrics)
+        self.panel = PricePanel(panel_path)
         self.DRIP_URL = 'http://www.dripinvesting.org/tools/U.S.DividendChampions.xls'
+        self.DRIP_CACHE = os.path.join('cache', 'U.S.DividendChampions.xls')
         try:
+            self.history = self.storage.history
+            self.storage.ensure_indexes()
             self.companies = self._get_companies()
         except Exception as e:
             logging.critical(e)
@@ -34,11 +51,41 @@ class DividendData:
         else:
             return 'challenger'
 
-    def download_drip_sheet(self):
-        '''Get data sheet from DRIP investing'''
+    def _fetch_drip_workbook(self):
+        '''Download the DRIP workbook into the local cache with a conditional request.
+        Returns (path, state): path is None if the workbook has not changed since the last download,
+        state holds the validators to save once the new sheet is processed.'''
+        state = self.storage.get_meta('dripSheet') or {}
+        headers = {}
+        if os.path.exists(self.DRIP_CACHE):
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('lastModified'):
+                headers['If-Modified-Since'] = state['lastModified']
+        r = requests.get(self.DRIP_URL, headers=headers, timeout=120)
+        if r.status_code == 304:
+            return (None, state)
+        r.raise_for_status()
+
+        content_hash = hashlib.sha1(r.content).hexdigest()
+        new_state = {
+            'etag': r.headers.get('ETag'),
+            'lastModified': r.headers.get('Last-Modified'),
+            'contentHash': content_hash
+        }
+        if content_hash == state.get('contentHash') and os.path.exists(self.DRIP_CACHE):
+            # Server ignored the validators but sent the same workbook
+            return (None, new_state)
+        os.makedirs(os.path.dirname(self.DRIP_CACHE), exist_ok=True)
+        with open(self.DRIP_CACHE, 'wb') as f:
+            f.write(r.content)
+        return (self.DRIP_CACHE, new_state)
+
+    def download_drip_sheet(self, source=None):
+        '''Get data sheet from DRIP investing (or a local copy of the workbook)'''
         logging.debug('Trying to download DRIP datasheet...')
         try:
-            companies = pd.read_excel(self.DRIP_URL, sheetname='All CCC')
+            companies = pd.read_excel(source or self.DRIP_URL, sheetname='All CCC')
         except Exception as e:
             logging.critical('Cannot download DRIP datasheet: {0}'.format(e))
         else:
@@ -66,57 +113,70 @@ class DividendData:
             return company_list
 
     def _download_company_history(self, ticker, interval=20):
-        '''Get price and dividend history of a company from Yahoo and format/process it'''
+        '''Get price and dividend history of a company from Yahoo as a DataFrame
+        with adjClose, dividend, lastDivAnnual and divYield columns'''
         logging.debug('Getting {1} year history for {0}'.format(ticker, interval))
         try:
-            data = self.downloader.get_history(ticker=ticker, years=interval)
+            data = self.downloader.get_history(ticker=ticker, years=interval, fields=['Adj Close'])
         except Exception as e:
             logging.error('Failed to download history for {0}: {1}'.format(ticker, e))
-            return []
-        else:
-            data['date'] = data.index
-            data['ticker'] = ticker
-
-            data.drop(['Open', 'High', 'Low', 'Close', 'Volume', 'Stock Splits'], axis=1, inplace=True)
+            return None
+        with self.metrics.timer('transform'):
+            data.drop(['Stock Splits'], axis=1, inplace=True)
             data.rename(columns={
                 'Adj Close': 'adjClose',
                 'Dividends': 'dividend'
             }, inplace=True)
 
-            # Yahoo data series sometimes contain 'null' values
-            data['adjClose'] = pd.to_numeric(data['adjClose'], errors='coerce')
+            # Yahoo data series sometimes contain 'null' values, parsed as NaN by the downloader
             data.dropna(axis=0, how='any', subset=['adjClose'], inplace=True)
 
-            data['lastDivAnnual'] = data['dividend'].replace(0, value=np.nan).fillna(method='ffill') * 4
+            data['lastDivAnnual'] = data['dividend'].replace(0, value=np.nan).ffill() * 4
             try:
                 data['divYield'] = data['lastDivAnnual'] / data['adjClose'] * 100
             except Exception as e:
                 logging.error('When trying to calculate div yield for {0}: {1}'.format(ticker, e))
                 data['divYield'] = np.nan
 
-            daily = data.drop(['dividend'], axis=1).where(pd.notnull(data), None)
-            daily['type'] = 'price'
-
-            dividend = data[data['dividend'] != 0].drop(['adjClose', 'lastDivAnnual', 'divYield'], axis=1)
-            dividend['type'] = 'dividend'
             logging.info('Retrieved history for {0}'.format(ticker))
-            return daily.to_dict(orient='records') + dividend.to_dict(orient='records')
+            return data
+
+    def _iter_history_documents(self, ticker, data, batch_size=1000):
+        '''Lazily turn a history DataFrame into (price documents, dividend documents) batches'''
+        def value(number):
+            return None if number != number else float(number)
+
+        for start in range(0, len(data), batch_size):
+            chunk = data.iloc[start:start + batch_size]
+            dates = chunk.index.to_pydatetime()
+            price_data = [
+                {'adjClose': value(adj_close), 'date': date, 'ticker': ticker, 'lastDivAnnual': value(last_div),
+                 'divYield': value(div_yield), 'type': 'price'}
+                for date, adj_close, last_div, div_yield
+                in zip(dates, chunk['adjClose'].values, chunk['lastDivAnnual'].values, chunk['divYield'].values)
+            ]
+            dividend_data = [
+                {'dividend': float(dividend), 'date': date, 'ticker': ticker, 'type': 'dividend'}
+                for date, dividend in zip(dates, chunk['dividend'].values) if dividend != 0
+            ]
+            yield (price_data, dividend_data)
 
     def _get_companies(self):
         '''Download company list from database companies collection'''
         logging.debug('Getting company list from database')
         try:
-            cursor = self.db.companies.find()
+            return self.storage.get_companies()
         except Exception as e:
             logging.error('Cannot retrieve company list: {0}'.format(e))
             return None
-        else:
-            return list(cursor)
 
     def _check_download_date(self):
         '''Get the last time the company list was updated'''
         logging.debug('Checking last download date in company list')
-        if self.companies and len(self.companies) > 0:
+        state = self.storage.get_meta('dripSheet')
+        if state and state.get('checked'):
+            return state['checked']
+        elif self.companies and len(self.companies) > 0:
             max_date = np.max([company['downloaded'] for company in self.companies])
             return max_date
         else:
@@ -133,89 +193,112 @@ class DividendData:
         return tickers
 
     def update_basic_company_data(self):
-        '''Insert or update basic company data, returning list of tickers'''
+        '''Insert, update or remove basic company data if the DRIP sheet changed, returning list of tickers'''
         logging.debug('Updating basic company data')
         last_downloaded = self._check_download_date()
-        if last_downloaded and datetime.today().month == last_downloaded.month:
+        today = datetime.today()
+        if last_downloaded and (today.year, today.month) == (last_downloaded.year, last_downloaded.month):
             logging.info('Company list seems up-to-date, skipping download')
+            return self.get_tickers()
+
+        logging.info('Company list is outdated, checking DRIP datasheet')
+        try:
+            path, state = self._fetch_drip_workbook()
+        except Exception as e:
+            logging.critical('Cannot download DRIP datasheet: {0}'.format(e))
+            return self.get_tickers()
+
+        if path is None:
+            logging.info('DRIP datasheet not modified since last download')
         else:
-            logging.info('Company list is outdated, download needed')
-            self.companies = self.download_drip_sheet()
-            logging.debug('Starting to upload company profiles')
-            for company in self.companies:
-                try:
-                    self.db.companies.update_one({'ticker': company['ticker']}, {'$set': company}, upsert=True)
-                except Exception as e:
-                    logging.error('{0} when uploading {1} to company collection'.format(e, company['ticker']))
-                else:
-                    logging.info('{0} is uploaded to company collection'.format(company['ticker']))
-            logging.debug('Company list update finished')
+            companies = self.download_drip_sheet(path)
+            if companies is None:
+                return self.get_tickers()
+            self._apply_company_changes(companies)
+            self.companies = self._get_companies()
+
+        self.storage.set_meta('dripSheet', dict(state, checked=today))
         return self.get_tickers()
 
+    def _record_hash(self, company):
+        '''Hash of a normalized DRIP record, ignoring the download stamp'''
+        record = {key: value for key, value in company.items() if key not in ('downloaded', 'recordHash')}
+        return hashlib.sha1(json.dumps(record, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _apply_company_changes(self, companies):
+        '''Write only added and changed companies and remove the ones dropped from the list'''
+        stored = {company['ticker']: company.get('recordHash') for company in self.companies or []}
+        changed = {}
+        for company in companies:
+            company['recordHash'] = self._record_hash(company)
+            if stored.get(company['ticker']) != company['recordHash']:
+                changed[company['ticker']] = company
+        removed = sorted(set(stored) - set(company['ticker'] for company in companies))
+        if removed and len(companies) < len(stored) * self.MIN_LIST_RATIO:
+            # An empty or truncated parse (e.g. a changed sheet layout) must not wipe the stored companies
+            logging.critical('DRIP sheet parsed to {0} companies against {1} stored, not removing {2} companies'.format(
+                len(companies), len(stored), len(removed)))
+            removed = []
+
+        logging.info('DRIP changes: {0} added or changed, {1} removed, {2} unchanged'.format(
+            len(changed), len(removed), len(companies) - len(changed)))
+        errors = self.storage.update_companies(changed, upsert=True)
+        errors.update(self.storage.remove_companies(removed))
+        for ticker in list(changed) + removed:
+            if ticker in errors:
+                logging.error('{0} when uploading {1} to company collection'.format(errors[ticker], ticker))
+            elif ticker in removed:
+                logging.info('{0} is removed from company collection'.format(ticker))
+            else:
+                logging.info('{0} is uploaded to company collection'.format(ticker))
+        logging.debug('Company list update finished')
+
     def update_company_history(self, ticker):
         '''Save new entries in price and dividend history'''
         logging.debug('Updating history for {0}'.format(ticker))
-        try:
-            # Get the last existing date from database
-            agg = self.db.history.aggregate([
-                {'$match': {'ticker': ticker}},
-                {'$project': {'_id': 0, 'price': 1}},
-                {'$unwind': '$price'},
-                {'$sort': {'price.date': -1}},
-                {'$limit': 1},
-                {'$project': {'price.date': 1}}
-            ])
-            max_date = list(agg)[0]['price']['date']
+        # Get the last existing date from database
+        max_date = self.history.get_last_date(ticker)
+        if max_date is not None:
             delta = datetime.today() - max_date
             interval = min([math.ceil(delta.days / 365) + 1, 20])
-        except IndexError:
+        else:
             # Company is not in database or no price data yet
             max_date = datetime(1900, 1, 1)
             interval = 20
 
         data = self._download_company_history(ticker, interval)
+        if data is None:
+            return False
 
-        price_data = [item for item in data if item['type'] == 'price' and item['date'] > max_date]
-        dividend_data = [item for item in data if item['type'] == 'dividend' and item['date'] > max_date]
-
-        if len(price_data) == 0 and len(dividend_data) == 0:
+        # Drop already stored days before building any documents
+        data = data[data.index > max_date]
+        price_count = len(data)
+        dividend_count = int((data['dividend'] != 0).sum())
+        if price_count == 0 and dividend_count == 0:
             logging.info('No new data for {0}, no updates added to database'.format(ticker))
             return True
         else:
-            logging.info('{0} price data, {1} dividend data for {2}'.format(len(price_data), len(dividend_data), ticker))
+            logging.info('{0} price data, {1} dividend data for {2}'.format(price_count, dividend_count, ticker))
 
-        # Insert document and placeholder fields if company is not in collection
         try:
-            self.db.history.update_one(
-                {'ticker': ticker},
-                {'$setOnInsert': {
-                    'ticker': ticker
-                },
-                '$push': {
-                    'price': {'$each': price_data},
-                    'dividend': {'$each': dividend_data}
-                },
-                '$set': {'lastUpdated': datetime.today()}
-                },
-                upsert=True)
+            with self.metrics.timer('history_write'):
+                for price_data, dividend_data in self._iter_history_documents(ticker, data):
+                    self.history.append(ticker, price_data, dividend_data)
+                    self.metrics.count('price_rows_written', len(price_data))
+                    self.metrics.count('dividend_rows_written', len(dividend_data))
         except Exception as e:
             logging.error('Cannot update {0} in history collection: {1}'.format(ticker, e))
             return False
         else:
-            logging.info('{0} history updated with {1} values'.format(ticker, len(price_data) + len(dividend_data)))
+            logging.info('{0} history updated with {1} values'.format(ticker, price_count + dividend_count))
             return True
 
     def _get_latest_data(self, ticker, type='price'):
         '''Get the last entry in history of a given ticker'''
         try:
-            agg = self.db.history.aggregate([
-                {'$match': {'ticker': ticker}},
-                {'$project': {'_id': 0, 'price': 1}},
-                {'$unwind': '$price'},
-                {'$sort': {'price.date': -1}},
-                {'$limit': 1}
-            ])
-            last_item = list(agg)[0]['price']
+            last_item = self.history.get_last_price(ticker)
+            if last_item is None:
+                raise Exception('no price data stored')
         except Exception as e:
             logging.error('Cannot retrieve latest price data for {0}: {1}'.format(ticker, e))
             return None
@@ -225,44 +308,127 @@ class DividendData:
 
     def _calculate_payout_ratio(self, ticker, last_div):
         '''Calculate the dividend-to-EPS payout ratio, if possible'''
-        EPS = self.db.companies.find_one({'ticker': ticker}, projection={'_id': 0, 'EPS': 1})['EPS']
-        if EPS and EPS > 0:
-            payout = last_div / EPS * 100
-        else:
-            payout = None
+        EPS = self.storage.get_company(ticker, fields=['EPS'])['EPS']
+        payout = self._payout_ratio(last_div, EPS)
         logging.debug('Payout calculated for {0}'.format(ticker))
         return payout
 
-    def get_yield_distribution(self, ticker, interval=10):
-        '''Calculate min, max, stdev, mean div yield for the given interval'''
+    def _payout_ratio(self, last_div, EPS):
+        if EPS and EPS > 0:
+            return last_div / EPS * 100
+        else:
+            return None
+
+    def get_yield_statistics(self, ticker, last_price=None, windows=yield_stats.WINDOWS):
+        '''Calculate yield statistics of the ticker for every trailing window (keyed '1y', '3y'...)'''
         try:
-            history = self.db.history.find_one({'ticker': ticker}, projection={'_id': 0, 'price': 1})['price']
+            if last_price is None:
+                last_price = self.history.get_last_price(ticker)
+            # The storage backend decides where the aggregation runs (in Python or pushed down to SQL)
+            stats = self.history.yield_statistics(ticker, last_price, windows) if last_price is not None else None
         except Exception as e:
             logging.error('Cannot retrieve price history for {0} for yield distribution: {1}'.format(ticker, e))
             return None
         else:
-            if len(history) > 0:
-                max_date = np.max([item['date'] for item in history])
-                start_date = max_date.replace(year=max_date.year - interval)
-                filtered = [item['divYield'] for item in history if item['date'] > start_date and item['divYield']]
-
-                yield_dist = {
-                    'interval': interval,
-                    'max': np.max(filtered),
-                    'min': np.min(filtered),
-                    'mean': np.mean(filtered),
-                    'std': np.std(filtered)
-                }
-                return yield_dist
-            else:
+            if stats is None:
+                logging.info('No history downloaded for {0}, cannot calculate yield distribution'.format(ticker))
+            return stats
+
+    def get_yield_statistics_batch(self, last_prices, windows=yield_stats.WINDOWS):
+        '''Yield statistics of several tickers by ticker from a dict of their latest price snapshots,
+        reading the price histories of all of them in one query instead of one per ticker'''
+        if not last_prices:
+            return {}
+        starts = {ticker: last['date'].replace(year=last['date'].year - max(windows))
+                  for ticker, last in last_prices.items()}
+        try:
+            histories = self.history.get_histories(list(last_prices), 'price', min(starts.values()))
+        except Exception as e:
+            logging.error('Cannot retrieve price history for yield distribution: {0}'.format(e))
+            return {ticker: None for ticker in last_prices}
+        stats = {}
+        for ticker, start in starts.items():
+            history = [item for item in histories.get(ticker, []) if item['date'] >= start]
+            stats[ticker] = yield_stats.window_statistics(*yield_stats.to_arrays(history), windows) if history else None
+            if stats[ticker] is None:
                 logging.info('No history downloaded for {0}, cannot calculate yield distribution'.format(ticker))
-                return None
+        return stats
+
+    def get_all_yield_statistics(self, tickers=None, windows=yield_stats.WINDOWS, from_panel=False):
+        '''Yield statistics for many tickers at once, computed in a single vectorized batch.
+        With from_panel the yields are read from the local price panel instead of the database.'''
+        if from_panel:
+            return self._get_panel_yield_statistics(tickers, windows)
+        histories = {}
+        for ticker in tickers or self.get_tickers():
+            try:
+                histories[ticker] = yield_stats.to_arrays(self.history.get_history(ticker, 'price'))
+            except Exception as e:
+                logging.error('Cannot retrieve price history for {0} for yield distribution: {1}'.format(ticker, e))
+        return yield_stats.batch_window_statistics(histories, windows)
+
+    def _get_panel_yield_statistics(self, tickers, windows):
+        dates, yields = self.panel.cross_section('divYield')
+        histories = {}
+        for column, ticker in enumerate(self.panel.tickers):
+            if tickers and ticker not in tickers:
+                continue
+            series = yields[:, column]
+            valid = np.isfinite(series) & (series > 0)
+            histories[ticker] = (dates[valid], series[valid])
+        return yield_stats.batch_window_statistics(histories, windows)
+
+    def update_dividend_growth(self, tickers=None, as_of=None, chunk_size=500):
+        '''Derive payment frequency, TTM dividends, growth rates and raise streak of every ticker
+        from the stored dividend history in one vectorized batch and save them as dividendGrowth.
+        Returns a dict of error messages by ticker for the writes that failed.'''
+        tickers = set(tickers or self.get_tickers())
+        with self.metrics.timer('dividend_growth'):
+            events = dividend_growth.to_ragged(
+                (ticker, dividends) for ticker, dividends in self.history.iter_dividends() if ticker in tickers)
+            metrics = dividend_growth.growth_metrics(*events, as_of=as_of)
+        # A stamp of its own: lastUpdated marks the ticker refreshed for the work queue, but the dataserver
+        # must see this write as a new data version too (see dataserver/queries.VERSION_FIELDS)
+        stamp = datetime.today()
+        with self.metrics.timer('dividend_growth_write'):
+            errors = self.storage.update_companies(
+                {ticker: {'dividendGrowth': values, 'growthUpdated': stamp} for ticker, values in metrics.items()},
+                chunk_size)
+        for ticker, error in errors.items():
+            logging.error('Cannot update {0} dividend growth: {1}'.format(ticker, error))
+        logging.info('Dividend growth updated for {0} tickers'.format(len(metrics) - len(errors)))
+        return errors
+
+    def refresh_panel(self, tickers=None):
+        '''Append history stored since the last refresh to the local price panel'''
+        logging.debug('Refreshing price panel')
+        self.panel.refresh(self.history, tickers or self.get_tickers())
+        logging.info('Price panel refreshed')
+
+    def get_panel_history(self, ticker, start_date=None, end_date=None):
+        '''Dates, adjClose, divYield and dividend arrays of the ticker from the local price panel'''
+        try:
+            return self.panel.slice(ticker, start_date, end_date)
+        except ValueError:
+            logging.info('{0} is not in the price panel'.format(ticker))
+            return None
+
+    def _distribution(self, stats, interval):
+        '''Min, max, mean and stdev subset of the window statistics, as stored in yieldDist'''
+        window = (stats or {}).get('{0}y'.format(interval))
+        if window is None:
+            return None
+        return {key: window[key] for key in ('interval', 'max', 'min', 'mean', 'std')}
+
+    def get_yield_distribution(self, ticker, interval=10, last_price=None):
+        '''Calculate min, max, stdev, mean div yield for the given interval'''
+        return self._distribution(self.get_yield_statistics(ticker, last_price, windows=(interval,)), interval)
 
     def update_company_profile(self, ticker):
         '''Set additional fields and data on existing aristocrat'''
         logging.debug('Updating {0} profile'.format(ticker))
         try:
-            data_used = self.db.companies.find_one({'ticker': ticker}, projection={'_id': 0, 'lastDataUsed': 1})
+            data_used = self.storage.get_company(ticker, fields=['lastDataUsed'])
             latest_data = self._get_latest_data(ticker)
 
             if 'lastDataUsed' in data_used and data_used['lastDataUsed'] == latest_data['date']:
@@ -270,18 +436,83 @@ class DividendData:
                 return True
 
             payout = self._calculate_payout_ratio(ticker, latest_data['lastDivAnnual'])
-            yield_dist = self.get_yield_distribution(ticker)
-            self.db.companies.update_one({'ticker': ticker}, {'$set': {
-                    'annualDividend': latest_data['lastDivAnnual'],
-                    'payout': payout,
-                    'yieldDist': yield_dist,
-                    'lastDataUsed': latest_data['date'],
-                    'divYield': latest_data['divYield'],
-                    'lastUpdated': datetime.today()
-            }})
+            profile = self._build_profile(ticker, latest_data, payout)
+            with self.metrics.timer('profile_write'):
+                self.storage.update_company(ticker, profile)
+            self.metrics.count('profiles_written')
         except Exception as e:
             logging.error('Cannot update {0} profile: {1}'.format(ticker, e))
             return None
         else:
             logging.info('{0} profile updated'.format(ticker))
             return True
+
+    def _build_profile(self, ticker, latest_data, payout, stats=None):
+        '''Profile fields derived from the latest price snapshot and the yield history
+        (read here unless the statistics are given)'''
+        if stats is None:
+            with self.metrics.timer('profile_compute'):
+                stats = self.get_yield_statistics(ticker, last_price=latest_data)
+        return {
+            'annualDividend': latest_data['lastDivAnnual'],
+            'payout': payout,
+            'yieldDist': self._distribution(stats, 10),
+            'yieldDist5y': self._distribution(stats, 5),
+            'yieldStats': stats,
+            'lastDataUsed': latest_data['date'],
+            'divYield': latest_data['divYield'],
+            'lastUpdated': datetime.today()
+        }
+
+    def update_company_profiles(self, tickers, chunk_size=500):
+        '''Batched version of update_company_profile: read company fields and latest prices
+        of all tickers at once and flush the profiles with bulk writes.
+        Returns a dict of error messages by ticker (None for success or no new data).'''
+        logging.debug('Updating {0} profiles in bulk'.format(len(tickers)))
+        results = {}
+        companies = self.storage.get_companies_by_ticker(tickers, fields=['EPS', 'lastDataUsed'])
+        latest = self.history.get_last_prices(tickers)
+
+        pending = {}
+        for ticker in tickers:
+            company = companies.get(ticker)
+            latest_data = latest.get(ticker)
+            if company is None or latest_data is None:
+                logging.error('Cannot update {0} profile: no company or price data'.format(ticker))
+                results[ticker] = 'no company or price data'
+                continue
+            if company.get('lastDataUsed') == latest_data['date']:
+                logging.info('No new data for {0}, skipping profile update'.format(ticker))
+                results[ticker] = None
+                continue
+            pending[ticker] = latest_data
+
+        # Price histories are read in chunks of tickers, one query each
+        stats = {}
+        pending_tickers = list(pending)
+        with self.metrics.timer('profile_compute'):
+            for start in range(0, len(pending_tickers), chunk_size):
+                chunk = pending_tickers[start:start + chunk_size]
+                stats.update(self.get_yield_statistics_batch({ticker: pending[ticker] for ticker in chunk}))
+
+        profiles = {}
+        for ticker, latest_data in pending.items():
+            try:
+                payout = self._payout_ratio(latest_data['lastDivAnnual'], companies[ticker].get('EPS'))
+                profile = self._build_profile(ticker, latest_data, payout, stats=stats.get(ticker))
+            except Exception as e:
+                logging.error('Cannot update {0} profile: {1}'.format(ticker, e))
+                results[ticker] = str(e)
+            else:
+                profiles[ticker] = profile
+
+        with self.metrics.timer('profile_write'):
+            errors = self.storage.update_companies(profiles, chunk_size)
+        self.metrics.count('profiles_written', len(profiles) - len(errors))
+        for ticker in profiles:
+            if ticker in errors:
+                logging.error('Cannot update {0} profile: {1}'.format(ticker, errors[ticker]))
+            else:
+                logging.info('{0} profile updated'.format(ticker))
+            results[ticker] = errors.get(ticker)
+        return results
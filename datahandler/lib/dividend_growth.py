@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+'''Vectorized dividend growth analytics over the dividend events of every ticker at once.
+
+The events are held as one ragged array set: the dates and amounts of all tickers concatenated
+in (ticker, date) order plus the start offset of each ticker. Every metric is then a handful of
+numpy operations over the whole universe. Lookups such as "last payment on or before a date" are
+binary searches on a combined (ticker, date) key.'''
+
+from datetime import datetime, timedelta
+import numpy as np
+
+
+CAGR_YEARS = (1, 3, 5, 10)
+# Upper bounds of the median gap between payments (days) for monthly, quarterly and semiannual payers
+FREQUENCY_GAPS = (45, 120, 240)
+FREQUENCIES = (12, 4, 2, 1)
+# Only recent payments decide the current schedule
+FREQUENCY_LOOKBACK = 3 * 365
+YEAR = 365
+# Relative change below which two payment levels count as equal
+TOLERANCE = 1e-4
+
+
+def to_ragged(dividends):
+    '''(tickers, dates, amounts, starts) from an iterable of (ticker, dividend entries):
+    int64 day numbers and float amounts of all tickers in (ticker, date) order and the offset
+    of each ticker's first event. Tickers without a positive dividend are left out.'''
+    tickers, dates, amounts = [], [], []
+    for ticker, entries in dividends:
+        ticker_dates = np.array([item['date'] for item in entries], dtype='datetime64[D]').astype(np.int64)
+        ticker_amounts = np.array([item['dividend'] for item in entries], dtype=float)
+        valid = np.isfinite(ticker_amounts) & (ticker_amounts > 0)
+        if not valid.any():
+            continue
+        order = np.argsort(ticker_dates[valid], kind='mergesort')
+        tickers.append(ticker)
+        dates.append(ticker_dates[valid][order])
+        amounts.append(ticker_amounts[valid][order])
+    counts = np.array([len(ticker_dates) for ticker_dates in dates], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    if not tickers:
+        return ([], np.empty(0, dtype=np.int64), np.empty(0), starts[:0])
+    return (tickers, np.concatenate(dates), np.concatenate(amounts), starts)
+
+
+class _Positions:
+    '''Binary search of "index of the last event on or before a day" for many (ticker, day) pairs'''
+    def __init__(self, group, dates, last_day):
+        self.base = int(dates.min())
+        self.span = max(int(dates.max()), last_day) - self.base + 2
+        self.keys = group * self.span + (dates - self.base)
+
+    def last(self, groups, days):
+        '''Index of the last event of each group on or before the day, start - 1 if there is none'''
+        offsets = np.clip(days - self.base, -1, self.span - 1)
+        return np.searchsorted(self.keys, groups * self.span + offsets, side='right') - 1
+
+
+def _group_medians(values, groups, count):
+    '''Median of values by group id (NaN for groups without values)'''
+    order = np.lexsort((values, groups))
+    values, groups = values[order], groups[order]
+    counts = np.bincount(groups, minlength=count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = np.full(count, np.nan)
+    present = counts > 0
+    low = starts[present] + (counts[present] - 1) // 2
+    high = starts[present] + counts[present] // 2
+    medians[present] = (values[low] + values[high]) / 2
+    return medians
+
+
+def _raise_streaks(group, dates, amounts, count, as_of):
+    '''Consecutive calendar years, up to last year, in which the mean payment rose above the previous
+    year's (plus this year, if it already shows a raise). Means rather than totals, so payments that
+    slip over the new year do not look like cuts.'''
+    years = dates.astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970
+    keys = group * 10000 + years
+    unique_keys, first, per_year = np.unique(keys, return_index=True, return_counts=True)
+    means = np.add.reduceat(amounts, first) / per_year
+    year_group, year = unique_keys // 10000, unique_keys % 10000
+
+    complete = year < as_of.year
+    c_group, c_year, c_mean = year_group[complete], year[complete], means[complete]
+    raised = np.zeros(len(c_group), dtype=bool)
+    raised[1:] = ((c_group[1:] == c_group[:-1]) & (c_year[1:] == c_year[:-1] + 1) &
+                  (c_mean[1:] > c_mean[:-1] * (1 + TOLERANCE)))
+    index = np.arange(len(raised))
+    last_break = np.maximum.accumulate(np.where(raised, 0, index)) if len(raised) else index
+    runs = index - last_break
+
+    groups = np.arange(count)
+    streaks = np.zeros(count, dtype=np.int64)
+    last_complete = np.searchsorted(c_group, groups, side='right') - 1
+    has_last = (last_complete >= 0)
+    has_last[has_last] &= (c_group[last_complete[has_last]] == groups[has_last]) & \
+        (c_year[last_complete[has_last]] == as_of.year - 1)
+    streaks[has_last] = runs[last_complete[has_last]]
+
+    # This year's payments so far, compared with last year
+    current = ~complete
+    cur_group, cur_mean = year_group[current], means[current]
+    previous = np.full(count, np.nan)
+    previous[groups[has_last]] = c_mean[last_complete[has_last]]
+    prev_mean = previous[cur_group]
+    streaks[cur_group[cur_mean > prev_mean * (1 + TOLERANCE)]] += 1
+    streaks[cur_group[cur_mean < prev_mean * (1 - TOLERANCE)]] = 0
+    return streaks
+
+
+def growth_metrics(tickers, dates, amounts, starts, as_of=None):
+    '''Dividend metrics of every ticker as of a date (today by default), by ticker:
+        frequency       payments per year inferred from the median gap of the last 3 years
+        lastPayment     date and amount of the latest dividend, forwardAnnual = lastAmount * frequency
+        ttm             sum of dividends paid in the trailing twelve months
+        cagr<n>y        compound annual growth (%) of the annualized dividend (last `frequency`
+                        payments) over n years, None where either end has no complete year of payments
+        raiseStreak     consecutive years with a dividend raise (within the stored history)'''
+    as_of = as_of or datetime.today()
+    count = len(tickers)
+    if count == 0:
+        return {}
+    today = int(np.datetime64(as_of, 'D').astype(np.int64))
+    ends = np.append(starts[1:], len(dates))
+    group = np.repeat(np.arange(count), ends - starts)
+    positions = _Positions(group, dates, today)
+    cumulative = np.concatenate(([0.0], np.cumsum(amounts)))
+    groups = np.arange(count)
+
+    # Payment frequency from the recent gaps
+    gaps = np.diff(dates).astype(float)
+    recent = (group[1:] == group[:-1]) & (dates[1:] > dates[ends - 1][group[1:]] - FREQUENCY_LOOKBACK)
+    median_gap = _group_medians(gaps[recent], group[1:][recent], count)
+    median_gap[np.isnan(median_gap)] = np.inf
+    frequency = np.array(FREQUENCIES)[np.searchsorted(FREQUENCY_GAPS, median_gap, side='left')]
+
+    # Trailing twelve months
+    last_today = positions.last(groups, np.full(count, today))
+    ttm = cumulative[last_today + 1] - cumulative[positions.last(groups, np.full(count, today - YEAR)) + 1]
+
+    def annualized(days):
+        '''Sum of the last `frequency` payments on or before the days, NaN if they span more than a year'''
+        last = positions.last(groups, days)
+        first = last - frequency + 1
+        slack = YEAR // frequency // 2
+        valid = first >= starts
+        valid[valid] &= dates[first[valid]] > days[valid] - YEAR - slack[valid]
+        totals = np.full(count, np.nan)
+        totals[valid] = cumulative[last[valid] + 1] - cumulative[first[valid]]
+        return totals
+
+    current = annualized(np.full(count, today))
+    cagrs = {}
+    for years in CAGR_YEARS:
+        past = annualized(np.full(count, today - int(round(365.25 * years))))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cagrs[years] = ((current / past) ** (1.0 / years) - 1) * 100
+
+    streaks = _raise_streaks(group, dates, amounts, count, as_of)
+
+    def number(value):
+        return float(value) if np.isfinite(value) else None
+
+    metrics = {}
+    for g, ticker in enumerate(tickers):
+        last = ends[g] - 1
+        metrics[ticker] = {
+            'frequency': int(frequency[g]),
+            'lastPayment': datetime(1970, 1, 1) + timedelta(days=int(dates[last])),
+            'lastAmount': float(amounts[last]),
+            'forwardAnnual': float(amounts[last] * frequency[g]),
+            'ttm': float(ttm[g]),
+            'raiseStreak': int(streaks[g]),
+            'asOf': as_of
+        }
+        for years in CAGR_YEARS:
+            metrics[ticker]['cagr{0}y'.format(years)] = number(cagrs[years][g])
+    return metrics
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+'''Storage layouts for price and dividend history in the aristocrats database'''
+
+from datetime import datetime
+from itertools import groupby
+import logging
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from lib import yield_stats
+
+
+WATERMARK_PRICE_FIELDS = ('date', 'adjClose', 'lastDivAnnual', 'divYield')
+
+
+class HistoryStore:
+    '''Original layout: one document per ticker with ever-growing price and dividend arrays'''
+    layout = 'single'
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.history
+
+    def ensure_indexes(self):
+        self.collection.create_index([('ticker', ASCENDING)])
+        self.db.watermarks.create_index([('ticker', ASCENDING)], unique=True)
+
+    def get_watermark(self, ticker):
+        '''Return the watermark record of the ticker (last price date, latest price snapshot,
+        last dividend date) or None if it has not been written yet'''
+        return self.db.watermarks.find_one({'ticker': ticker}, projection={'_id': 0})
+
+    def get_last_price(self, ticker):
+        '''Return the latest price snapshot of the ticker or None if there is no price data'''
+        watermark = self.get_watermark(ticker)
+        if watermark and watermark.get('latestPrice'):
+            return watermark['latestPrice']
+        # History written before watermarks existed, build the record once from the full series
+        watermark = self.rebuild_watermark(ticker)
+        return watermark['latestPrice'] if watermark else None
+
+    def get_last_date(self, ticker):
+        '''Date of the last stored price entry, where incremental downloads resume, or None if there is none.
+        It is read from the history, which records it in the same write as the entries, so an append that
+        was interrupted before its watermark update is not downloaded and stored again; the lagging
+        watermark is rebuilt.'''
+        last_date = self._stored_last_date(ticker)
+        if last_date is not None:
+            watermark = self.get_watermark(ticker)
+            if watermark is None or watermark.get('lastPriceDate') is None or watermark['lastPriceDate'] < last_date:
+                logging.warning('Watermark of {0} is behind its history, rebuilding it'.format(ticker))
+                self.rebuild_watermark(ticker)
+        return last_date
+
+    def _stored_last_date(self, ticker):
+        document = self.collection.find_one({'ticker': ticker}, projection={'_id': 0, 'lastPriceDate': 1})
+        if document is None:
+            return None
+        if 'lastPriceDate' not in document:
+            # Written before the history recorded it, the watermark (or a scan) has it
+            last_price = self.get_last_price(ticker)
+            return last_price['date'] if last_price else None
+        return document['lastPriceDate']
+
+    def get_last_prices(self, tickers):
+        '''Return the latest price snapshots of several tickers by ticker, reading watermarks in one query'''
+        latest = {
+            watermark['ticker']: watermark['latestPrice']
+            for watermark in self.db.watermarks.find(
+                {'ticker': {'$in': tickers}, 'latestPrice': {'$ne': None}},
+                projection={'_id': 0, 'ticker': 1, 'latestPrice': 1})
+        }
+        for ticker in tickers:
+            if ticker not in latest:
+                last_price = self.get_last_price(ticker)
+                if last_price is not None:
+                    latest[ticker] = last_price
+        return latest
+
+    def _update_watermark(self, ticker, price_data, dividend_data):
+        '''Advance the watermark record with newly appended entries, never moving it backwards'''
+        if dividend_data:
+            last_dividend = max(item['date'] for item in dividend_data)
+            self.db.watermarks.update_one(
+                {'ticker': ticker},
+                {'$max': {'lastDividendDate': last_dividend}},
+                upsert=True)
+        if price_data:
+            latest = max(price_data, key=lambda item: item['date'])
+            try:
+                self.db.watermarks.update_one(
+                    {'ticker': ticker, '$or': [
+                        {'lastPriceDate': None},
+                        {'lastPriceDate': {'$lt': latest['date']}}
+                    ]},
+                    {'$set': {
+                        'lastPriceDate': latest['date'],
+                        'latestPrice': {field: latest.get(field) for field in WATERMARK_PRICE_FIELDS}
+                    }},
+                    upsert=True)
+            except DuplicateKeyError:
+                # Watermark already holds a later date
+                pass
+
+    def rebuild_watermark(self, ticker):
+        '''Recompute the watermark record of the ticker from the stored history'''
+        last_price = self._scan_last_entry(ticker, 'price')
+        last_dividend = self._scan_last_entry(ticker, 'dividend')
+        if last_price is None and last_dividend is None:
+            return None
+        watermark = {
+            'ticker': ticker,
+            'lastPriceDate': last_price['date'] if last_price else None,
+            'latestPrice': {field: last_price.get(field) for field in WATERMARK_PRICE_FIELDS} if last_price else None,
+            'lastDividendDate': last_dividend['date'] if last_dividend else None
+        }
+        self.db.watermarks.replace_one({'ticker': ticker}, watermark, upsert=True)
+        return watermark
+
+    def _scan_last_entry(self, ticker, data_type):
+        '''Find the latest price or dividend entry by scanning the whole series'''
+        agg = self.collection.aggregate([
+            {'$match': {'ticker': ticker}},
+            {'$project': {'_id': 0, data_type: 1}},
+            {'$unwind': '$' + data_type},
+            {'$sort': {data_type + '.date': -1}},
+            {'$limit': 1}
+        ])
+        items = list(agg)
+        return items[0][data_type] if items else None
+
+    def get_history(self, ticker, data_type='price', start_date=None):
+        '''Return price or dividend entries of the ticker from start_date on'''
+        document = self.collection.find_one({'ticker': ticker}, projection={'_id': 0, data_type: 1})
+        if document is None:
+            return []
+        items = document.get(data_type, [])
+        if start_date is not None:
+            items = [item for item in items if item['date'] >= start_date]
+        return items
+
+    def get_histories(self, tickers, data_type='price', start_date=None):
+        '''Return price or dividend entries from start_date on of several tickers by ticker, read in one query'''
+        histories = {ticker: [] for ticker in tickers}
+        for document in self.collection.find({'ticker': {'$in': tickers}}, projection={'_id': 0, 'ticker': 1, data_type: 1}):
+            items = document.get(data_type, [])
+            if start_date is not None:
+                items = [item for item in items if item['date'] >= start_date]
+            histories[document['ticker']] = items
+        return histories
+
+    def yield_statistics(self, ticker, last_price, windows=yield_stats.WINDOWS):
+        '''Yield statistics of the trailing windows ending at the latest price (see yield_stats.window_statistics),
+        computed from the price entries read back from the database. None if there is no price history.'''
+        max_date = last_price['date']
+        history = self.get_history(ticker, 'price', max_date.replace(year=max_date.year - max(windows)))
+        if not history:
+            return None
+        dates, yields = yield_stats.to_arrays(history)
+        return yield_stats.window_statistics(dates, yields, windows)
+
+    def append(self, ticker, price_data, dividend_data):
+        '''Add new price and dividend entries to the ticker history'''
+        update = {
+            '$setOnInsert': {
+                'ticker': ticker
+            },
+            '$push': {
+                'price': {'$each': price_data},
+                'dividend': {'$each': dividend_data}
+            },
+            '$set': {'lastUpdated': datetime.today()}
+        }
+        if price_data:
+            # Atomic with the entries, unlike the watermark record (see get_last_date)
+            update['$max'] = {'lastPriceDate': max(item['date'] for item in price_data)}
+        self.collection.update_one({'ticker': ticker}, update, upsert=True)
+        self._update_watermark(ticker, price_data, dividend_data)
+
+    def delete(self, ticker):
+        '''Remove the whole history and the watermark of the ticker'''
+        self.collection.delete_many({'ticker': ticker})
+        self.db.watermarks.delete_one({'ticker': ticker})
+
+    def tickers(self):
+        return self.collection.distinct('ticker')
+
+    def iter_tickers(self):
+        '''Yield (ticker, price entries, dividend entries) for every stored ticker'''
+        for document in self.collection.find(projection={'_id': 0}):
+            yield (document['ticker'], document.get('price', []), document.get('dividend', []))
+
+    def iter_dividends(self):
+        '''Yield (ticker, dividend entries) for every stored ticker, without reading prices'''
+        for document in self.collection.find(projection={'_id': 0, 'ticker': 1, 'dividend': 1}):
+            yield (document['ticker'], document.get('dividend', []))
+
+
+class BucketedHistoryStore(HistoryStore):
+    '''Bucketed layout: one document per ticker and calendar year with a min/max date header,
+    so range reads and appends only touch the buckets they need'''
+    layout = 'bucketed'
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.history_buckets
+
+    def ensure_indexes(self):
+        self.collection.create_index([('ticker', ASCENDING), ('year', ASCENDING)], unique=True)
+        self.collection.create_index([('ticker', ASCENDING), ('maxDate', DESCENDING)])
+        self.db.watermarks.create_index([('ticker', ASCENDING)], unique=True)
+
+    def _scan_last_entry(self, ticker, data_type):
+        bucket = self.collection.find_one(
+            {'ticker': ticker, data_type + '.0': {'$exists': True}},
+            projection={'_id': 0, data_type: 1},
+            sort=[('year', DESCENDING)])
+        if bucket is None:
+            return None
+        return max(bucket[data_type], key=lambda item: item['date'])
+
+    def _stored_last_date(self, ticker):
+        # Every dividend entry has a price entry on the same day, so maxDate is the last price date
+        bucket = self.collection.find_one(
+            {'ticker': ticker, 'price.0': {'$exists': True}},
+            projection={'_id': 0, 'maxDate': 1},
+            sort=[('year', DESCENDING)])
+        return bucket['maxDate'] if bucket else None
+
+    def get_history(self, ticker, data_type='price', start_date=None):
+        query = {'ticker': ticker}
+        if start_date is not None:
+            query['maxDate'] = {'$gte': start_date}
+        buckets = self.collection.find(query, projection={'_id': 0, data_type: 1}, sort=[('year', ASCENDING)])
+        items = [item for bucket in buckets for item in bucket.get(data_type, [])]
+        if start_date is not None:
+            items = [item for item in items if item['date'] >= start_date]
+        return items
+
+    def get_histories(self, tickers, data_type='price', start_date=None):
+        query = {'ticker': {'$in': tickers}}
+        if start_date is not None:
+            query['maxDate'] = {'$gte': start_date}
+        buckets = self.collection.find(
+            query, projection={'_id': 0, 'ticker': 1, data_type: 1}, sort=[('ticker', ASCENDING), ('year', ASCENDING)])
+        histories = {ticker: [] for ticker in tickers}
+        for ticker, group in groupby(buckets, key=lambda bucket: bucket['ticker']):
+            items = [item for bucket in group for item in bucket.get(data_type, [])]
+            if start_date is not None:
+                items = [item for item in items if item['date'] >= start_date]
+            histories[ticker] = items
+        return histories
+
+    def append(self, ticker, price_data, dividend_data):
+        entries = [('price', item) for item in price_data] + [('dividend', item) for item in dividend_data]
+        entries.sort(key=lambda entry: entry[1]['date'].year)
+        operations = []
+        for year, group in groupby(entries, key=lambda entry: entry[1]['date'].year):
+            group = list(group)
+            dates = [item['date'] for _, item in group]
+            operations.append(UpdateOne(
+                {'ticker': ticker, 'year': year},
+                {'$push': {
+                    'price': {'$each': [item for data_type, item in group if data_type == 'price']},
+                    'dividend': {'$each': [item for data_type, item in group if data_type == 'dividend']}
+                },
+                '$min': {'minDate': min(dates)},
+                '$max': {'maxDate': max(dates)},
+                '$set': {'lastUpdated': datetime.today()}
+                },
+                upsert=True))
+        if operations:
+            # In year order, so a failed write leaves only older buckets written and maxDate stays a resume point
+            self.collection.bulk_write(operations, ordered=True)
+            self._update_watermark(ticker, price_data, dividend_data)
+
+    def iter_tickers(self):
+        for ticker in self.tickers():
+            yield (ticker, self.get_history(ticker, 'price'), self.get_history(ticker, 'dividend'))
+
+    def iter_dividends(self):
+        buckets = self.collection.find(
+            {'dividend.0': {'$exists': True}},
+            projection={'_id': 0, 'ticker': 1, 'dividend': 1},
+            sort=[('ticker', ASCENDING), ('year', ASCENDING)])
+        for ticker, group in groupby(buckets, key=lambda bucket: bucket['ticker']):
+            yield (ticker, [item for bucket in group for item in bucket['dividend']])
+
+
+LAYOUTS = {
+    HistoryStore.layout: HistoryStore,
+    BucketedHistoryStore.layout: BucketedHistoryStore
+}
+
+
+def get_history_store(db):
+    '''Return the history store for the layout recorded in the meta collection'''
+    setting = db.meta.find_one({'_id': 'historyLayout'}) or {}
+    return LAYOUTS[setting.get('layout', HistoryStore.layout)](db)
+
+
+def migrate_history(db, layout=BucketedHistoryStore.layout):
+    '''Copy every ticker history into the given layout and make it the active one.
+    The source collection is left in place so the migration can be rolled back.'''
+    source = get_history_store(db)
+    if source.layout == layout:
+        logging.info('History is already stored in {0} layout'.format(layout))
+        return 0
+    target = LAYOUTS[layout](db)
+    target.ensure_indexes()
+    count = 0
+    for ticker, price_data, dividend_data in source.iter_tickers():
+        # Start from scratch so an interrupted migration can simply be run again
+        target.collection.delete_many({'ticker': ticker})
+        target.append(ticker, price_data, dividend_data)
+        count += 1
+        logging.info('Migrated {0} history to {1} layout'.format(ticker, layout))
+    db.meta.update_one({'_id': 'historyLayout'}, {'$set': {'layout': layout}}, upsert=True)
+    return count
+
+
+def repair_watermarks(db):
+    '''Rebuild the watermark record of every ticker from the stored history'''
+    store = get_history_store(db)
+    store.ensure_indexes()
+    count = 0
+    for ticker in store.tickers():
+        if store.rebuild_watermark(ticker) is not None:
+            count += 1
+            logging.info('Rebuilt watermark for {0}'.format(ticker))
+    return count
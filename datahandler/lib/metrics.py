@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+'''Per-run stage timings and counters of the data pipeline, exported as JSON or Prometheus text'''
+
+from datetime import datetime
+import json
+import os
+import threading
+import time
+
+
+# Upper bounds in seconds of the stage latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    '''Cumulative-bucket latency histogram with count, sum and max'''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def cumulative(self):
+        '''(upper bound, observations <= bound) pairs, ending with +Inf'''
+        total, pairs = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            pairs.append((str(bound), total))
+        pairs.append(('+Inf', self.count))
+        return pairs
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q-th quantile, an estimate good to one bucket'''
+        rank = q * self.count
+        for bound, total in self.cumulative()[:-1]:
+            if total >= rank:
+                return float(bound)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'totalSeconds': self.sum,
+            'meanSeconds': self.sum / self.count if self.count else None,
+            'maxSeconds': self.max,
+            'p50Seconds': self.quantile(0.5),
+            'p90Seconds': self.quantile(0.9),
+            'p99Seconds': self.quantile(0.99)
+        }
+
+
+class _Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    '''Thread-safe stage timers and counters for one pipeline run.
+    When disabled every call returns immediately without recording anything.'''
+    def __init__(self, enabled=True, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.started = datetime.today()
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+
+    def timer(self, stage):
+        '''Context manager that records the duration of the block under the stage name'''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram(self.buckets)
+            self.stages[stage].observe(seconds)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        '''Stage timings and counters of the run as a JSON-serializable dict'''
+        with self._lock:
+            return {
+                'started': self.started.isoformat(),
+                'finished': datetime.today().isoformat(),
+                'stages': {stage: histogram.summary() for stage, histogram in sorted(self.stages.items())},
+                'counters': dict(sorted(self.counters.items()))
+            }
+
+    def to_prometheus(self, prefix='dividend_pipeline'):
+        '''Prometheus text exposition of the stage histograms and counters'''
+        lines = []
+        with self._lock:
+            if self.stages:
+                lines += ['# HELP {0}_stage_seconds Duration of pipeline stages'.format(prefix),
+                          '# TYPE {0}_stage_seconds histogram'.format(prefix)]
+            for stage, histogram in sorted(self.stages.items()):
+                for bound, total in histogram.cumulative():
+                    lines.append('{0}_stage_seconds_bucket{{stage="{1}",le="{2}"}} {3}'.format(prefix, stage, bound, total))
+                lines.append('{0}_stage_seconds_sum{{stage="{1}"}} {2}'.format(prefix, stage, histogram.sum))
+                lines.append('{0}_stage_seconds_count{{stage="{1}"}} {2}'.format(prefix, stage, histogram.count))
+            for name, value in sorted(self.counters.items()):
+                lines += ['# TYPE {0}_{1}_total counter'.format(prefix, name),
+                          '{0}_{1}_total {2}'.format(prefix, name, value)]
+        lines.append('# TYPE {0}_last_run_timestamp_seconds gauge'.format(prefix))
+        lines.append('{0}_last_run_timestamp_seconds {1}'.format(prefix, time.time()))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path):
+        '''Write the text format for the node_exporter textfile collector, replacing the file atomically'''
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
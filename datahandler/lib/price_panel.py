@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+'''Local memory-mapped panel of daily adjClose, divYield and dividend values (trading days x tickers)
+
+Layout of the panel directory:
+    meta.json               tickers (column order), day count, column capacity, generation, last stored date per ticker
+    gen-<n>/dates.bin       datetime64[D] row labels, ascending
+    gen-<n>/<field>.bin     float64 matrix of shape (days, capacity), row-major, NaN where there is no value
+
+New trading days are appended to the end of the files in place. Only inserting days before the
+last stored one or running out of ticker columns rewrites the panel into a new generation, which
+is published by replacing meta.json, so readers never see a half-written layout.'''
+
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import shutil
+import threading
+import numpy as np
+
+
+FIELDS = ('adjClose', 'divYield', 'dividend')
+ITEM_SIZE = np.dtype('float64').itemsize
+
+
+class PricePanel:
+    def __init__(self, path='panel'):
+        self.path = path
+        self._lock = threading.Lock()
+        self.meta = self._load_meta()
+
+    def _load_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'generation': 0, 'days': 0, 'capacity': 0, 'tickers': [], 'lastDates': {}}
+
+    def _save_meta(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+    def _file(self, name, generation=None):
+        generation = self.meta['generation'] if generation is None else generation
+        return os.path.join(self.path, 'gen-{0}'.format(generation), name + '.bin')
+
+    def reload(self):
+        self.meta = self._load_meta()
+
+    # Readers
+
+    @property
+    def tickers(self):
+        return self.meta['tickers']
+
+    def dates(self):
+        if self.meta['days'] == 0:
+            return np.empty(0, dtype='datetime64[D]')
+        return np.memmap(self._file('dates'), dtype='datetime64[D]', mode='r', shape=(self.meta['days'],))
+
+    def field(self, name):
+        '''Read-only (days, tickers) view of one field'''
+        if self.meta['days'] == 0:
+            return np.empty((0, len(self.tickers)))
+        matrix = np.memmap(self._file(name), dtype='float64', mode='r', shape=(self.meta['days'], self.meta['capacity']))
+        return matrix[:, :len(self.tickers)]
+
+    def _rows(self, start=None, end=None):
+        dates = self.dates()
+        lo = 0 if start is None else np.searchsorted(dates, np.datetime64(start, 'D'), side='left')
+        hi = len(dates) if end is None else np.searchsorted(dates, np.datetime64(end, 'D'), side='right')
+        return (dates, lo, hi)
+
+    def slice(self, ticker, start=None, end=None, fields=FIELDS):
+        '''Dates and field columns of one ticker between start and end (inclusive), as views without copies'''
+        column = self.tickers.index(ticker)
+        dates, lo, hi = self._rows(start, end)
+        data = {'date': dates[lo:hi]}
+        for name in fields:
+            data[name] = self.field(name)[lo:hi, column]
+        return data
+
+    def cross_section(self, name, start=None, end=None):
+        '''Dates and the (days, tickers) matrix of one field for every ticker between start and end'''
+        dates, lo, hi = self._rows(start, end)
+        return (dates[lo:hi], self.field(name)[lo:hi])
+
+    # Writers
+
+    def _rewrite(self, dates, capacity):
+        '''Copy the panel into a new generation with the given row dates and column capacity'''
+        old_dates = self.dates()
+        generation = self.meta['generation'] + 1
+        os.makedirs(os.path.dirname(self._file('dates', generation)), exist_ok=True)
+        dates.astype('datetime64[D]').tofile(self._file('dates', generation))
+        rows = np.searchsorted(dates, old_dates)
+        for name in FIELDS:
+            matrix = np.memmap(self._file(name, generation), dtype='float64', mode='w+', shape=(len(dates), capacity))
+            matrix[:] = np.nan
+            if len(old_dates):
+                matrix[rows, :len(self.tickers)] = self.field(name)
+            matrix.flush()
+            del matrix
+        old_directory = os.path.dirname(self._file('dates'))
+        self.meta.update({'generation': generation, 'days': len(dates), 'capacity': capacity})
+        self._save_meta()
+        shutil.rmtree(old_directory, ignore_errors=True)
+        logging.info('Price panel rewritten: {0} days x {1} columns'.format(len(dates), capacity))
+
+    def _append_days(self, new_dates):
+        '''Extend the files of the current generation with rows for new, later trading days'''
+        days, capacity = self.meta['days'], self.meta['capacity']
+        with open(self._file('dates'), 'r+b') as f:
+            f.seek(days * new_dates.itemsize)
+            new_dates.astype('datetime64[D]').tofile(f)
+            f.truncate()
+        block = np.full((len(new_dates), capacity), np.nan).tobytes()
+        for name in FIELDS:
+            with open(self._file(name), 'r+b') as f:
+                # Anything past the recorded size is left over from an interrupted write
+                f.seek(days * capacity * ITEM_SIZE)
+                f.write(block)
+                f.truncate()
+        self.meta['days'] = days + len(new_dates)
+
+    def _ensure_layout(self, ticker, entry_dates):
+        '''Make sure the ticker has a column and every entry date has a row'''
+        dates = np.asarray(self.dates())
+        missing = np.setdiff1d(entry_dates, dates)
+        capacity = self.meta['capacity']
+        if ticker not in self.tickers and len(self.tickers) >= capacity:
+            capacity = max(64, capacity * 2)
+        if capacity != self.meta['capacity'] or (len(missing) and len(dates) and missing[0] <= dates[-1]):
+            self._rewrite(np.union1d(dates, missing), capacity)
+        elif len(missing):
+            self._append_days(missing)
+        if ticker not in self.tickers:
+            self.tickers.append(ticker)
+
+    def write(self, ticker, price_data, dividend_data):
+        '''Store price and dividend entries of the ticker in the panel'''
+        if not price_data and not dividend_data:
+            return
+        with self._lock:
+            price_dates = np.array([item['date'] for item in price_data], dtype='datetime64[D]')
+            dividend_dates = np.array([item['date'] for item in dividend_data], dtype='datetime64[D]')
+            entry_dates = np.union1d(price_dates, dividend_dates)
+            self._ensure_layout(ticker, entry_dates)
+
+            dates = self.dates()
+            column = self.tickers.index(ticker)
+            shape = (self.meta['days'], self.meta['capacity'])
+            updates = [
+                ('adjClose', price_dates, [item['adjClose'] for item in price_data]),
+                ('divYield', price_dates, [item['divYield'] for item in price_data]),
+                ('dividend', dividend_dates, [item['dividend'] for item in dividend_data])
+            ]
+            for name, field_dates, values in updates:
+                if len(field_dates) == 0:
+                    continue
+                matrix = np.memmap(self._file(name), dtype='float64', mode='r+', shape=shape)
+                matrix[np.searchsorted(dates, field_dates), column] = np.array(values, dtype=float)
+                matrix.flush()
+                del matrix
+
+            last_date = str(entry_dates[-1])
+            if last_date > self.meta['lastDates'].get(ticker, ''):
+                self.meta['lastDates'][ticker] = last_date
+            self._save_meta()
+
+    def build(self, store, tickers):
+        '''Recreate the panel from scratch with the full stored history of the tickers'''
+        histories = {ticker: (store.get_history(ticker, 'price'), store.get_history(ticker, 'dividend')) for ticker in tickers}
+        dates = np.unique(np.array(
+            [item['date'] for price_data, dividend_data in histories.values() for item in price_data + dividend_data],
+            dtype='datetime64[D]'))
+        capacity = 64
+        while capacity < len(tickers):
+            capacity *= 2
+        with self._lock:
+            self.meta.update({'days': 0, 'tickers': [], 'lastDates': {}})
+            self._rewrite(dates, capacity)
+        for ticker, (price_data, dividend_data) in histories.items():
+            self.write(ticker, price_data, dividend_data)
+
+    def refresh(self, store, tickers):
+        '''Append entries stored after the last date already in the panel, for each ticker'''
+        for ticker in tickers:
+            last_date = self.meta['lastDates'].get(ticker)
+            start_date = datetime.strptime(last_date, '%Y-%m-%d') + timedelta(days=1) if last_date else None
+            try:
+                price_data = store.get_history(ticker, 'price', start_date)
+                dividend_data = store.get_history(ticker, 'dividend', start_date)
+                self.write(ticker, price_data, dividend_data)
+            except Exception as e:
+                logging.error('Cannot refresh {0} in price panel: {1}'.format(ticker, e))
+            else:
+                logging.debug('{0} price panel updated with {1} values'.format(ticker, len(price_data) + len(dividend_data)))
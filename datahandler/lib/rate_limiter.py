@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+'''Thread-safe request rate limiter shared by concurrent downloads'''
+
+import threading
+import time
+
+
+class RateLimiter:
+    '''Space out calls so that no more than `rate` calls start per second across all threads'''
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError('Rate limit must be positive')
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self):
+        '''Block until the caller is allowed to make its request'''
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
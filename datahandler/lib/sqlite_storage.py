@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+
+'''Embedded SQLite backend: company documents as JSON, price and dividend history in
+(ticker, date) clustered tables, so range reads are index scans and latest-value lookups
+and yield statistics are answered by SQL without loading whole series'''
+
+from datetime import datetime, timedelta
+from itertools import groupby
+import json
+import math
+import sqlite3
+import threading
+import numpy as np
+from lib import yield_stats
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS companies (
+    ticker TEXT PRIMARY KEY,
+    document TEXT NOT NULL,
+    lastUpdated TEXT,
+    downloaded TEXT,
+    growthUpdated TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    document TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS price (
+    ticker TEXT NOT NULL,
+    date TEXT NOT NULL,
+    adjClose REAL,
+    lastDivAnnual REAL,
+    divYield REAL,
+    PRIMARY KEY (ticker, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dividend (
+    ticker TEXT NOT NULL,
+    date TEXT NOT NULL,
+    dividend REAL,
+    PRIMARY KEY (ticker, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS jobs (
+    ticker TEXT PRIMARY KEY,
+    lastAttempt TEXT,
+    lastSuccess TEXT,
+    failures INTEGER NOT NULL DEFAULT 0,
+    nextEligible TEXT,
+    lastError TEXT,
+    leaseOwner TEXT,
+    leaseExpires TEXT
+);
+'''
+
+DATE_FORMAT = '%Y-%m-%d'
+STAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# Positive and finite, as in yield_stats.to_arrays
+VALID_YIELD = 'divYield > 0 AND divYield < 1e308'
+
+
+def to_date(value):
+    return value.strftime(DATE_FORMAT)
+
+
+def from_date(value):
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'$date': value.strftime(STAMP_FORMAT)}
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
+
+
+def _decode(document):
+    if len(document) == 1 and '$date' in document:
+        return datetime.strptime(document['$date'], STAMP_FORMAT)
+    return document
+
+
+def dumps(document):
+    return json.dumps(document, default=_encode)
+
+
+def loads(text):
+    return json.loads(text, object_hook=_decode)
+
+
+def _stamp(value):
+    return value.strftime(STAMP_FORMAT) if isinstance(value, datetime) else None
+
+
+class SQLiteStorage:
+    '''Company list, pipeline state, job states and history in one SQLite file, with a connection per thread'''
+    backend = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.history = SQLiteHistoryStore(self)
+        self.jobs = SQLiteJobStore(self)
+        self.ensure_indexes()
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            # Readers (e.g. the dataserver) are not blocked while the pipeline writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def ensure_indexes(self):
+        connection = self.connection()
+        connection.executescript(SCHEMA)
+        if 'growthUpdated' not in [row[1] for row in connection.execute('PRAGMA table_info(companies)')]:
+            # Files created before the dividend growth stamp was part of the data version
+            connection.execute('ALTER TABLE companies ADD COLUMN growthUpdated TEXT')
+
+    # Company list
+
+    def get_companies(self):
+        return [loads(document) for document, in self.connection().execute('SELECT document FROM companies')]
+
+    def get_company(self, ticker, fields=None):
+        row = self.connection().execute('SELECT document FROM companies WHERE ticker = ?', (ticker,)).fetchone()
+        if row is None:
+            return None
+        company = loads(row[0])
+        return {field: company[field] for field in fields if field in company} if fields else company
+
+    def get_companies_by_ticker(self, tickers, fields=None):
+        companies = {}
+        for start in range(0, len(tickers), 500):
+            chunk = tickers[start:start + 500]
+            rows = self.connection().execute(
+                'SELECT ticker, document FROM companies WHERE ticker IN ({0})'.format(','.join('?' * len(chunk))), chunk)
+            for ticker, document in rows:
+                company = loads(document)
+                if fields:
+                    company = dict({field: company[field] for field in fields if field in company}, ticker=ticker)
+                companies[ticker] = company
+        return companies
+
+    def update_company(self, ticker, fields):
+        self.update_companies({ticker: fields})
+
+    def update_companies(self, updates, chunk_size=500, upsert=False):
+        '''Merge fields into the company documents in transactions of chunk_size companies,
+        returning a dict of error messages by ticker for the chunks that failed'''
+        errors = {}
+        items = list(updates.items())
+        connection = self.connection()
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            chunk_errors = {}
+            try:
+                with connection:
+                    for ticker, fields in chunk:
+                        row = connection.execute('SELECT document FROM companies WHERE ticker = ?', (ticker,)).fetchone()
+                        if row is None and not upsert:
+                            continue
+                        company = loads(row[0]) if row else {'ticker': ticker}
+                        company.update(fields)
+                        try:
+                            document = dumps(company)
+                        except (TypeError, ValueError) as e:
+                            # Only this company fails, as a single write error does on MongoDB
+                            chunk_errors[ticker] = str(e)
+                            continue
+                        connection.execute(
+                            'INSERT OR REPLACE INTO companies (ticker, document, lastUpdated, downloaded, growthUpdated) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (ticker, document, _stamp(company.get('lastUpdated')), _stamp(company.get('downloaded')),
+                             _stamp(company.get('growthUpdated'))))
+            except sqlite3.Error as e:
+                chunk_errors = {ticker: str(e) for ticker, _ in chunk}
+            errors.update(chunk_errors)
+        return errors
+
+    def remove_companies(self, tickers, chunk_size=500):
+        errors = {}
+        connection = self.connection()
+        try:
+            with connection:
+                connection.executemany('DELETE FROM companies WHERE ticker = ?', [(ticker,) for ticker in tickers])
+        except sqlite3.Error as e:
+            errors = {ticker: str(e) for ticker in tickers}
+        return errors
+
+    # Pipeline state
+
+    def get_meta(self, key):
+        row = self.connection().execute('SELECT document FROM meta WHERE key = ?', (key,)).fetchone()
+        return loads(row[0]) if row else None
+
+    def set_meta(self, key, fields):
+        with self.connection() as connection:
+            row = connection.execute('SELECT document FROM meta WHERE key = ?', (key,)).fetchone()
+            document = dict(loads(row[0]) if row else {}, **fields)
+            connection.execute('INSERT OR REPLACE INTO meta (key, document) VALUES (?, ?)', (key, dumps(document)))
+
+
+class SQLiteJobStore:
+    '''Same interface as work_queue.JobStore on the jobs table. Stamps are stored as fixed-width
+    text, so they compare in time order.'''
+    FIELDS = ('ticker', 'lastAttempt', 'lastSuccess', 'failures', 'nextEligible', 'lastError', 'leaseOwner', 'leaseExpires')
+    STAMPS = ('lastAttempt', 'lastSuccess', 'nextEligible', 'leaseExpires')
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def ensure_indexes(self):
+        pass
+
+    def _job(self, row):
+        job = dict(zip(self.FIELDS, row))
+        for field in self.STAMPS:
+            if job[field] is not None:
+                job[field] = datetime.strptime(job[field], STAMP_FORMAT)
+        return job
+
+    def add(self, tickers):
+        with self.storage.connection() as connection:
+            connection.executemany('INSERT OR IGNORE INTO jobs (ticker) VALUES (?)', [(ticker,) for ticker in tickers])
+
+    def get(self, tickers):
+        jobs = {}
+        for start in range(0, len(tickers), 500):
+            chunk = tickers[start:start + 500]
+            rows = self.storage.connection().execute('SELECT {0} FROM jobs WHERE ticker IN ({1})'.format(
+                ', '.join(self.FIELDS), ','.join('?' * len(chunk))), chunk)
+            for row in rows:
+                jobs[row[0]] = self._job(row)
+        return jobs
+
+    def claim(self, ticker, owner, now, expires, since):
+        with self.storage.connection() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET leaseOwner = ?, leaseExpires = ?, lastAttempt = ? WHERE ticker = ? '
+                'AND (lastSuccess IS NULL OR lastSuccess < ?) AND (nextEligible IS NULL OR nextEligible <= ?) '
+                'AND (leaseExpires IS NULL OR leaseExpires <= ? OR leaseOwner = ?)',
+                (owner, _stamp(expires), _stamp(now), ticker, _stamp(since), _stamp(now), _stamp(now), owner))
+            if cursor.rowcount != 1:
+                return None
+            row = connection.execute(
+                'SELECT {0} FROM jobs WHERE ticker = ?'.format(', '.join(self.FIELDS)), (ticker,)).fetchone()
+        return self._job(row)
+
+    def finish(self, ticker, owner, fields):
+        fields = {field: _stamp(value) if field in self.STAMPS else value for field, value in fields.items()}
+        with self.storage.connection() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET {0}, leaseOwner = NULL, leaseExpires = NULL WHERE ticker = ? AND leaseOwner = ?'.format(
+                    ', '.join('{0} = ?'.format(field) for field in fields)),
+                list(fields.values()) + [ticker, owner])
+        return cursor.rowcount == 1
+
+    def release(self, owner):
+        with self.storage.connection() as connection:
+            connection.execute('UPDATE jobs SET leaseOwner = NULL, leaseExpires = NULL WHERE leaseOwner = ?', (owner,))
+
+
+class SQLiteHistoryStore:
+    '''Same interface as history_store.HistoryStore on the price and dividend tables.
+    Watermarks are not stored separately: the latest entry is one primary key lookup.'''
+    layout = 'sqlite'
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def ensure_indexes(self):
+        self.storage.ensure_indexes()
+
+    def _price(self, ticker, row):
+        date, adj_close, last_div, div_yield = row
+        return {'adjClose': adj_close, 'date': from_date(date), 'ticker': ticker, 'lastDivAnnual': last_div,
+                'divYield': div_yield, 'type': 'price'}
+
+    def _dividend(self, ticker, row):
+        date, dividend = row
+        return {'dividend': dividend, 'date': from_date(date), 'ticker': ticker, 'type': 'dividend'}
+
+    def _last_date(self, ticker, table):
+        row = self.storage.connection().execute(
+            'SELECT date FROM {0} WHERE ticker = ? ORDER BY date DESC LIMIT 1'.format(table), (ticker,)).fetchone()
+        return from_date(row[0]) if row else None
+
+    def get_watermark(self, ticker):
+        last_price = self.get_last_price(ticker)
+        last_dividend = self._last_date(ticker, 'dividend')
+        if last_price is None and last_dividend is None:
+            return None
+        return {
+            'ticker': ticker,
+            'lastPriceDate': last_price['date'] if last_price else None,
+            'latestPrice': last_price,
+            'lastDividendDate': last_dividend
+        }
+
+    def rebuild_watermark(self, ticker):
+        return self.get_watermark(ticker)
+
+    def get_last_date(self, ticker):
+        return self._last_date(ticker, 'price')
+
+    def get_last_price(self, ticker):
+        row = self.storage.connection().execute(
+            'SELECT date, adjClose, lastDivAnnual, divYield FROM price WHERE ticker = ? ORDER BY date DESC LIMIT 1',
+            (ticker,)).fetchone()
+        if row is None:
+            return None
+        date, adj_close, last_div, div_yield = row
+        return {'date': from_date(date), 'adjClose': adj_close, 'lastDivAnnual': last_div, 'divYield': div_yield}
+
+    def get_last_prices(self, tickers):
+        latest = {}
+        for start in range(0, len(tickers), 500):
+            chunk = tickers[start:start + 500]
+            rows = self.storage.connection().execute(
+                'SELECT p.ticker, p.date, p.adjClose, p.lastDivAnnual, p.divYield FROM price p '
+                'JOIN (SELECT ticker, MAX(date) AS date FROM price WHERE ticker IN ({0}) GROUP BY ticker) m '
+                'ON p.ticker = m.ticker AND p.date = m.date'.format(','.join('?' * len(chunk))), chunk)
+            for ticker, date, adj_close, last_div, div_yield in rows:
+                latest[ticker] = {'date': from_date(date), 'adjClose': adj_close, 'lastDivAnnual': last_div,
+                                  'divYield': div_yield}
+        return latest
+
+    def get_history(self, ticker, data_type='price', start_date=None):
+        start = to_date(start_date) if start_date is not None else ''
+        if data_type == 'price':
+            rows = self.storage.connection().execute(
+                'SELECT date, adjClose, lastDivAnnual, divYield FROM price WHERE ticker = ? AND date >= ? ORDER BY date',
+                (ticker, start))
+            return [self._price(ticker, row) for row in rows]
+        rows = self.storage.connection().execute(
+            'SELECT date, dividend FROM dividend WHERE ticker = ? AND date >= ? ORDER BY date', (ticker, start))
+        return [self._dividend(ticker, row) for row in rows]
+
+    def get_histories(self, tickers, data_type='price', start_date=None):
+        start = to_date(start_date) if start_date is not None else ''
+        histories = {ticker: [] for ticker in tickers}
+        if data_type == 'price':
+            columns, build = 'ticker, date, adjClose, lastDivAnnual, divYield', self._price
+        else:
+            columns, build = 'ticker, date, dividend', self._dividend
+        for chunk_start in range(0, len(tickers), 500):
+            chunk = tickers[chunk_start:chunk_start + 500]
+            rows = self.storage.connection().execute(
+                'SELECT {0} FROM {1} WHERE ticker IN ({2}) AND date >= ? ORDER BY ticker, date'.format(
+                    columns, 'price' if data_type == 'price' else 'dividend', ','.join('?' * len(chunk))),
+                chunk + [start])
+            for ticker, group in groupby(rows, key=lambda row: row[0]):
+                histories[ticker] = [build(ticker, row[1:]) for row in group]
+        return histories
+
+    def append(self, ticker, price_data, dividend_data):
+        with self.storage.connection() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO price (ticker, date, adjClose, lastDivAnnual, divYield) VALUES (?, ?, ?, ?, ?)',
+                [(ticker, to_date(item['date']), item.get('adjClose'), item.get('lastDivAnnual'), item.get('divYield'))
+                 for item in price_data])
+            connection.executemany(
+                'INSERT OR REPLACE INTO dividend (ticker, date, dividend) VALUES (?, ?, ?)',
+                [(ticker, to_date(item['date']), item.get('dividend')) for item in dividend_data])
+
+    def delete(self, ticker):
+        with self.storage.connection() as connection:
+            connection.execute('DELETE FROM price WHERE ticker = ?', (ticker,))
+            connection.execute('DELETE FROM dividend WHERE ticker = ?', (ticker,))
+
+    def tickers(self):
+        rows = self.storage.connection().execute('SELECT DISTINCT ticker FROM price UNION SELECT DISTINCT ticker FROM dividend')
+        return [ticker for ticker, in rows]
+
+    def iter_tickers(self):
+        for ticker in self.tickers():
+            yield (ticker, self.get_history(ticker, 'price'), self.get_history(ticker, 'dividend'))
+
+    def iter_dividends(self):
+        rows = self.storage.connection().execute('SELECT ticker, date, dividend FROM dividend ORDER BY ticker, date')
+        for ticker, group in groupby(rows, key=lambda row: row[0]):
+            yield (ticker, [self._dividend(ticker, row[1:]) for row in group])
+
+    def yield_statistics(self, ticker, last_price, windows=yield_stats.WINDOWS, percentiles=yield_stats.PERCENTILES):
+        '''Same result as yield_stats.window_statistics, with counts, extremes, sums and the
+        percentile ranks aggregated by SQLite over the (ticker, date) index instead of in Python.
+        Only the percentiles are computed in numpy: ranking rows in SQL needs window functions (SQLite 3.25).'''
+        connection = self.storage.connection()
+        max_date = last_price['date']
+        fetch_start = to_date(max_date.replace(year=max_date.year - max(windows)))
+        valid = 'ticker = ? AND date >= ? AND ' + VALID_YIELD
+        has_history, first, end = connection.execute(
+            'SELECT COUNT(*) > 0, MIN(CASE WHEN {0} THEN date END), MAX(CASE WHEN {0} THEN date END) '
+            'FROM price WHERE ticker = ? AND date >= ?'.format(VALID_YIELD), (ticker, fetch_start)).fetchone()
+        if not has_history:
+            return None
+        if end is None:
+            return {}
+        current, = connection.execute('SELECT divYield FROM price WHERE ticker = ? AND date = ?', (ticker, end)).fetchone()
+
+        stats = {}
+        end_date = from_date(end)
+        valid_rows = None
+        for years in windows:
+            start = to_date(end_date - timedelta(days=int(round(365.25 * years))))
+            count, low, high, total, squares, at_most_current = connection.execute(
+                'SELECT COUNT(*), MIN(divYield), MAX(divYield), SUM(divYield), SUM(divYield * divYield), '
+                'SUM(divYield <= ?) FROM price WHERE {0} AND date > ?'.format(valid),
+                (current, ticker, fetch_start, start)).fetchone()
+            if count == 0:
+                continue
+            if valid_rows is None:
+                # Read once for all windows, each window is a suffix of the date ordered rows
+                rows = connection.execute(
+                    'SELECT date, divYield FROM price WHERE {0} ORDER BY date'.format(valid), (ticker, fetch_start)).fetchall()
+                valid_rows = (np.array([date for date, _ in rows]), np.array([div_yield for _, div_yield in rows], dtype=float))
+            dates, yields = valid_rows
+            window = yields[np.searchsorted(dates, start, side='right'):]
+            mean = total / count
+            std = math.sqrt(max(squares / count - mean ** 2, 0))
+            stats['{0}y'.format(years)] = {
+                'interval': years,
+                'count': count,
+                'complete': first <= start,
+                'min': low,
+                'max': high,
+                'mean': mean,
+                'std': std,
+                'percentiles': {'p{0}'.format(p): float(v) for p, v in zip(percentiles, np.percentile(window, percentiles))},
+                'current': current,
+                'percentileRank': at_most_current / count * 100,
+                'zScore': (current - mean) / std if std > 0 else None
+            }
+        return stats
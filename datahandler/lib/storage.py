@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+'''Storage backends of the aristocrats data: company list, pipeline state and price/dividend history.
+
+open_storage() picks the backend from a URI:
+    mongodb://host:port         MongoDB dividend_investing database (default)
+    sqlite:///relative/file.db  embedded SQLite file, no database server needed
+    sqlite:////absolute/file.db'''
+
+import logging
+from pymongo import MongoClient, UpdateOne, DeleteOne, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+from lib.history_store import get_history_store
+from lib.work_queue import JobStore
+
+
+# Indexes of the companies collection: lookups by ticker, the data version stamps read by the
+# dataserver and the screening fields (see dataserver/screen.py)
+COMPANY_INDEXES = [
+    [('ticker', ASCENDING)],
+    [('lastUpdated', DESCENDING)],
+    [('downloaded', DESCENDING)],
+    [('growthUpdated', DESCENDING)],
+    [('category', ASCENDING), ('divYield', DESCENDING)],
+    [('divYield', DESCENDING)],
+    [('payout', ASCENDING)],
+    [('divRaiseYrs', DESCENDING)],
+    [('divg5y', DESCENDING)],
+    [('divg10y', DESCENDING)]
+]
+
+class MongoStorage:
+    '''Companies, meta and jobs collections plus the history layout recorded in the meta collection'''
+    backend = 'mongo'
+
+    def __init__(self, db):
+        self.db = db
+        self.history = get_history_store(db)
+        self.jobs = JobStore(db)
+
+    def ensure_indexes(self):
+        self.history.ensure_indexes()
+        self.jobs.ensure_indexes()
+        for keys in COMPANY_INDEXES:
+            self.db.companies.create_index(keys)
+
+    # Company list
+
+    def get_companies(self):
+        return list(self.db.companies.find())
+
+    def get_company(self, ticker, fields=None):
+        '''Company document of the ticker (only the given fields if set) or None'''
+        projection = dict({'_id': 0}, **{field: 1 for field in fields}) if fields else {'_id': 0}
+        return self.db.companies.find_one({'ticker': ticker}, projection=projection)
+
+    def get_companies_by_ticker(self, tickers, fields=None):
+        '''Dict of company documents by ticker for the given tickers, read at once'''
+        projection = dict({'_id': 0, 'ticker': 1}, **{field: 1 for field in fields}) if fields else {'_id': 0}
+        return {
+            company['ticker']: company
+            for company in self.db.companies.find({'ticker': {'$in': tickers}}, projection=projection)
+        }
+
+    def update_company(self, ticker, fields):
+        self.db.companies.update_one({'ticker': ticker}, {'$set': fields})
+
+    def update_companies(self, updates, chunk_size=500, upsert=False):
+        '''Set fields on many companies from a dict of field dicts by ticker,
+        returning a dict of error messages by ticker for the writes that failed'''
+        operations = [(ticker, UpdateOne({'ticker': ticker}, {'$set': fields}, upsert=upsert))
+                      for ticker, fields in updates.items()]
+        return self._bulk_write(self.db.companies, operations, chunk_size)
+
+    def remove_companies(self, tickers, chunk_size=500):
+        operations = [(ticker, DeleteOne({'ticker': ticker})) for ticker in tickers]
+        return self._bulk_write(self.db.companies, operations, chunk_size)
+
+    def _bulk_write(self, collection, operations, chunk_size=500):
+        '''Flush (ticker, operation) pairs with unordered bulk writes in chunks,
+        returning a dict of error messages by ticker for the operations that failed'''
+        errors = {}
+        for start in range(0, len(operations), chunk_size):
+            chunk = operations[start:start + chunk_size]
+            try:
+                collection.bulk_write([operation for _, operation in chunk], ordered=False)
+            except BulkWriteError as e:
+                for write_error in e.details['writeErrors']:
+                    errors[chunk[write_error['index']][0]] = write_error['errmsg']
+            except Exception as e:
+                for ticker, _ in chunk:
+                    errors[ticker] = str(e)
+        return errors
+
+    # Pipeline state
+
+    def get_meta(self, key):
+        '''State record saved under key (e.g. dripSheet) or None'''
+        return self.db.meta.find_one({'_id': key}, projection={'_id': 0})
+
+    def set_meta(self, key, fields):
+        self.db.meta.update_one({'_id': key}, {'$set': fields}, upsert=True)
+
+
+def open_storage(uri=None):
+    '''Storage backend for the URI, the local MongoDB server if not given'''
+    if uri and uri.startswith('sqlite:///'):
+        from lib.sqlite_storage import SQLiteStorage
+        return SQLiteStorage(uri[len('sqlite:///'):])
+    return MongoStorage(MongoClient(uri).dividend_investing)
+
+
+def copy_storage(source, target):
+    '''Copy companies, pipeline state and history of every ticker from one backend to another'''
+    target.ensure_indexes()
+    companies = {company['ticker']: {key: value for key, value in company.items() if key != '_id'}
+                 for company in source.get_companies()}
+    errors = target.update_companies(companies, upsert=True)
+    for ticker, error in errors.items():
+        logging.error('Cannot copy {0} company data: {1}'.format(ticker, error))
+    for key in ('dripSheet',):
+        state = source.get_meta(key)
+        if state:
+            target.set_meta(key, state)
+    count = 0
+    for ticker, price_data, dividend_data in source.history.iter_tickers():
+        # Start from scratch so an interrupted copy can simply be run again
+        target.history.delete(ticker)
+        target.history.append(ticker, price_data, dividend_data)
+        count += 1
+        logging.info('Copied {0} history'.format(ticker))
+    return count
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+import mongomock
+import pytest
+from lib.history_store import HistoryStore
+
+
+def prices(start, count):
+    return [{'date': start + timedelta(days=i), 'adjClose': 10.0 + i, 'lastDivAnnual': 1.0, 'divYield': 0.1,
+             'ticker': 'AAA', 'type': 'price'} for i in range(count)]
+
+
+@pytest.fixture
+def store():
+    store = HistoryStore(mongomock.MongoClient().dividend_investing)
+    store.ensure_indexes()
+    return store
+
+
+def test_last_date_follows_appends(store):
+    assert store.get_last_date('AAA') is None
+    store.append('AAA', prices(datetime(2020, 1, 1), 3), [])
+    assert store.get_last_date('AAA') == datetime(2020, 1, 3)
+    store.append('AAA', [], [{'date': datetime(2020, 1, 5), 'dividend': 0.25, 'ticker': 'AAA', 'type': 'dividend'}])
+    assert store.get_last_date('AAA') == datetime(2020, 1, 3)
+    assert store.get_last_price('AAA')['adjClose'] == 12.0
+
+
+def test_interrupted_append_is_not_repeated(store, monkeypatch):
+    store.append('AAA', prices(datetime(2020, 1, 1), 3), [])
+
+    def crash(*args):
+        raise RuntimeError('connection lost')
+    monkeypatch.setattr(store, '_update_watermark', crash)
+    with pytest.raises(RuntimeError):
+        store.append('AAA', prices(datetime(2020, 1, 4), 2), [])
+    monkeypatch.undo()
+
+    # The entries are stored, only the watermark is behind
+    assert store.get_watermark('AAA')['lastPriceDate'] == datetime(2020, 1, 3)
+    assert store.get_last_date('AAA') == datetime(2020, 1, 5)
+    assert store.get_watermark('AAA')['lastPriceDate'] == datetime(2020, 1, 5)
+    assert store.get_last_price('AAA')['adjClose'] == 11.0
+
+
+def test_history_written_before_the_stamp(store):
+    store.collection.insert_one({'ticker': 'AAA', 'price': prices(datetime(2020, 1, 1), 4), 'dividend': []})
+    assert store.get_last_date('AAA') == datetime(2020, 1, 4)
+    store.append('AAA', prices(datetime(2020, 1, 5), 1), [])
+    assert store.get_last_date('AAA') == datetime(2020, 1, 5)
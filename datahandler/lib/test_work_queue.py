@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta
+import mongomock
+import pytest
+import data_pipeline
+from lib.sqlite_storage import SQLiteStorage
+from lib.storage import MongoStorage
+from lib.work_queue import WorkQueue, LEASE, RETRY
+
+TICKERS = ['T{0}'.format(i) for i in range(6)]
+
+
+@pytest.fixture(params=['mongo', 'sqlite'])
+def storage(request, tmp_path):
+    if request.param == 'mongo':
+        storage = MongoStorage(mongomock.MongoClient().dividend_investing)
+    else:
+        storage = SQLiteStorage(str(tmp_path / 'queue.db'))
+    storage.ensure_indexes()
+    return storage
+
+
+def set_companies(storage, companies):
+    if storage.backend == 'mongo':
+        storage.db.companies.insert_many([dict(company) for company in companies])
+    else:
+        storage.update_companies({company['ticker']: company for company in companies}, upsert=True)
+
+
+def test_due_orders_by_staleness_and_skips_current_tickers(storage):
+    today = datetime.today()
+    set_companies(storage, [
+        {'ticker': 'T0', 'lastUpdated': today},
+        {'ticker': 'T1', 'lastUpdated': today - timedelta(days=1)},
+        {'ticker': 'T2', 'lastUpdated': today - timedelta(days=30)},
+        {'ticker': 'T3'}
+    ])
+    queue = WorkQueue(storage, owner='a')
+    assert queue.due(TICKERS[:4]) == ['T3', 'T2', 'T1']
+
+
+def test_claims_are_exclusive(storage):
+    first, second = WorkQueue(storage, owner='a'), WorkQueue(storage, owner='b')
+    first_batches, second_batches = first.batches(TICKERS, 2), second.batches(TICKERS, 2)
+    claimed = [next(first_batches), next(second_batches), next(first_batches)]
+    assert claimed == [['T0', 'T1'], ['T2', 'T3'], ['T4', 'T5']]
+    # Everything left is leased by the first queue
+    assert list(second_batches) == []
+
+    now = datetime.today()
+    assert storage.jobs.claim('T0', 'b', now, now + LEASE, WorkQueue.day_start(now)) is None
+    assert storage.jobs.claim('T0', 'a', now, now + LEASE, WorkQueue.day_start(now)) is not None
+
+
+def test_expired_lease_is_reclaimed(storage):
+    storage.jobs.add(['T0'])
+    start = datetime.today().replace(hour=1)
+    since = WorkQueue.day_start(start)
+    assert storage.jobs.claim('T0', 'a', start, start + LEASE, since)['leaseOwner'] == 'a'
+    assert storage.jobs.claim('T0', 'b', start + LEASE / 2, start + LEASE * 1.5, since) is None
+    job = storage.jobs.claim('T0', 'b', start + LEASE, start + LEASE * 2, since)
+    assert job['leaseOwner'] == 'b'
+    # The first owner lost the lease, its outcome is not recorded
+    assert not storage.jobs.finish('T0', 'a', {'lastSuccess': start})
+    assert storage.jobs.finish('T0', 'b', {'lastSuccess': start})
+    assert storage.jobs.get(['T0'])['T0']['leaseOwner'] is None
+
+
+def test_success_makes_ticker_current_for_the_day(storage):
+    queue = WorkQueue(storage, owner='a')
+    batch = next(queue.batches(TICKERS, 2))
+    queue.complete({ticker: None for ticker in batch})
+    queue.release()
+    assert queue.due(TICKERS) == TICKERS[2:]
+    assert queue.due(TICKERS, now=datetime.today() + timedelta(days=1))[-2:] == batch
+
+    # A second process does not claim them either
+    other = WorkQueue(storage, owner='b')
+    assert [ticker for batch in other.batches(TICKERS, 10) for ticker in batch] == TICKERS[2:]
+
+
+def test_failures_back_off_exponentially(storage):
+    queue = WorkQueue(storage, owner='a')
+    storage.jobs.add(['T0'])
+    # Early enough that the retries stay within the day
+    now = datetime.today().replace(hour=1, minute=0, second=0, microsecond=0)
+    for failures in (1, 2, 3):
+        assert queue.jobs.claim('T0', 'a', now, now + LEASE, WorkQueue.day_start(now)) is not None
+        queue.complete({'T0': 'download failed'}, now=now)
+        job = storage.jobs.get(['T0'])['T0']
+        assert job['failures'] == failures
+        assert job['lastError'] == 'download failed'
+        assert job['nextEligible'] == now + RETRY * 2 ** (failures - 1)
+        assert 'T0' not in queue.due(['T0'], now=now)
+        now = job['nextEligible']
+    assert queue.due(['T0'], now=now) == ['T0']
+
+    queue.jobs.claim('T0', 'a', now, now + LEASE, WorkQueue.day_start(now))
+    queue.complete({'T0': None}, now=now)
+    job = storage.jobs.get(['T0'])['T0']
+    assert (job['failures'], job['nextEligible'], job['lastError']) == (0, None, None)
+
+
+class FakeData:
+    '''Stands in for DividendData in data_pipeline.refresh_all'''
+    def __init__(self, fail=(), crash_after=None):
+        self.fail = fail
+        self.crash_after = crash_after
+        self.refreshed = []
+
+    def update_company_history(self, ticker):
+        if self.crash_after is not None and len(self.refreshed) == self.crash_after:
+            raise KeyboardInterrupt()
+        self.refreshed.append(ticker)
+        return ticker not in self.fail
+
+    def update_company_profile(self, ticker):
+        return True
+
+
+def test_refresh_due_resumes_after_a_crash(storage):
+    crashed = FakeData(crash_after=3)
+    with pytest.raises(KeyboardInterrupt):
+        data_pipeline.refresh_due(crashed, WorkQueue(storage, owner='a'), TICKERS, batch_size=2)
+    assert crashed.refreshed == ['T0', 'T1', 'T2']
+    # The interrupted batch was released, only the finished one is current
+    assert not any(job.get('leaseOwner') for job in storage.jobs.get(TICKERS).values())
+
+    resumed = FakeData(fail=['T4'])
+    results = data_pipeline.refresh_due(resumed, WorkQueue(storage, owner='b'), TICKERS, batch_size=2)
+    assert resumed.refreshed == ['T2', 'T3', 'T4', 'T5']
+    assert results == {'T2': None, 'T3': None, 'T4': 'history update failed', 'T5': None}
+    assert storage.jobs.get(['T4'])['T4']['failures'] == 1
+
+    assert data_pipeline.refresh_due(FakeData(), WorkQueue(storage, owner='c'), TICKERS, batch_size=2) == {}
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+'''Persistent work queue of the ingestion pipeline.
+
+Every ticker has a job state (last attempt, last success, failure count, next eligible time and
+an optional lease). A run refreshes only the tickers that are due, most stale first: not yet
+brought up to date today, not backing off after failures and not leased by another process.
+Tickers are claimed in small batches with an atomic lease, so several pipeline processes can
+split the universe, and every outcome is recorded as soon as its batch is done, so a run that
+crashed resumes with the remaining tickers (those of the interrupted batch once their lease expires).'''
+
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError
+
+
+LEASE = timedelta(minutes=15)
+# Retry delay after the first failure, doubled with every further failure up to MAX_RETRY
+RETRY = timedelta(hours=1)
+MAX_RETRY = timedelta(days=7)
+
+
+class JobStore:
+    '''Job states in the jobs collection of the MongoDB database, one document per ticker'''
+    def __init__(self, db):
+        self.collection = db.jobs
+
+    def ensure_indexes(self):
+        self.collection.create_index([('ticker', ASCENDING)], unique=True)
+
+    def add(self, tickers):
+        '''Create the missing job states of the tickers'''
+        existing = {job['ticker'] for job in self.collection.find({'ticker': {'$in': tickers}}, projection={'ticker': 1})}
+        missing = [{'ticker': ticker, 'failures': 0} for ticker in tickers if ticker not in existing]
+        if missing:
+            try:
+                self.collection.insert_many(missing, ordered=False)
+            except BulkWriteError:
+                # Created by another process in the meantime
+                pass
+
+    def get(self, tickers):
+        '''Dict of job states by ticker'''
+        return {job['ticker']: job for job in self.collection.find({'ticker': {'$in': tickers}}, projection={'_id': 0})}
+
+    def claim(self, ticker, owner, now, expires, since):
+        '''Lease the ticker to the owner until expires if it has not succeeded since the given time, is
+        eligible now and is not leased by another owner. Returns the job state or None if not claimed.'''
+        return self.collection.find_one_and_update(
+            {'ticker': ticker, '$and': [
+                {'$or': [{'lastSuccess': None}, {'lastSuccess': {'$lt': since}}]},
+                {'$or': [{'nextEligible': None}, {'nextEligible': {'$lte': now}}]},
+                {'$or': [{'leaseExpires': None}, {'leaseExpires': {'$lte': now}}, {'leaseOwner': owner}]}
+            ]},
+            {'$set': {'leaseOwner': owner, 'leaseExpires': expires, 'lastAttempt': now}},
+            projection={'_id': 0},
+            return_document=ReturnDocument.AFTER)
+
+    def finish(self, ticker, owner, fields):
+        '''Save the outcome fields and drop the lease, unless the lease went to another owner.
+        Returns False in that case.'''
+        result = self.collection.update_one(
+            {'ticker': ticker, 'leaseOwner': owner},
+            {'$set': dict(fields, leaseOwner=None, leaseExpires=None)})
+        return result.matched_count == 1
+
+    def release(self, owner):
+        '''Drop every lease of the owner'''
+        self.collection.update_many({'leaseOwner': owner}, {'$set': {'leaseOwner': None, 'leaseExpires': None}})
+
+
+class WorkQueue:
+    '''Staleness-ordered, lease-based scheduling of ticker refreshes on the job store of a storage backend'''
+    def __init__(self, storage, owner=None, lease=LEASE, retry=RETRY, max_retry=MAX_RETRY):
+        self.storage = storage
+        self.jobs = storage.jobs
+        self.owner = owner or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.lease = lease
+        self.retry = retry
+        self.max_retry = max_retry
+
+    @staticmethod
+    def day_start(now):
+        return datetime(now.year, now.month, now.day)
+
+    def due(self, tickers, now=None):
+        '''Tickers that are due now, least recently brought up to date first (never updated ones first).
+        A ticker is current for the day once its profile was updated or its refresh succeeded today.'''
+        now = now or datetime.today()
+        today = self.day_start(now)
+        self.jobs.add(tickers)
+        jobs = self.jobs.get(tickers)
+        companies = self.storage.get_companies_by_ticker(tickers, fields=['lastUpdated'])
+        due = []
+        for ticker in tickers:
+            job = jobs.get(ticker, {})
+            stamps = [stamp for stamp in (companies.get(ticker, {}).get('lastUpdated'), job.get('lastSuccess')) if stamp]
+            updated = max(stamps) if stamps else None
+            if updated is not None and updated >= today:
+                continue
+            if job.get('nextEligible') and job['nextEligible'] > now:
+                continue
+            if job.get('leaseExpires') and job['leaseExpires'] > now and job.get('leaseOwner') != self.owner:
+                continue
+            due.append((updated or datetime.min, ticker))
+        due.sort()
+        return [ticker for _, ticker in due]
+
+    def batches(self, tickers, size):
+        '''Yield lists of up to size tickers leased to this process, in staleness order, until none is due.
+        Pass each batch's results to complete() before taking the next one.'''
+        due = self.due(tickers)
+        logging.info('{0} of {1} tickers due, claiming batches of {2} as {3}'.format(
+            len(due), len(tickers), size, self.owner))
+        position = 0
+        while position < len(due):
+            now = datetime.today()
+            batch = []
+            while position < len(due) and len(batch) < size:
+                ticker = due[position]
+                position += 1
+                if self.jobs.claim(ticker, self.owner, now, now + self.lease, self.day_start(now)) is not None:
+                    batch.append(ticker)
+            if batch:
+                yield batch
+
+    def complete(self, results, now=None):
+        '''Record the outcome of claimed tickers from a dict of error messages (None for success) by ticker.
+        Failed tickers back off exponentially with the number of consecutive failures.'''
+        now = now or datetime.today()
+        jobs = self.jobs.get(list(results))
+        for ticker, error in results.items():
+            if error is None:
+                fields = {'lastSuccess': now, 'failures': 0, 'nextEligible': None, 'lastError': None}
+            else:
+                failures = jobs.get(ticker, {}).get('failures', 0) + 1
+                delay = min(self.retry * 2 ** (failures - 1), self.max_retry)
+                fields = {'failures': failures, 'nextEligible': now + delay, 'lastError': error}
+                logging.info('{0} failed {1} times in a row, next attempt after {2:%Y-%m-%d %H:%M}'.format(
+                    ticker, failures, now + delay))
+            if not self.jobs.finish(ticker, self.owner, fields):
+                logging.warning('Lease on {0} expired before its refresh finished'.format(ticker))
+
+    def release(self):
+        '''Give up the leases still held, e.g. after an interrupted batch'''
+        self.jobs.release(self.owner)
@@ -3,18 +3,52 @@
 '''Data downloader for Yahoo Finance API 2017'''
 
 import requests
+from requests.adapters import HTTPAdapter
 import re
 from datetime import datetime
 import pandas as pd
 import io
+import json
 import logging
+import os
+import random
+import threading
+import time
+from lib.metrics import Metrics
+from lib.rate_limiter import RateLimiter
+
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+CSV_COLUMNS = {
+    'history': PRICE_COLUMNS,
+    'div': ['Dividends'],
+    'split': ['Stock Splits']
+}
+
 
 class Downloader:
-    def __init__(self):
+    def __init__(self, rate_limit=None, pool_size=10, auth_cache='.yahoo_auth.json', auth_ttl=12 * 3600,
+                 max_attempts=10, backoff=0.5, max_backoff=30,
+                 quote_url='https://finance.yahoo.com/quote/^GSPC',
+                 download_url='https://query1.finance.yahoo.com/v7/finance/download/{}', metrics=None):
         self.DATA_TYPES = ['history', 'div', 'split']
+        self.quote_url = quote_url
+        self.download_url = download_url
         self._cookie = None
         self._crumb = None
-        self.attempt_counter = 0
+        self._auth_lock = threading.Lock()
+        self._rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.auth_cache = auth_cache
+        self.auth_ttl = auth_ttl
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'auth_errors': 0}
+        self.metrics = metrics or Metrics(enabled=False)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.years = 20
         self.ticker = None
 
@@ -23,11 +57,75 @@ class Downloader:
 
         return (self.ticker, self.years)
 
+    def get_stats(self):
+        '''Return a copy of the request, retry and auth error counters'''
+
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+        self.metrics.count('yahoo_' + name)
+
+    def _wait_for_slot(self):
+        '''Respect the global requests-per-second limit, if one is set'''
+
+        if self._rate_limiter is not None:
+            self._rate_limiter.wait()
+
+    def _get(self, url, stage='http_download', **kwargs):
+        '''Make a rate limited GET request through the pooled session, timed under the stage name'''
+
+        with self.metrics.timer('rate_limit_wait'):
+            self._wait_for_slot()
+        self._count('requests')
+        with self.metrics.timer(stage):
+            return self.session.get(url, **kwargs)
+
+    def _load_cached_auth(self):
+        '''Restore crumb and cookies saved by a previous run, if they are not expired'''
+
+        if not self.auth_cache:
+            return False
+        try:
+            with open(self.auth_cache) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if cached.get('expires', 0) < time.time():
+            logging.debug('Cached Yahoo crumb expired')
+            return False
+        self._crumb = cached['crumb']
+        self._cookie = requests.utils.cookiejar_from_dict(cached['cookies'])
+        logging.debug('Using cached Yahoo crumb')
+        return True
+
+    def _save_cached_auth(self):
+        if not self.auth_cache:
+            return
+        cached = {
+            'crumb': self._crumb,
+            'cookies': requests.utils.dict_from_cookiejar(self._cookie),
+            'expires': time.time() + self.auth_ttl
+        }
+        try:
+            with open(self.auth_cache, 'w') as f:
+                json.dump(cached, f)
+        except IOError as e:
+            logging.warning('Cannot save Yahoo crumb to {0}: {1}'.format(self.auth_cache, e))
+
+    def _remove_cached_auth(self):
+        if self.auth_cache and os.path.exists(self.auth_cache):
+            try:
+                os.remove(self.auth_cache)
+            except OSError:
+                pass
+
     def _get_crumb_and_cookies(self):
         '''Make an initial request to extract cookies and crumb to use in subsequent requests'''
 
-        url = 'https://finance.yahoo.com/quote/^GSPC'
-        r = requests.get(url)
+        r = self._get(self.quote_url, stage='crumb_fetch')
         if r.status_code == requests.codes.ok:
             self._cookie = r.cookies
             search = re.search('\"CrumbStore\"\:\{\"crumb\"\:\"(.*)\"\}\,\"QuotePageStore\"', r.text)
@@ -35,75 +133,117 @@ class Downloader:
                 raise Exception('No crumb found in initial response')
             else:
                 self._crumb = search.group(1)
+                self._save_cached_auth()
         else:
             r.raise_for_status()
 
-    def _get_single_data_type(self, data_type):
+    def _get_auth(self):
+        '''Return the shared (crumb, cookie) pair, from memory, disk cache or a new handshake.
+        Only one thread performs the handshake, the others wait for its result.'''
+
+        with self._auth_lock:
+            if self._cookie is None or self._crumb is None:
+                if not self._load_cached_auth():
+                    self._get_crumb_and_cookies()
+            return (self._crumb, self._cookie)
+
+    def _invalidate_auth(self, crumb):
+        '''Drop the shared crumb and cookie unless another thread already renewed them'''
+
+        with self._auth_lock:
+            if self._crumb == crumb:
+                self._crumb = None
+                self._cookie = None
+                self._remove_cached_auth()
+
+    def _backoff_delay(self, attempt):
+        '''Exponential backoff with full jitter for the given (1-based) attempt'''
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def _parse_csv(self, content, data_type, fields=None):
+        '''Parse a downloaded CSV with declared columns and dtypes and a native date index.
+        For the history data type fields can limit the price columns that are parsed.'''
+
+        columns = fields if data_type == 'history' and fields else CSV_COLUMNS[data_type]
+        # Splits come as 'a/b' strings, everything else is numeric with 'null' for missing values
+        dtype = str if data_type == 'split' else 'float64'
+        frame = pd.read_csv(
+            io.BytesIO(content),
+            usecols=['Date'] + columns,
+            dtype={column: dtype for column in columns},
+            na_values=['null'],
+            parse_dates=['Date'],
+            index_col='Date')
+        # A CSV without rows (e.g. no splits) gets an object index, which would spread to the joined frame
+        frame.index = pd.DatetimeIndex(frame.index, name='Date')
+        return frame
+
+    def _get_single_data_type(self, ticker, years, data_type, fields=None):
         '''Return a dataframe of the specified data type [history|div|split]'''
 
-        if self._cookie is None or self._crumb is None:
-            self._get_crumb_and_cookies()
-
-        start_date = datetime.today().replace(year=datetime.today().year - self.years)
-
-        self.attempt_counter += 1
-        params = {
-            'period1': int(start_date.timestamp()),
-            'period2': int(datetime.today().timestamp()),
-            'events': data_type,
-            'crumb': self._crumb,
-            'interval': '1d'
-        }
-        url = 'https://query1.finance.yahoo.com/v7/finance/download/{}'.format(self.ticker)
-        r = requests.get(url, params=params, cookies=self._cookie)
-        if r.status_code == requests.codes.ok:
-            df = pd.read_csv(io.BytesIO(r.content))
-            df.set_index(pd.DatetimeIndex(df['Date']), inplace=True)
-            df.drop('Date', axis=1, inplace=True)
-            self.attempt_counter = 0
-            return df
-        elif r.status_code == 401:
-            # In case of authorization error renew crumb and cookie and fetch data again. Max. 10 attempts.
-            # See the issue here: https://github.com/c0redumb/yahoo_quote_download/issues/3
-            self._crumb = None
-            self._cookie = None
-
-            if self.attempt_counter < 10:
-                logging.error('Yahoo auth error, retrying...')
-                return self._get_single_data_type(data_type=data_type)
+        start_date = datetime.today().replace(year=datetime.today().year - years)
+        url = self.download_url.format(ticker)
+
+        for attempt in range(1, self.max_attempts + 1):
+            crumb, cookie = self._get_auth()
+            params = {
+                'period1': int(start_date.timestamp()),
+                'period2': int(datetime.today().timestamp()),
+                'events': data_type,
+                'crumb': crumb,
+                'interval': '1d'
+            }
+            r = self._get(url, params=params, cookies=cookie)
+            if r.status_code == requests.codes.ok:
+                with self.metrics.timer('csv_parse'):
+                    return self._parse_csv(r.content, data_type, fields)
+            elif r.status_code == 401:
+                # In case of authorization error renew crumb and cookie and fetch data again.
+                # See the issue here: https://github.com/c0redumb/yahoo_quote_download/issues/3
+                self._count('auth_errors')
+                self._invalidate_auth(crumb)
+                if attempt < self.max_attempts:
+                    delay = self._backoff_delay(attempt)
+                    logging.error('Yahoo auth error, retrying in {0:.1f}s...'.format(delay))
+                    self._count('retries')
+                    time.sleep(delay)
             else:
-                raise Exception('Permanent Auth Error')
-        else:
-            r.raise_for_status()
+                r.raise_for_status()
+
+        raise Exception('Permanent Auth Error')
 
-    def _get_all_data_types(self):
+    def _get_all_data_types(self, ticker, years, fields=None):
         '''Return an iterator of all the three data types.'''
 
-        data = None
         for data_type in self.DATA_TYPES:
-            data = self._get_single_data_type(data_type=data_type)
-            yield data
+            yield self._get_single_data_type(ticker, years, data_type, fields)
 
-    def _format_splits(self, value):
-        '''Format splits to float'''
+    def _split_ratios(self, splits):
+        '''Convert 'a/b' split strings to float ratios'''
 
-        if value != 1:
-            numbers = value.split('/')
-            ratio = int(numbers[0]) / int(numbers[1])
-            return ratio
-        else:
-            return value
+        parts = splits.str.split('/', expand=True)
+        if parts.shape[1] < 2:
+            return pd.Series(1.0, index=splits.index)
+        return parts[0].astype(float) / parts[1].astype(float)
+
+    def _merge_frames(self, history, dividends, splits):
+        '''Align the three data types on the price dates with a single outer join'''
 
-    def get_history(self, ticker, years=20):
+        splits = splits.assign(**{'Stock Splits': self._split_ratios(splits['Stock Splits'])})
+        full_data = history.join([dividends, splits], how='outer')
+        full_data['Dividends'] = full_data['Dividends'].fillna(0)
+        full_data['Stock Splits'] = full_data['Stock Splits'].fillna(1)
+        return full_data
+
+    def get_history(self, ticker, years=20, fields=None):
         '''Return quotes, dividends and splits in single Pandas DataFrame
-        for the given ticker and specified number of years ending today (or the latest available).'''
+        for the given ticker and specified number of years ending today (or the latest available).
+        fields limits the price columns to parse (e.g. ['Adj Close']), by default all are returned.
+        Safe to call from several threads on the same instance.'''
 
+        years = max([years, 1])
         self.ticker = ticker
-
-        self.years = max([years, 1])
-        frames = list(self._get_all_data_types())
-        full_data = pd.concat(frames, axis=1)
-        full_data['Dividends'].fillna(0, inplace=True)
-        full_data['Stock Splits'].fillna(1, inplace=True)
-        full_data['Stock Splits'] = full_data['Stock Splits'].apply(self._format_splits)
-        return full_data
+        self.years = years
+        history, dividends, splits = self._get_all_data_types(ticker, years, fields)
+        return self._merge_frames(history, dividends, splits)
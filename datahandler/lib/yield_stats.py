@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+'''Vectorized dividend yield statistics over several trailing windows'''
+
+import numpy as np
+
+
+WINDOWS = (1, 3, 5, 10, 20)
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def to_arrays(history):
+    '''Convert price entries to ascending datetime64[D] dates and float yields,
+    keeping only days with a positive, finite yield'''
+    dates = np.array([item['date'] for item in history], dtype='datetime64[D]')
+    yields = np.array([item.get('divYield') for item in history], dtype=float)
+    order = np.argsort(dates, kind='mergesort')
+    dates, yields = dates[order], yields[order]
+    valid = np.isfinite(yields) & (yields > 0)
+    return (dates[valid], yields[valid])
+
+
+def _window_starts(dates, windows):
+    '''Start date and index of the first date inside each trailing window ending at the last date'''
+    end = dates[-1]
+    starts = np.array([end - np.timedelta64(int(round(365.25 * years)), 'D') for years in windows],
+                      dtype='datetime64[D]')
+    return (starts, np.searchsorted(dates, starts, side='right'))
+
+
+def window_statistics(dates, yields, windows=WINDOWS, percentiles=PERCENTILES):
+    '''Yield statistics for every trailing window ending at the latest date.
+
+    Mean and standard deviation come from one cumulative-sum pass and min/max from
+    suffix accumulations, so adding windows costs O(1) each apart from percentiles.'''
+    if len(yields) == 0:
+        return {}
+
+    suffix_sum = np.cumsum(yields[::-1])[::-1]
+    suffix_sq = np.cumsum((yields ** 2)[::-1])[::-1]
+    suffix_min = np.minimum.accumulate(yields[::-1])[::-1]
+    suffix_max = np.maximum.accumulate(yields[::-1])[::-1]
+    current = float(yields[-1])
+
+    stats = {}
+    start_dates, start_indexes = _window_starts(dates, windows)
+    for years, start_date, start in zip(windows, start_dates, start_indexes):
+        count = len(yields) - start
+        if count == 0:
+            continue
+        mean = suffix_sum[start] / count
+        std = np.sqrt(max(suffix_sq[start] / count - mean ** 2, 0))
+        window = np.sort(yields[start:])
+        stats['{0}y'.format(years)] = {
+            'interval': years,
+            'count': int(count),
+            'complete': bool(dates[0] <= start_date),
+            'min': float(suffix_min[start]),
+            'max': float(suffix_max[start]),
+            'mean': float(mean),
+            'std': float(std),
+            'percentiles': {'p{0}'.format(p): float(v) for p, v in zip(percentiles, np.percentile(window, percentiles))},
+            'current': current,
+            'percentileRank': float(np.searchsorted(window, current, side='right') / count * 100),
+            'zScore': float((current - mean) / std) if std > 0 else None
+        }
+    return stats
+
+
+def rolling_statistics(dates, yields, years=5):
+    '''Trailing mean, standard deviation and z-score of the yield at every date'''
+    if len(yields) == 0:
+        return {'date': dates, 'mean': yields, 'std': yields, 'zScore': yields}
+
+    starts = np.searchsorted(dates, dates - np.timedelta64(int(round(365.25 * years)), 'D'), side='right')
+    ends = np.arange(1, len(yields) + 1)
+    cum_sum = np.concatenate(([0.0], np.cumsum(yields)))
+    cum_sq = np.concatenate(([0.0], np.cumsum(yields ** 2)))
+    counts = ends - starts
+    mean = (cum_sum[ends] - cum_sum[starts]) / counts
+    std = np.sqrt(np.maximum((cum_sq[ends] - cum_sq[starts]) / counts - mean ** 2, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_score = np.where(std > 0, (yields - mean) / std, np.nan)
+    return {'date': dates, 'mean': mean, 'std': std, 'zScore': z_score}
+
+
+def batch_window_statistics(histories, windows=WINDOWS, percentiles=PERCENTILES):
+    '''Run window_statistics for a dict of ticker -> (dates, yields) arrays'''
+    return {
+        ticker: window_statistics(dates, yields, windows, percentiles)
+        for ticker, (dates, yields) in histories.items()
+    }
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+'''Maintenance commands for the aristocrats database'''
+
+import argparse
+import logging
+import os
+from pymongo import MongoClient
+from lib.history_store import migrate_history, repair_watermarks, LAYOUTS
+from lib.price_panel import PricePanel
+from lib.storage import copy_storage, open_storage
+
+
+def migrate_history_command(db, args):
+    count = migrate_history(db, layout=args.layout)
+    print('Migrated {0} tickers to {1} history layout'.format(count, args.layout))
+
+
+def repair_watermarks_command(db, args):
+    count = repair_watermarks(db)
+    print('Rebuilt watermarks for {0} tickers'.format(count))
+
+
+def build_panel_command(db, args):
+    store = open_storage(args.storage).history
+    tickers = sorted(store.tickers())
+    PricePanel(args.path).build(store, tickers)
+    print('Built price panel of {0} tickers in {1}'.format(len(tickers), args.path))
+
+
+def copy_storage_command(db, args):
+    count = copy_storage(open_storage(args.source), open_storage(args.target))
+    print('Copied {0} ticker histories to {1}'.format(count, args.target))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s;%(levelname)s;%(message)s')
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command')
+
+    migrate = commands.add_parser('migrate-history', help='convert stored history to another layout')
+    migrate.add_argument('--layout', choices=sorted(LAYOUTS), default='bucketed')
+    migrate.set_defaults(func=migrate_history_command)
+
+    repair = commands.add_parser('repair-watermarks', help='rebuild per-ticker watermarks from stored history')
+    repair.set_defaults(func=repair_watermarks_command)
+
+    panel = commands.add_parser('build-panel', help='recreate the local price panel from stored history')
+    panel.add_argument('--path', default='panel')
+    panel.add_argument('--storage', metavar='URI', default=os.environ.get('DIVIDEND_STORAGE'))
+    panel.set_defaults(func=build_panel_command)
+
+    copy = commands.add_parser('copy-storage', help='copy companies and history to another storage backend')
+    copy.add_argument('target', metavar='URI', help='e.g. sqlite:///aristocrats.db')
+    copy.add_argument('--from', dest='source', metavar='URI', default=os.environ.get('DIVIDEND_STORAGE'),
+                      help='source backend, the local MongoDB server by default')
+    copy.set_defaults(func=copy_storage_command)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.error('no command given')
+    args.func(MongoClient().dividend_investing, args)
@@ -0,0 +1,75 @@
+'''Non-blocking data access for the asynchronous server, backed by a pooled Motor client'''
+import os
+import time
+import queries
+
+POOL_SETTINGS = {
+    'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 50)),
+    'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 5)),
+    'waitQueueTimeoutMS': int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000)),
+    'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+    'socketTimeoutMS': int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 10000))
+}
+
+
+def connect(uri=None, **settings):
+    '''Return the dividend_investing database of a new Motor client with the pool settings applied'''
+    from motor.motor_asyncio import AsyncIOMotorClient
+    options = dict(POOL_SETTINGS, **settings)
+    return AsyncIOMotorClient(uri or os.environ.get('MONGO_URI', 'mongodb://localhost:27017'), **options).dividend_investing
+
+
+class AsyncDB:
+    '''Async counterpart of db.py; takes any Motor-compatible database, so tests can pass an in-memory stand-in'''
+    def __init__(self, database):
+        self.db = database
+        self._history_layout = None
+        self._layout_checked = 0
+
+    async def get_companies(self):
+        return await self.db.companies.find(projection=queries.COMPANY_PROJECTION).to_list(None)
+
+    async def get_data_version(self):
+        stamps = []
+        for field in queries.VERSION_FIELDS:
+            latest = await self.db.companies.find_one(**queries.latest_stamp_query(field))
+            if latest:
+                stamps.append(latest[field])
+        return max(stamps) if stamps else None
+
+    async def get_company_data(self, ticker):
+        company = await self.db.companies.find_one({'ticker': ticker}, projection=queries.COMPANY_PROJECTION)
+        if company is None:
+            raise IndexError('No company data for {0}'.format(ticker))
+        return company
+
+    async def get_history_layout(self):
+        now = time.monotonic()
+        if self._history_layout is None or now - self._layout_checked > queries.LAYOUT_INTERVAL:
+            self._history_layout = queries.layout_of(await self.db.meta.find_one({'_id': 'historyLayout'}))
+            self._layout_checked = now
+        return self._history_layout
+
+    async def iter_historical_data(self, ticker, data_type='price', date_range='5'):
+        '''Yield price or dividend entries one by one straight from the database cursor'''
+        start_date = queries.start_date(date_range)
+        queries.check_data_type(data_type)
+
+        if await self.get_history_layout() == 'bucketed':
+            async for bucket in self.db.history_buckets.find(**queries.bucket_query(ticker, data_type, start_date)):
+                for item in queries.bucket_items([bucket], data_type, start_date):
+                    yield item
+        else:
+            async for document in self.db.history.aggregate(queries.history_items_pipeline(ticker, data_type, start_date)):
+                yield document['item']
+
+    async def get_historical_data(self, ticker, data_type='price', date_range='5'):
+        start_date = queries.start_date(date_range)
+        queries.check_data_type(data_type)
+
+        if await self.get_history_layout() == 'bucketed':
+            buckets = await self.db.history_buckets.find(**queries.bucket_query(ticker, data_type, start_date)).to_list(None)
+            return queries.bucketed_history(ticker, data_type, list(queries.bucket_items(buckets, data_type, start_date)))
+
+        history = await self.db.history.aggregate(queries.history_pipeline(ticker, data_type, start_date)).to_list(None)
+        return history[0]
@@ -0,0 +1,318 @@
+'''Asynchronous serving mode: same endpoints as server.py on aiohttp with a pooled Motor client,
+including streamed NDJSON history, conditional GETs on the data version and materialized payloads.
+
+Run with `python async_server.py`. Needs the aiohttp and motor packages. Pool and limits are set via
+MONGO_URI, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_WAIT_QUEUE_TIMEOUT_MS,
+MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS and MAX_IN_FLIGHT; GET /status shows them.'''
+import asyncio
+import calendar
+import datetime
+import hashlib
+import json
+import os
+import time
+from email.utils import formatdate
+from functools import wraps
+import jinja2
+from aiohttp import web
+import queries
+from async_db import AsyncDB, POOL_SETTINGS, connect
+from downsample import downsample_history, RESOLUTIONS
+from formats import FORMATS, to_columnar, ndjson_lines
+from metrics import EndpointMetrics, CONTENT_TYPE
+from payloads import PayloadStore, history_path
+from screen import CompanyIndex, ScreenError, parse_query
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# NDJSON lines written to the stream at once
+NDJSON_BATCH = 500
+templates = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(BASE_DIR, 'templates')), autoescape=True)
+
+
+class InFlight:
+    '''Bounded count of requests being served, plus how many are waiting for a slot'''
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+        self.peak = 0
+        self.served = 0
+
+    def status(self):
+        return {'limit': self.limit, 'active': self.active, 'waiting': self.waiting, 'peak': self.peak, 'served': self.served}
+
+
+@web.middleware
+async def limit_in_flight(request, handler):
+    in_flight = request.app['in_flight']
+    in_flight.waiting += 1
+    async with in_flight.semaphore:
+        in_flight.waiting -= 1
+        in_flight.active += 1
+        in_flight.peak = max(in_flight.peak, in_flight.active)
+        try:
+            return await handler(request)
+        finally:
+            in_flight.active -= 1
+            in_flight.served += 1
+
+
+@web.middleware
+async def record_latency(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route
+        endpoint = route.handler.__name__ if route.resource is not None else 'unmatched'
+        request.app['metrics'].observe(endpoint, status, time.perf_counter() - start)
+
+
+async def data_version(app):
+    '''Current data version (see db.get_data_version), polled at most once every version_interval seconds'''
+    now = time.monotonic()
+    if app['version_checked'] is None or now - app['version_checked'] > app['version_interval']:
+        app['version'] = await app['db'].get_data_version()
+        app['version_checked'] = now
+    return app['version']
+
+
+def conditional(handler):
+    '''Answer 304 when the client is up-to-date with the data version, like server.conditional.
+    The ETag and Last-Modified headers are set in add_conditional_headers, so streamed responses get them too.'''
+    @wraps(handler)
+    async def wrapper(request):
+        version = await data_version(request.app)
+        # Same tag as server.py, whose request.full_path always has the '?'
+        etag = hashlib.sha1('{0}|{1}?{2}'.format(version, request.path, request.query_string).encode('utf-8')).hexdigest()
+        # Pipeline stamps are naive local time, HTTP dates are UTC
+        last_modified = version.astimezone(datetime.timezone.utc).replace(microsecond=0) if version else None
+        request['version'] = version
+        request['conditional'] = (etag, last_modified)
+        since = request.if_modified_since
+        if any(match.value in (etag, '*') for match in request.if_none_match or ()) or (
+                not request.if_none_match and since and last_modified and last_modified <= since):
+            return web.Response(status=304)
+        return await handler(request)
+    return wrapper
+
+
+async def add_conditional_headers(request, response):
+    if 'conditional' not in request or response.status >= 400:
+        return
+    etag, last_modified = request['conditional']
+    # Weak, because gzip encoded and identity responses share it
+    response.headers['ETag'] = 'W/"{0}"'.format(etag)
+    # On 304s too, so caches keep the encodings apart
+    vary = response.headers.get('Vary')
+    if not vary:
+        response.headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        response.headers['Vary'] = vary + ', Accept-Encoding'
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+
+
+def send_payload(request, name, content_type):
+    '''Response sending the materialized gzip file of the current data version (see payloads.py),
+    None if there is none or the client does not accept gzip and the view has to answer live'''
+    payloads = request.app['payloads']
+    if payloads is None or 'gzip' not in request.headers.get('Accept-Encoding', '').lower():
+        return None
+    path = payloads.path(name, request['version'])
+    if path is None:
+        return None
+    return web.FileResponse(path, headers={'Content-Type': content_type, 'Content-Encoding': 'gzip'})
+
+
+def _json_default(value):
+    # Same date format as Flask's jsonify
+    if isinstance(value, datetime.datetime):
+        return formatdate(calendar.timegm(value.utctimetuple()), usegmt=True)
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
+
+
+def json_response(request, data):
+    response = web.Response(text=json.dumps(data, default=_json_default), content_type='application/json')
+    response.enable_compression()
+    return response
+
+
+def html_response(template, **context):
+    response = web.Response(text=templates.get_template(template).render(**context), content_type='text/html')
+    response.enable_compression()
+    return response
+
+
+async def main_page(request):
+    return html_response('index.html')
+
+
+@conditional
+async def info_data(request):
+    payload = send_payload(request, 'info/{0}.html'.format(request.match_info['ticker']), 'text/html')
+    if payload is not None:
+        return payload
+    try:
+        data = await request.app['db'].get_company_data(request.match_info['ticker'])
+    except IndexError:
+        raise web.HTTPNotFound()
+    return html_response('infopanel.html', data=data)
+
+
+@conditional
+async def detail_page(request):
+    ticker = request.match_info['ticker']
+    payload = send_payload(request, 'details/{0}.html'.format(ticker), 'text/html')
+    if payload is not None:
+        return payload
+    database = request.app['db']
+    try:
+        # Independent queries of the page run concurrently
+        current, history = await asyncio.gather(database.get_company_data(ticker), database.get_historical_data(ticker))
+    except IndexError:
+        raise web.HTTPNotFound()
+    return html_response('details.html', ticker=ticker, current=current, history=history)
+
+
+@conditional
+async def get_companies_data(request):
+    payload = send_payload(request, 'companies.json', 'application/json')
+    if payload is not None:
+        return payload
+    return json_response(request, await request.app['db'].get_companies())
+
+
+async def get_company_index(app):
+    '''Screening index of the company list, rebuilt when the data version changes (checked every few seconds)'''
+    version = await data_version(app)
+    if app['company_index'] is None or app['company_index'].version != version:
+        app['company_index'] = CompanyIndex(await app['db'].get_companies(), version)
+    return app['company_index']
+
+
+@conditional
+async def screen_companies(request):
+    try:
+        query = parse_query(request.query)
+    except ScreenError as e:
+        raise web.HTTPBadRequest(text=json.dumps({'error': str(e)}), content_type='application/json')
+    index = await get_company_index(request.app)
+    return json_response(request, index.screen(**query))
+
+
+async def stream_history(request, ticker, data_type, date_range, points, resolution):
+    '''NDJSON history written to the client while it is read, compressed on the fly if the client accepts gzip'''
+    queries.check_data_type(data_type)
+    database = request.app['db']
+    items = None
+    if points or resolution:
+        try:
+            data = await database.get_historical_data(ticker, data_type, date_range)
+        except IndexError:
+            raise web.HTTPNotFound()
+        items = downsample_history(data, data_type, points, resolution)[data_type]
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    response.enable_compression()
+    await response.prepare(request)
+    if items is not None:
+        for start in range(0, len(items), NDJSON_BATCH):
+            await response.write(''.join(ndjson_lines(items[start:start + NDJSON_BATCH])).encode('utf-8'))
+    else:
+        lines = []
+        async for item in database.iter_historical_data(ticker, data_type, date_range):
+            lines.extend(ndjson_lines([item]))
+            if len(lines) >= NDJSON_BATCH:
+                await response.write(''.join(lines).encode('utf-8'))
+                lines = []
+        if lines:
+            await response.write(''.join(lines).encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+@conditional
+async def get_history(request):
+    ticker = request.match_info['ticker']
+    name = history_path(ticker, request.query)
+    payload = send_payload(request, name, 'application/json') if name else None
+    if payload is not None:
+        return payload
+    data_type = request.query.get('type')
+    date_range = request.query.get('range')
+    resolution = request.query.get('resolution')
+    response_format = request.query.get('format', 'json')
+    try:
+        points = int(request.query['points']) if 'points' in request.query else None
+    except ValueError:
+        points = None
+    if (resolution and resolution not in RESOLUTIONS) or response_format not in FORMATS or (
+            points is not None and points < 1):
+        raise web.HTTPBadRequest()
+    if not data_type:
+        raise web.HTTPNotFound()
+    if response_format == 'ndjson':
+        return await stream_history(request, ticker, data_type, date_range, points, resolution)
+    try:
+        data = await request.app['db'].get_historical_data(ticker, data_type, date_range)
+    except IndexError:
+        raise web.HTTPNotFound()
+    data = downsample_history(data, data_type, points, resolution)
+    if response_format == 'columnar':
+        data = to_columnar(data, data_type)
+    return json_response(request, data)
+
+
+async def get_metrics(request):
+    return web.Response(body=request.app['metrics'].to_prometheus().encode('utf-8'),
+                        headers={'Content-Type': CONTENT_TYPE})
+
+
+async def status(request):
+    return json_response(request, {
+        'inFlight': request.app['in_flight'].status(),
+        'pool': request.app['pool_settings']
+    })
+
+
+def create_app(database=None, max_in_flight=None, pool_settings=None, payload_dir=None):
+    '''Build the application; pass an in-memory Motor-compatible database for testing.
+    Payloads are read from payload_dir (PAYLOAD_DIR by default, an empty string disables them).'''
+    pool_settings = dict(POOL_SETTINGS, **(pool_settings or {}))
+    app = web.Application(middlewares=[record_latency, limit_in_flight])
+    app['metrics'] = EndpointMetrics(enabled=os.environ.get('SERVER_METRICS', '1') != '0')
+    app['company_index'] = None
+    app['version'] = None
+    app['version_checked'] = None
+    app['version_interval'] = 5
+    if payload_dir is None:
+        payload_dir = os.environ.get('PAYLOAD_DIR', os.path.join(BASE_DIR, 'payloads'))
+    app['payloads'] = PayloadStore(payload_dir) if payload_dir else None
+    app['db'] = AsyncDB(database if database is not None else connect(**pool_settings))
+    app['pool_settings'] = pool_settings
+    app['in_flight'] = InFlight(max_in_flight or int(os.environ.get('MAX_IN_FLIGHT', 100)))
+    app.on_response_prepare.append(add_conditional_headers)
+    app.router.add_get('/', main_page)
+    app.router.add_get('/info/{ticker}', info_data)
+    app.router.add_get('/details/{ticker}', detail_page)
+    app.router.add_get('/data/companies', get_companies_data)
+    app.router.add_get('/data/screen', screen_companies)
+    app.router.add_get('/data/history/{ticker}', get_history)
+    app.router.add_get('/status', status)
+    app.router.add_get('/metrics', get_metrics)
+    if os.path.isdir(os.path.join(BASE_DIR, 'dist')):
+        app.router.add_static('/dist', os.path.join(BASE_DIR, 'dist'))
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,64 @@
+'''In-process LRU/TTL cache for database reads, invalidated when the pipeline writes new data'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    def __init__(self, version_loader, max_entries=512, ttl=3600, version_interval=5):
+        '''version_loader returns the current data version (e.g. latest lastUpdated stamp);
+        it is called at most once every version_interval seconds'''
+        self.version_loader = version_loader
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_interval = version_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked = None
+        self.hits = 0
+        self.misses = 0
+
+    def version(self):
+        now = time.monotonic()
+        # An empty database has no version either, so the check time alone decides when to poll again
+        if self._version_checked is None or now - self._version_checked > self.version_interval:
+            version = self.version_loader()
+            with self._lock:
+                if version != self._version:
+                    self._entries.clear()
+                self._version = version
+                self._version_checked = now
+        return self._version
+
+    def get(self, key, loader):
+        '''Return the cached value for key or load, store and return it'''
+        version = self.version()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+        value = loader()
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (version, now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+            self._version_checked = None
+
+    def wrap(self, function):
+        '''Cached version of function, keyed by its name and arguments'''
+        def cached(*args):
+            return self.get((function.__name__,) + args, lambda: function(*args))
+        cached.__name__ = function.__name__
+        return cached
@@ -1,74 +1,68 @@
-import datetime
+import time
 from pymongo import MongoClient
+from panel import get_panel_slice
+import queries
 db = MongoClient().dividend_investing
+_history_layout = None
+_layout_checked = 0
 
 
 def get_companies():
-    companies = db.companies.find(projection={'_id': 0})
+    companies = db.companies.find(projection=queries.COMPANY_PROJECTION)
     return list(companies)
 
 
+def get_data_version():
+    '''Latest pipeline stamp on the company list (profile update, list download or dividend growth update)'''
+    stamps = []
+    for field in queries.VERSION_FIELDS:
+        latest = db.companies.find_one(**queries.latest_stamp_query(field))
+        if latest:
+            stamps.append(latest[field])
+    return max(stamps) if stamps else None
+
+
 def get_company_data(ticker):
-    company = db.companies.find(filter={'ticker': ticker}, projection={'_id': 0})
+    company = db.companies.find(filter={'ticker': ticker}, projection=queries.COMPANY_PROJECTION)
     return list(company)[0]
 
 
-def get_historical_data(ticker, data_type='price', date_range='5'):
-    today = datetime.datetime.today()
-    try:
-        count_years = int(date_range)
-    except Exception:
-        count_years = 5
-
-    start_date = datetime.datetime(today.year - count_years, today.month, today.day)
-
-    if data_type == 'price':
-        history = db.history.aggregate([
-            {'$match': {'ticker': ticker}},
-            {'$project': {
-                '_id': 1,
-                'price': '$daily',
-                'ticker': 1
-            }},
-            {'$unwind': '$price'},
-            {'$match': {'price.date': {'$gte': start_date}}},
-            {'$group': {
-                '_id': {
-                    'id': '$_id',
-                    'ticker': '$ticker'
-                },
-                'price': {'$push': '$price'},
-            }},
-            {'$project': {
-                '_id': 0,
-                'ticker': '$_id.ticker',
-                'price': 1
-            }}
-        ])
-    elif data_type == 'dividend':
-        history = db.history.aggregate([
-            {'$match': {'ticker': ticker}},
-            {'$project': {
-                '_id': 1,
-                'dividend': 1,
-                'ticker': 1
-            }},
-            {'$unwind': '$dividend'},
-            {'$match': {'dividend.date': {'$gte': start_date}}},
-            {'$group': {
-                '_id': {
-                    'id': '$_id',
-                    'ticker': '$ticker'
-                },
-                'dividend': {'$push': '$dividend'}
-            }},
-            {'$project': {
-                '_id': 0,
-                'ticker': '$_id.ticker',
-                'dividend': 1
-            }}
-        ])
+def get_history_layout():
+    '''Layout of the history data as recorded by the data pipeline (single or bucketed)'''
+    global _history_layout, _layout_checked
+    now = time.monotonic()
+    if _history_layout is None or now - _layout_checked > queries.LAYOUT_INTERVAL:
+        _history_layout = queries.layout_of(db.meta.find_one({'_id': 'historyLayout'}))
+        _layout_checked = now
+    return _history_layout
+
+
+def iter_historical_data(ticker, data_type='price', date_range='5'):
+    '''Yield price or dividend entries one by one straight from the database cursor'''
+    start_date = queries.start_date(date_range)
+    queries.check_data_type(data_type)
+
+    if get_history_layout() == 'bucketed':
+        buckets = db.history_buckets.find(**queries.bucket_query(ticker, data_type, start_date))
+        for item in queries.bucket_items(buckets, data_type, start_date):
+            yield item
     else:
-        raise Exception('Invalid data type parameter')
+        for document in db.history.aggregate(queries.history_items_pipeline(ticker, data_type, start_date)):
+            yield document['item']
 
+
+def get_historical_data(ticker, data_type='price', date_range='5'):
+    start_date = queries.start_date(date_range)
+    queries.check_data_type(data_type)
+
+    if get_history_layout() == 'bucketed':
+        buckets = db.history_buckets.find(**queries.bucket_query(ticker, data_type, start_date))
+        return queries.bucketed_history(ticker, data_type, list(queries.bucket_items(buckets, data_type, start_date)))
+
+    history = db.history.aggregate(queries.history_pipeline(ticker, data_type, start_date))
     return list(history)[0]
+
+
+def get_panel_data(ticker, date_range='5'):
+    '''Price panel arrays of the ticker for the last date_range years, without a database query'''
+    return get_panel_slice(ticker, queries.start_date(date_range))
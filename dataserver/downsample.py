@@ -0,0 +1,78 @@
+'''Server-side downsampling of daily price history for charts'''
+import numpy as np
+
+RESOLUTIONS = ('weekly', 'monthly')
+
+
+def lttb_indices(x, y, threshold):
+    '''Indices of the points kept by Largest-Triangle-Three-Buckets downsampling to threshold points'''
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # First and last points are always kept, the rest is split into threshold - 2 buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs((x[previous] - avg_x) * (y[start:end] - y[previous]) -
+                      (x[previous] - x[start:end]) * (avg_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        selected[i + 1] = previous
+    return selected
+
+
+def lttb(items, points, fields=('adjClose', 'divYield')):
+    '''Keep the union of the LTTB points of every field, so each series keeps its shape.
+    The point budget is split between the fields, so at most `points` items are returned.
+    Budgets too small for LTTB (under 3 points per field) keep evenly spaced items instead.'''
+    if points < 1:
+        raise ValueError('Invalid number of points: {0}'.format(points))
+    if len(items) <= points:
+        return items
+    budget = points // len(fields)
+    if budget < 3:
+        indices = np.unique(np.linspace(0, len(items) - 1, points).round().astype(int))
+        return [items[i] for i in indices]
+    x = np.array([item['date'].timestamp() for item in items])
+    keep = set()
+    for field in fields:
+        y = np.array([item.get(field) for item in items], dtype=float)
+        y = np.where(np.isfinite(y), y, 0)
+        keep.update(lttb_indices(x, y, budget).tolist())
+    return [items[i] for i in sorted(keep)]
+
+
+def aggregate(items, resolution):
+    '''Keep the last trading day of every week or month'''
+    if resolution == 'weekly':
+        period = lambda date: date.isocalendar()[:2]
+    elif resolution == 'monthly':
+        period = lambda date: (date.year, date.month)
+    else:
+        raise ValueError('Invalid resolution: {0}'.format(resolution))
+    result = []
+    for item in items:
+        if result and period(result[-1]['date']) == period(item['date']):
+            result[-1] = item
+        else:
+            result.append(item)
+    return result
+
+
+def downsample_history(data, data_type, points=None, resolution=None):
+    '''Downsample a price history document; dividend events are always returned intact'''
+    if data_type != 'price' or (not points and not resolution):
+        return data
+    items = sorted(data['price'], key=lambda item: item['date'])
+    if resolution:
+        items = aggregate(items, resolution)
+    if points:
+        items = lttb(items, points)
+    return dict(data, price=items)
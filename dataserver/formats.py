@@ -0,0 +1,62 @@
+'''Compact response formats for history endpoints and gzip encoding'''
+import calendar
+import gzip
+import zlib
+from flask import json
+
+FORMATS = ('json', 'columnar', 'ndjson')
+FIELDS = {
+    'price': ('adjClose', 'lastDivAnnual', 'divYield'),
+    'dividend': ('dividend',)
+}
+MIN_COMPRESS_SIZE = 500
+
+
+def epoch_ms(date):
+    return calendar.timegm(date.utctimetuple()) * 1000 + date.microsecond // 1000
+
+
+def to_columnar(data, data_type):
+    '''Parallel arrays instead of one dict per row: dates as epoch milliseconds plus one array per field'''
+    items = data[data_type]
+    columns = {
+        'ticker': data['ticker'],
+        'type': data_type,
+        'date': [epoch_ms(item['date']) for item in items]
+    }
+    for field in FIELDS[data_type]:
+        columns[field] = [item.get(field) for item in items]
+    return columns
+
+
+def ndjson_lines(items):
+    '''One JSON document per line, dates as epoch milliseconds'''
+    for item in items:
+        yield json.dumps(dict(item, date=epoch_ms(item['date']))) + '\n'
+
+
+def accepts_gzip(request):
+    return 'gzip' in request.accept_encodings
+
+
+def gzip_stream(chunks):
+    '''Compress a stream of text chunks into a gzip stream'''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gzip_response(response):
+    '''Compress a buffered response body in place if it is worth it'''
+    if response.direct_passthrough or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+    response.set_data(gzip.compress(body, 6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
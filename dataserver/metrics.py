@@ -0,0 +1,50 @@
+'''Per-endpoint request latency histograms in Prometheus text format'''
+import threading
+
+# Upper bounds in seconds of the latency buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class EndpointMetrics:
+    def __init__(self, enabled=True, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # endpoint -> [bucket counts..., count, sum]
+        self._latency = {}
+        # (endpoint, status) -> count
+        self._responses = {}
+
+    def observe(self, endpoint, status, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            series = self._latency.get(endpoint)
+            if series is None:
+                series = self._latency[endpoint] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += 1
+            series[-1] += seconds
+            key = (endpoint, status)
+            self._responses[key] = self._responses.get(key, 0) + 1
+
+    def to_prometheus(self, prefix='dataserver'):
+        lines = ['# HELP {0}_request_seconds Request latency by endpoint'.format(prefix),
+                 '# TYPE {0}_request_seconds histogram'.format(prefix)]
+        with self._lock:
+            for endpoint, series in sorted(self._latency.items()):
+                total = 0
+                for bound, count in zip(self.buckets, series):
+                    total += count
+                    lines.append('{0}_request_seconds_bucket{{endpoint="{1}",le="{2}"}} {3}'.format(prefix, endpoint, bound, total))
+                lines.append('{0}_request_seconds_bucket{{endpoint="{1}",le="+Inf"}} {2}'.format(prefix, endpoint, series[-2]))
+                lines.append('{0}_request_seconds_sum{{endpoint="{1}"}} {2}'.format(prefix, endpoint, series[-1]))
+                lines.append('{0}_request_seconds_count{{endpoint="{1}"}} {2}'.format(prefix, endpoint, series[-2]))
+            lines += ['# TYPE {0}_responses_total counter'.format(prefix)]
+            for (endpoint, status), count in sorted(self._responses.items()):
+                lines.append('{0}_responses_total{{endpoint="{1}",status="{2}"}} {3}'.format(prefix, endpoint, status, count))
+        return '\n'.join(lines) + '\n'
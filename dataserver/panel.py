@@ -0,0 +1,42 @@
+'''Read-only access to the memory-mapped price panel maintained by the data pipeline
+(see datahandler/lib/price_panel.py for the file layout)'''
+import json
+import os
+import numpy as np
+
+PANEL_PATH = os.environ.get('PRICE_PANEL_PATH', os.path.join(os.path.dirname(__file__), '..', 'datahandler', 'panel'))
+FIELDS = ('adjClose', 'divYield', 'dividend')
+
+
+def _load_meta():
+    with open(os.path.join(PANEL_PATH, 'meta.json')) as f:
+        return json.load(f)
+
+
+def _map(meta, name, dtype, shape):
+    path = os.path.join(PANEL_PATH, 'gen-{0}'.format(meta['generation']), name + '.bin')
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+def get_panel_slice(ticker, start_date=None, end_date=None, fields=FIELDS):
+    '''Dates and field arrays of the ticker between start_date and end_date as zero-copy views,
+    or None if there is no panel or the ticker is not in it'''
+    try:
+        meta = _load_meta()
+        column = meta['tickers'].index(ticker)
+    except (IOError, ValueError):
+        return None
+    if meta['days'] == 0:
+        return None
+    try:
+        dates = _map(meta, 'dates', 'datetime64[D]', (meta['days'],))
+        columns = {name: _map(meta, name, 'float64', (meta['days'], meta['capacity'])) for name in fields}
+    except (IOError, OSError, ValueError):
+        # The pipeline swapped generations since meta.json was read, the caller falls back to the database
+        return None
+    lo = 0 if start_date is None else np.searchsorted(dates, np.datetime64(start_date, 'D'), side='left')
+    hi = len(dates) if end_date is None else np.searchsorted(dates, np.datetime64(end_date, 'D'), side='right')
+    data = {'date': dates[lo:hi]}
+    for name in fields:
+        data[name] = columns[name][lo:hi, column]
+    return data
@@ -0,0 +1,147 @@
+'''Precompressed dashboard payloads materialized at the end of a pipeline run.
+
+For every company the info panel and details fragments and the /data/history JSON of the standard
+types and ranges, plus the company list, are rendered through the server's own routes once, gzipped
+and written to a directory named after the data version. manifest.json, replaced atomically when
+all files are written, points to the current directory. server.py sends these files from disk as
+long as the manifest matches the data version and falls back to live queries otherwise.
+
+    python payloads.py DIR    materialize the payloads of the current data into DIR'''
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+HISTORY_TYPES = ('price', 'dividend')
+HISTORY_RANGES = ('1', '5', '10', '20')
+# /data/history without a range or with a non-integer one returns the default 5 years (see queries.start_date)
+DEFAULT_RANGE = '5'
+MANIFEST = 'manifest.json'
+SAFE_NAME = re.compile(r'^[\w^\-][\w.^\-]*$')
+
+
+def payload_paths(ticker):
+    '''(relative file path, request URL) of the payloads of one company'''
+    paths = [
+        ('info/{0}.html'.format(ticker), '/info/{0}'.format(ticker)),
+        ('details/{0}.html'.format(ticker), '/details/{0}'.format(ticker))
+    ]
+    for data_type in HISTORY_TYPES:
+        for date_range in HISTORY_RANGES:
+            paths.append(('history/{0}/{1}-{2}.json'.format(ticker, data_type, date_range),
+                          '/data/history/{0}?type={1}&range={2}'.format(ticker, data_type, date_range)))
+    return paths
+
+
+def history_path(ticker, args):
+    '''Relative file path of a /data/history request or None if it is not a materialized one'''
+    if set(args) - {'type', 'range', 'format'} or args.get('format', 'json') != 'json':
+        return None
+    data_type = args.get('type')
+    try:
+        date_range = str(int(args['range']))
+    except (KeyError, ValueError):
+        date_range = DEFAULT_RANGE
+    if data_type not in HISTORY_TYPES or date_range not in HISTORY_RANGES:
+        return None
+    return 'history/{0}/{1}-{2}.json'.format(ticker, data_type, date_range)
+
+
+class PayloadStore:
+    '''Reader of the current payload directory, rereading the manifest at most once every manifest_interval seconds'''
+    def __init__(self, directory, manifest_interval=5):
+        self.directory = directory
+        self.manifest_interval = manifest_interval
+        self._lock = threading.Lock()
+        self._manifest = None
+        self._mtime = None
+        self._checked = 0
+
+    def manifest(self):
+        now = time.monotonic()
+        if now - self._checked > self.manifest_interval:
+            path = os.path.join(self.directory, MANIFEST)
+            try:
+                mtime = os.stat(path).st_mtime
+                manifest = self._manifest
+                if mtime != self._mtime:
+                    with open(path) as f:
+                        manifest = json.load(f)
+            except (OSError, ValueError):
+                mtime, manifest = None, None
+            with self._lock:
+                self._manifest, self._mtime, self._checked = manifest, mtime, now
+        return self._manifest
+
+    def path(self, name, version):
+        '''Absolute path of the gzipped payload for the data version or None if there is none'''
+        manifest = self.manifest()
+        if manifest is None or manifest['version'] != str(version) or not all(
+                SAFE_NAME.match(part) for part in name.split('/')):
+            return None
+        path = os.path.join(self.directory, manifest['path'], name + '.gz')
+        return path if os.path.isfile(path) else None
+
+
+def _write(path, body):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(gzip.compress(body, 9))
+
+
+def materialize(app, db, directory):
+    '''Render and save the payloads of every company for the current data version through the app's
+    routes, then switch the manifest to them. Returns the number of files written.'''
+    version = db.get_data_version()
+    # A new directory on every run: a rerun on unchanged data must not rewrite the files the manifest points to
+    os.makedirs(directory, exist_ok=True)
+    target = tempfile.mkdtemp(prefix=(version.strftime('%Y%m%dT%H%M%S%f') if version else 'empty') + '-', dir=directory)
+    os.chmod(target, 0o755)
+    name = os.path.basename(target)
+
+    client = app.test_client()
+    paths = [('companies.json', '/data/companies')]
+    for company in db.get_companies():
+        if SAFE_NAME.match(company['ticker']):
+            paths.extend(payload_paths(company['ticker']))
+    count = 0
+    for path, url in paths:
+        response = client.get(url)
+        if response.status_code != 200:
+            logging.warning('Cannot materialize {0}: status {1}'.format(url, response.status_code))
+            continue
+        _write(os.path.join(target, path + '.gz'), response.get_data())
+        count += 1
+
+    manifest = {'version': str(version), 'path': name, 'files': count, 'created': datetime.now().isoformat()}
+    previous = os.path.join(directory, MANIFEST)
+    old = None
+    if os.path.isfile(previous):
+        with open(previous) as f:
+            old = json.load(f).get('path')
+    with open(previous + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(previous + '.tmp', previous)
+
+    # Keep the previous version for requests that are still reading it
+    for entry in os.listdir(directory):
+        if entry not in (name, old, MANIFEST) and os.path.isdir(os.path.join(directory, entry)):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    return count
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s;%(levelname)s;%(message)s')
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    os.environ['PAYLOAD_DIR'] = ''
+    from server import app, db
+    count = materialize(app, db, os.path.abspath(sys.argv[1]))
+    print('Materialized {0} payloads in {1}'.format(count, sys.argv[1]))
@@ -0,0 +1,96 @@
+'''Query definitions shared by the synchronous (db.py) and asynchronous (async_db.py) data access'''
+import datetime
+
+DATA_TYPES = ('price', 'dividend')
+COMPANY_PROJECTION = {'_id': 0}
+VERSION_FIELDS = ('lastUpdated', 'downloaded', 'growthUpdated')
+# Seconds between rereads of the history layout, so a running server follows manage.py migrate-history
+LAYOUT_INTERVAL = 5
+
+
+def start_date(date_range):
+    '''Start of the date_range years long period ending today (5 years if the range is invalid)'''
+    today = datetime.datetime.today()
+    try:
+        count_years = int(date_range)
+    except Exception:
+        count_years = 5
+
+    return datetime.datetime(today.year - count_years, today.month, today.day)
+
+
+def check_data_type(data_type):
+    if data_type not in DATA_TYPES:
+        raise Exception('Invalid data type parameter')
+
+
+def history_pipeline(ticker, data_type, start):
+    '''Aggregation returning {ticker, <data_type>: [entries since start]} from the single document layout'''
+    return [
+        {'$match': {'ticker': ticker}},
+        {'$project': {
+            '_id': 1,
+            data_type: 1,
+            'ticker': 1
+        }},
+        {'$unwind': '$' + data_type},
+        {'$match': {data_type + '.date': {'$gte': start}}},
+        {'$group': {
+            '_id': {
+                'id': '$_id',
+                'ticker': '$ticker'
+            },
+            data_type: {'$push': '$' + data_type},
+        }},
+        {'$project': {
+            '_id': 0,
+            'ticker': '$_id.ticker',
+            data_type: 1
+        }}
+    ]
+
+
+def history_items_pipeline(ticker, data_type, start):
+    '''Aggregation returning one {item} document per entry since start from the single document layout'''
+    return [
+        {'$match': {'ticker': ticker}},
+        {'$project': {'_id': 0, 'item': '$' + data_type}},
+        {'$unwind': '$item'},
+        {'$match': {'item.date': {'$gte': start}}}
+    ]
+
+
+def bucket_query(ticker, data_type, start):
+    '''find() arguments selecting the history buckets that overlap the period since start'''
+    return {
+        'filter': {'ticker': ticker, 'maxDate': {'$gte': start}},
+        'projection': {'_id': 0, data_type: 1},
+        'sort': [('year', 1)]
+    }
+
+
+def bucket_items(buckets, data_type, start):
+    '''Entries since start from an iterable of history buckets'''
+    for bucket in buckets:
+        for item in bucket.get(data_type, []):
+            if item['date'] >= start:
+                yield item
+
+
+def bucketed_history(ticker, data_type, items):
+    if not items:
+        raise IndexError('No {0} history for {1}'.format(data_type, ticker))
+    return {'ticker': ticker, data_type: items}
+
+
+def layout_of(setting):
+    return (setting or {}).get('layout', 'single')
+
+
+def latest_stamp_query(field):
+    '''find_one() arguments for the latest value of a pipeline time stamp in the companies collection'''
+    return {
+        'filter': {field: {'$ne': None}},
+        'projection': {'_id': 0, field: 1},
+        'sort': [(field, -1)]
+    }
@@ -0,0 +1,175 @@
+'''In-memory columnar index of the company list for server-side screening.
+
+Every numeric screening field is kept as a float array with its sort order, so a range filter is
+two binary searches and sorting a result reuses precomputed ranks instead of comparing documents.
+The index is rebuilt from scratch whenever the data version (latest lastUpdated/downloaded/growthUpdated) changes.'''
+import math
+import numpy as np
+
+NUMERIC_FIELDS = (
+    'divYield', 'payout', 'annualDividend', 'EPS', 'divRaiseYrs', 'divg1y', 'divg3y', 'divg5y', 'divg10y',
+    'yieldStats.5y.zScore', 'yieldStats.5y.percentileRank', 'yieldStats.10y.zScore', 'yieldStats.10y.percentileRank',
+    'dividendGrowth.ttm', 'dividendGrowth.forwardAnnual', 'dividendGrowth.cagr1y', 'dividendGrowth.cagr3y',
+    'dividendGrowth.cagr5y', 'dividendGrowth.cagr10y', 'dividendGrowth.raiseStreak'
+)
+TEXT_FIELDS = ('ticker', 'name', 'category', 'industry')
+CATEGORY_FIELDS = ('category', 'industry')
+DEFAULT_FIELDS = ('ticker', 'name', 'category', 'industry', 'divYield', 'payout', 'divRaiseYrs')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+class ScreenError(ValueError):
+    '''Invalid screening query'''
+
+
+def field_value(document, path):
+    '''Value of a dotted field path (e.g. yieldStats.5y.zScore) or None'''
+    for key in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return number if math.isfinite(number) else math.nan
+
+
+class CompanyIndex:
+    def __init__(self, companies, version=None):
+        self.version = version
+        self.companies = [{key: value for key, value in company.items() if key != '_id'} for company in companies]
+        self.size = len(self.companies)
+        self.values = {}
+        self.sorted = {}
+        # Ascending position of every row by field, missing values ranked last
+        self.ranks = {}
+        for field in NUMERIC_FIELDS:
+            values = np.array([_number(field_value(company, field)) for company in self.companies], dtype=float)
+            order = np.argsort(values, kind='mergesort')
+            valid = int(np.count_nonzero(~np.isnan(values)))
+            self.values[field] = values
+            self.sorted[field] = (values[order[:valid]], order)
+            self.ranks[field] = self._ranks(order, values)
+        for field in TEXT_FIELDS:
+            keys = np.array([str(field_value(company, field) or '').lower() for company in self.companies], dtype=object)
+            order = np.argsort(keys, kind='mergesort')
+            self.ranks[field] = self._ranks(order, keys)
+        self.categories = {}
+        for field in CATEGORY_FIELDS:
+            rows = {}
+            for row, company in enumerate(self.companies):
+                rows.setdefault(str(field_value(company, field)).lower(), []).append(row)
+            self.categories[field] = {value: np.array(indexes) for value, indexes in rows.items()}
+
+    def _ranks(self, order, keys):
+        '''Position of every row in the sort order, equal keys sharing the position of the first one,
+        so the next sort key decides between them'''
+        positions = np.arange(self.size)
+        ordered = keys[order]
+        first = np.ones(self.size, dtype=bool)
+        first[1:] = ordered[1:] != ordered[:-1]
+        ranks = np.empty(self.size, dtype=np.int64)
+        ranks[order] = np.maximum.accumulate(np.where(first, positions, 0))
+        return ranks
+
+    def _range_mask(self, field, low, high):
+        values, order = self.sorted[field]
+        start = 0 if low is None else np.searchsorted(values, low, side='left')
+        end = len(values) if high is None else np.searchsorted(values, high, side='right')
+        mask = np.zeros(self.size, dtype=bool)
+        mask[order[start:end]] = True
+        return mask
+
+    def _category_mask(self, field, choices):
+        mask = np.zeros(self.size, dtype=bool)
+        for choice in choices:
+            rows = self.categories[field].get(choice.lower())
+            if rows is not None:
+                mask[rows] = True
+        return mask
+
+    def _sort_rank(self, field, descending):
+        ranks = self.ranks[field]
+        if not descending:
+            return ranks
+        if field in self.sorted:
+            # Reverse the valid values only, so missing values stay at the end
+            valid = len(self.sorted[field][0])
+            return np.where(ranks < valid, valid - 1 - ranks, ranks)
+        return self.size - 1 - ranks
+
+    def screen(self, ranges=None, categories=None, sort=None, fields=DEFAULT_FIELDS, offset=0, limit=DEFAULT_LIMIT):
+        '''Companies matching every range ({field: (low, high)}, None for open ends) and category choice
+        ({field: [values]}), ordered by the sort keys ([(field, descending)]), one page of the projected fields'''
+        mask = np.ones(self.size, dtype=bool)
+        for field, (low, high) in (ranges or {}).items():
+            mask &= self._range_mask(field, low, high)
+        for field, choices in (categories or {}).items():
+            mask &= self._category_mask(field, choices)
+        rows = np.flatnonzero(mask)
+
+        sort = sort or [('ticker', False)]
+        # lexsort uses the last key as the primary one
+        order = np.lexsort([self._sort_rank(field, descending)[rows] for field, descending in reversed(sort)])
+        page = rows[order[offset:offset + limit]]
+        return {
+            'total': int(len(rows)),
+            'offset': offset,
+            'limit': limit,
+            'items': [{field: field_value(self.companies[row], field) for field in fields} for row in page]
+        }
+
+
+def parse_query(args):
+    '''screen() keyword arguments from request arguments:
+    min_<field>/max_<field> (numeric fields), category/industry (comma separated),
+    sort (comma separated, - prefix for descending), fields (comma separated), offset, limit'''
+    def numbers(name):
+        try:
+            return float(args[name]) if name in args else None
+        except ValueError:
+            raise ScreenError('{0} must be a number'.format(name))
+
+    def names(name):
+        return [value.strip() for value in args.get(name, '').split(',') if value.strip()]
+
+    ranges = {}
+    for field in NUMERIC_FIELDS:
+        low, high = numbers('min_' + field), numbers('max_' + field)
+        if low is not None or high is not None:
+            ranges[field] = (low, high)
+    unknown = [name for name in args if name.startswith(('min_', 'max_')) and name[4:] not in NUMERIC_FIELDS]
+    if unknown:
+        raise ScreenError('Cannot filter by {0}'.format(', '.join(sorted(unknown))))
+
+    categories = {field: names(field) for field in CATEGORY_FIELDS if names(field)}
+
+    sort = []
+    for key in names('sort'):
+        field = key.lstrip('-+')
+        if field not in NUMERIC_FIELDS and field not in TEXT_FIELDS:
+            raise ScreenError('Cannot sort by {0}'.format(field))
+        sort.append((field, key.startswith('-')))
+
+    try:
+        offset = int(args.get('offset', 0))
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ScreenError('offset and limit must be integers')
+    if offset < 0 or not 0 < limit <= MAX_LIMIT:
+        raise ScreenError('offset must not be negative, limit must be between 1 and {0}'.format(MAX_LIMIT))
+
+    return {
+        'ranges': ranges,
+        'categories': categories,
+        'sort': sort,
+        'fields': names('fields') or DEFAULT_FIELDS,
+        'offset': offset,
+        'limit': limit
+    }
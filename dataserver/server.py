@@ -1,7 +1,124 @@
-from flask import Flask, request, abort, render_template, json
-from db import get_company_data, get_historical_data, get_companies
+import hashlib
+import os
+import time
+from datetime import timezone
+from functools import wraps
+from flask import Flask, Response, g, request, abort, render_template, json, make_response, send_file, stream_with_context
+if os.environ.get('DIVIDEND_STORAGE', '').startswith('sqlite:///'):
+    import sql_db as db
+else:
+    import db
+from cache import ResponseCache
+from downsample import downsample_history, RESOLUTIONS
+from formats import FORMATS, to_columnar, ndjson_lines, accepts_gzip, gzip_stream, gzip_response
+from metrics import EndpointMetrics, CONTENT_TYPE
+from payloads import PayloadStore, history_path
+from screen import CompanyIndex, ScreenError, parse_query
 
 app = Flask(__name__, static_folder='dist')
+# Let the front server (nginx, Apache) send payload files instead of the worker
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+cache = ResponseCache(
+    db.get_data_version,
+    max_entries=int(os.environ.get('RESPONSE_CACHE_SIZE', 512)),
+    ttl=int(os.environ.get('RESPONSE_CACHE_TTL', 3600)))
+get_companies = cache.wrap(db.get_companies)
+get_company_data = cache.wrap(db.get_company_data)
+get_historical_data = cache.wrap(db.get_historical_data)
+metrics = EndpointMetrics(enabled=os.environ.get('SERVER_METRICS', '1') != '0')
+_payload_dir = os.environ.get('PAYLOAD_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads'))
+payloads = PayloadStore(_payload_dir) if _payload_dir else None
+
+
+def get_chart_history(ticker, data_type, date_range, points, resolution):
+    return downsample_history(get_historical_data(ticker, data_type, date_range), data_type, points, resolution)
+
+
+get_chart_history = cache.wrap(get_chart_history)
+_company_index = None
+
+
+def get_company_index():
+    '''Screening index of the company list, rebuilt when the data version changes'''
+    global _company_index
+    version = cache.version()
+    if _company_index is None or _company_index.version != version:
+        _company_index = CompanyIndex(db.get_companies(), version)
+    return _company_index
+
+
+def send_payload(name, mimetype):
+    '''Response sending the materialized gzip file of the current data version (see payloads.py),
+    None if there is none or the client does not accept gzip and the view has to answer live'''
+    if payloads is None or not accepts_gzip(request):
+        return None
+    path = payloads.path(name, cache.version())
+    if path is None:
+        return None
+    response = send_file(path, mimetype=mimetype, conditional=False)
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    # Revalidated through the data version ETag like live responses
+    response.cache_control.public = False
+    response.cache_control.max_age = None
+    return response
+
+
+def conditional(view):
+    '''Add ETag/Last-Modified based on the data version and answer 304 when the client is up-to-date'''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version = cache.version()
+        etag = hashlib.sha1('{0}|{1}'.format(version, request.full_path).encode('utf-8')).hexdigest()
+        # Pipeline stamps are naive local time, HTTP dates are UTC
+        last_modified = version.astimezone(timezone.utc).replace(tzinfo=None, microsecond=0) if version else None
+        since = request.if_modified_since
+        if request.if_none_match.contains_weak(etag) or (
+                not request.if_none_match and since and last_modified and last_modified <= since.replace(tzinfo=None)):
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+        # Weak, because gzip encoded and identity responses share it
+        response.set_etag(etag, weak=True)
+        # On 304s too, so caches keep the encodings apart
+        response.vary.add('Accept-Encoding')
+        if last_modified:
+            response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+# Registered before compress, so it runs after it and the latency includes compression
+# (streamed responses are measured up to the first byte)
+@app.after_request
+def record_latency(response):
+    start = g.get('request_start')
+    if start is not None:
+        metrics.observe(request.endpoint or 'unmatched', response.status_code, time.perf_counter() - start)
+        g.latency_recorded = True
+    return response
+
+
+@app.teardown_request
+def record_failure(exception):
+    '''Count unhandled exceptions as 500s, depending on the Flask version their responses skip after_request'''
+    start = g.get('request_start')
+    if exception is not None and start is not None and not g.get('latency_recorded'):
+        metrics.observe(request.endpoint or 'unmatched', 500, time.perf_counter() - start)
+
+
+@app.after_request
+def compress(response):
+    if response.mimetype in ('application/json', 'text/html') and accepts_gzip(request):
+        return gzip_response(response)
+    return response
 
 
 @app.route('/')
@@ -10,33 +127,85 @@ def main_page():
 
 
 @app.route('/info/<ticker>')
+@conditional
 def info_data(ticker):
+    payload = send_payload('info/{0}.html'.format(ticker), 'text/html')
+    if payload is not None:
+        return payload
     return render_template('infopanel.html', data=get_company_data(ticker))
 
 
 @app.route('/details/<ticker>')
+@conditional
 def detail_page(ticker):
+    payload = send_payload('details/{0}.html'.format(ticker), 'text/html')
+    if payload is not None:
+        return payload
     current = get_company_data(ticker)
     history = get_historical_data(ticker)
     return render_template('details.html', ticker=ticker, current=current, history=history)
 
 
 @app.route('/data/companies')
+@conditional
 def get_companies_data():
+    payload = send_payload('companies.json', 'application/json')
+    if payload is not None:
+        return payload
     data = get_companies()
     return json.jsonify(data)
 
 
+@app.route('/data/screen')
+@conditional
+def screen_companies():
+    try:
+        query = parse_query(request.args)
+    except ScreenError as e:
+        return json.jsonify({'error': str(e)}), 400
+    return json.jsonify(get_company_index().screen(**query))
+
+
 @app.route('/data/history/<ticker>')
+@conditional
 def get_history(ticker):
+    name = history_path(ticker, request.args)
+    payload = send_payload(name, 'application/json') if name else None
+    if payload is not None:
+        return payload
     date_range = request.args.get('range')
     data_type = request.args.get('type')
-    if data_type:
-        data = get_historical_data(ticker, data_type, date_range)
-        return json.jsonify(data)
-    else:
+    points = request.args.get('points', type=int)
+    resolution = request.args.get('resolution')
+    response_format = request.args.get('format', 'json')
+    if (resolution and resolution not in RESOLUTIONS) or response_format not in FORMATS or (
+            points is not None and points < 1):
+        abort(400)
+    if not data_type:
         abort(404)
 
+    if response_format == 'ndjson':
+        if points or resolution:
+            items = get_chart_history(ticker, data_type, date_range, points, resolution)[data_type]
+        else:
+            items = db.iter_historical_data(ticker, data_type, date_range)
+        lines = ndjson_lines(items)
+        headers = {}
+        if accepts_gzip(request):
+            lines = gzip_stream(lines)
+            headers = {'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'}
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson', headers=headers)
+
+    data = get_chart_history(ticker, data_type, date_range, points, resolution)
+    if response_format == 'columnar':
+        data = to_columnar(data, data_type)
+    return json.jsonify(data)
+
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.to_prometheus(), content_type=CONTENT_TYPE)
+
 
 if __name__ == '__main__':
     app.run(debug=True)
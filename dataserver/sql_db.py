@@ -0,0 +1,77 @@
+'''Data access on the embedded SQLite file written by the data pipeline (datahandler/lib/sqlite_storage.py),
+with the same functions as db.py. server.py uses it when DIVIDEND_STORAGE is a sqlite:/// URI.'''
+import datetime
+import json
+import os
+import sqlite3
+import threading
+from panel import get_panel_slice
+import queries
+
+PATH = os.environ.get('DIVIDEND_STORAGE', 'sqlite:///aristocrats.db')[len('sqlite:///'):]
+DATE_FORMAT = '%Y-%m-%d'
+STAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+_local = threading.local()
+
+
+def connection():
+    '''Read-only connection of the current thread'''
+    if getattr(_local, 'connection', None) is None:
+        _local.connection = sqlite3.connect('file:{0}?mode=ro'.format(PATH), uri=True, timeout=30)
+    return _local.connection
+
+
+def _decode(document):
+    if len(document) == 1 and '$date' in document:
+        return datetime.datetime.strptime(document['$date'], STAMP_FORMAT)
+    return document
+
+
+def _date(value):
+    return datetime.datetime.strptime(value, DATE_FORMAT)
+
+
+def get_companies():
+    return [json.loads(document, object_hook=_decode) for document, in connection().execute('SELECT document FROM companies')]
+
+
+def get_data_version():
+    '''Latest pipeline stamp on the company list (profile update, list download or dividend growth update)'''
+    stamps = [stamp for stamp in connection().execute(
+        'SELECT MAX(lastUpdated), MAX(downloaded), MAX(growthUpdated) FROM companies').fetchone() if stamp]
+    return datetime.datetime.strptime(max(stamps), STAMP_FORMAT) if stamps else None
+
+
+def get_company_data(ticker):
+    row = connection().execute('SELECT document FROM companies WHERE ticker = ?', (ticker,)).fetchone()
+    if row is None:
+        raise IndexError('No company data for {0}'.format(ticker))
+    return json.loads(row[0], object_hook=_decode)
+
+
+def iter_historical_data(ticker, data_type='price', date_range='5'):
+    '''Yield price or dividend entries one by one, in date order, from an index range scan'''
+    start = queries.start_date(date_range).strftime(DATE_FORMAT)
+    queries.check_data_type(data_type)
+
+    if data_type == 'price':
+        rows = connection().execute(
+            'SELECT date, adjClose, lastDivAnnual, divYield FROM price WHERE ticker = ? AND date >= ? ORDER BY date',
+            (ticker, start))
+        for date, adj_close, last_div, div_yield in rows:
+            yield {'adjClose': adj_close, 'date': _date(date), 'ticker': ticker, 'lastDivAnnual': last_div,
+                   'divYield': div_yield, 'type': 'price'}
+    else:
+        rows = connection().execute(
+            'SELECT date, dividend FROM dividend WHERE ticker = ? AND date >= ? ORDER BY date', (ticker, start))
+        for date, dividend in rows:
+            yield {'dividend': dividend, 'date': _date(date), 'ticker': ticker, 'type': 'dividend'}
+
+
+def get_historical_data(ticker, data_type='price', date_range='5'):
+    return queries.bucketed_history(ticker, data_type, list(iter_historical_data(ticker, data_type, date_range)))
+
+
+def get_panel_data(ticker, date_range='5'):
+    '''Price panel arrays of the ticker for the last date_range years, without a database query'''
+    return get_panel_slice(ticker, queries.start_date(date_range))
@@ -0,0 +1,128 @@
+import asyncio
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from async_server import create_app
+
+AsyncMongoMockClient = pytest.importorskip('mongomock_motor').AsyncMongoMockClient
+UPDATED = datetime(2020, 5, 4, 18, 30)
+GROWTH = {'divYield': 3.2, 'payout': 55.0, 'divg1y': 4.0, 'divg3y': 5.0, 'divg5y': 6.0, 'divg10y': 7.0}
+
+
+@pytest.fixture
+def database():
+    database = AsyncMongoMockClient().dividend_investing
+    today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+    dates = [today - timedelta(days=i) for i in range(300, 0, -1)]
+    prices = [{'date': date, 'adjClose': 10.0 + i, 'lastDivAnnual': 1.0, 'divYield': 1.0 / (10 + i), 'ticker': 'AAA',
+               'type': 'price'} for i, date in enumerate(dates)]
+    dividends = [{'date': date, 'dividend': 0.25, 'ticker': 'AAA', 'type': 'dividend'} for date in dates[::90]]
+    collections = database.delegate
+    collections.companies.insert_many([
+        dict(GROWTH, ticker='AAA', name='Alpha', category='Champions', lastUpdated=UPDATED),
+        dict(GROWTH, ticker='BBB', name='Beta', category='Contenders', lastUpdated=UPDATED - timedelta(days=1))
+    ])
+    collections.history.insert_one({'ticker': 'AAA', 'price': prices, 'dividend': dividends})
+    return database
+
+
+def serve(database, scenario, **settings):
+    '''Run scenario(client) against the application on the in-memory database'''
+    async def main():
+        async with TestClient(TestServer(create_app(database, **dict({'payload_dir': ''}, **settings)))) as client:
+            return await scenario(client)
+    return asyncio.run(main())
+
+
+def test_companies_and_conditional_get(database):
+    async def scenario(client):
+        response = await client.get('/data/companies')
+        assert response.status == 200
+        assert sorted(company['ticker'] for company in await response.json()) == ['AAA', 'BBB']
+        etag = response.headers['ETag']
+        assert etag.startswith('W/')
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert response.headers['Cache-Control'] == 'no-cache'
+
+        cached = await client.get('/data/companies', headers={'If-None-Match': etag})
+        assert cached.status == 304
+        assert cached.headers['ETag'] == etag
+        assert 'Accept-Encoding' in cached.headers['Vary']
+
+        since = await client.get('/data/companies', headers={'If-Modified-Since': response.headers['Last-Modified']})
+        assert since.status == 304
+        other = await client.get('/data/companies?x=1', headers={'If-None-Match': etag})
+        assert other.status == 200
+    serve(database, scenario)
+
+
+def test_history_formats(database):
+    async def scenario(client):
+        data = await (await client.get('/data/history/AAA?type=price&range=1')).json()
+        assert len(data['price']) == 300
+
+        columnar = await (await client.get('/data/history/AAA?type=price&range=1&format=columnar')).json()
+        assert len(columnar['date']) == 300 and columnar['adjClose'][-1] == 309.0
+
+        response = await client.get('/data/history/AAA?type=price&range=1&format=ndjson',
+                                    headers={'Accept-Encoding': 'gzip'})
+        assert response.status == 200
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'ETag' in response.headers
+        lines = (await response.text()).splitlines()
+        assert len(lines) == 300
+        assert json.loads(lines[0])['adjClose'] == 10.0
+
+        response = await client.get('/data/history/AAA?type=price&range=1&format=ndjson&points=50')
+        assert len((await response.text()).splitlines()) <= 50
+
+        response = await client.get('/data/history/AAA?type=dividend&range=1&format=ndjson')
+        assert len((await response.text()).splitlines()) == 4
+
+        for query in ('format=xml', 'points=0', 'resolution=daily'):
+            response = await client.get('/data/history/AAA?type=price&' + query)
+            assert response.status == 400
+        assert (await client.get('/data/history/ZZZ?type=price')).status == 404
+    serve(database, scenario)
+
+
+def test_screen_and_pages(database):
+    async def scenario(client):
+        response = await client.get('/data/screen?category=Contenders')
+        assert [company['ticker'] for company in (await response.json())['items']] == ['BBB']
+        assert (await client.get('/data/screen?sort=-nothing')).status == 400
+        assert (await client.get('/info/AAA')).status == 200
+        missing = await client.get('/info/ZZZ')
+        assert missing.status == 404 and 'ETag' not in missing.headers
+    serve(database, scenario)
+
+
+def test_materialized_payloads(database, tmp_path):
+    directory = tmp_path / str(UPDATED.year)
+    os.makedirs(str(directory / 'history' / 'AAA'))
+    with open(str(directory / 'companies.json.gz'), 'wb') as f:
+        f.write(gzip.compress(b'["materialized"]'))
+    with open(str(directory / 'history' / 'AAA' / 'price-5.json.gz'), 'wb') as f:
+        f.write(gzip.compress(b'{"price": []}'))
+    with open(str(tmp_path / 'manifest.json'), 'w') as f:
+        json.dump({'version': str(UPDATED), 'path': str(UPDATED.year)}, f)
+
+    async def scenario(client):
+        response = await client.get('/data/companies', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Content-Type'].startswith('application/json')
+        assert 'ETag' in response.headers
+        assert await response.json() == ['materialized']
+        response = await client.get('/data/history/AAA?type=price', headers={'Accept-Encoding': 'gzip'})
+        assert await response.json() == {'price': []}
+
+        # Live answers without gzip and for requests that are not materialized
+        response = await client.get('/data/companies', headers={'Accept-Encoding': 'identity'})
+        assert len(await response.json()) == 2
+        response = await client.get('/data/history/AAA?type=price&range=1', headers={'Accept-Encoding': 'gzip'})
+        assert len((await response.json())['price']) == 300
+    serve(database, scenario, payload_dir=str(tmp_path))
@@ -0,0 +1,68 @@
+import time
+from cache import ResponseCache
+
+
+class Versions:
+    def __init__(self, version=1):
+        self.version = version
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.version
+
+
+def test_get_loads_once_per_version():
+    versions = Versions()
+    cache = ResponseCache(versions, version_interval=0)
+    loads = []
+    load = lambda: loads.append(1) or len(loads)
+    assert cache.get('key', load) == 1
+    assert cache.get('key', load) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    versions.version = 2
+    time.sleep(0.001)
+    assert cache.get('key', load) == 2
+
+
+def test_version_is_polled_at_most_once_per_interval():
+    versions = Versions()
+    cache = ResponseCache(versions, version_interval=60)
+    for _ in range(5):
+        assert cache.version() == 1
+    assert versions.calls == 1
+
+
+def test_empty_database_is_polled_at_most_once_per_interval():
+    versions = Versions(version=None)
+    cache = ResponseCache(versions, version_interval=60)
+    for _ in range(5):
+        assert cache.version() is None
+    assert versions.calls == 1
+
+
+def test_ttl_and_max_entries():
+    cache = ResponseCache(Versions(), max_entries=2, ttl=0)
+    cache.get('a', lambda: 'a')
+    assert cache.get('a', lambda: 'reloaded') == 'reloaded'
+
+    cache = ResponseCache(Versions(), max_entries=2)
+    for key in 'abc':
+        cache.get(key, lambda: key)
+    assert cache.get('a', lambda: 'reloaded') == 'reloaded'
+    assert cache.get('c', lambda: 'reloaded') == 'c'
+
+
+def test_wrap_keys_by_arguments():
+    cache = ResponseCache(Versions())
+    calls = []
+
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    cached = cache.wrap(square)
+    assert [cached(2), cached(3), cached(2)] == [4, 9, 4]
+    assert calls == [2, 3]
+    assert cached.__name__ == 'square'
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+import math
+import numpy as np
+import pytest
+from downsample import lttb, lttb_indices, aggregate, downsample_history
+
+
+def prices(count, start=datetime(2020, 1, 1)):
+    return [{'date': start + timedelta(days=day), 'adjClose': 100 + 10 * math.sin(day / 10.0),
+             'divYield': 3 + math.cos(day / 7.0)} for day in range(count)]
+
+
+def test_lttb_indices_keep_ends_and_peaks():
+    x = np.arange(100, dtype=float)
+    y = np.zeros(100)
+    y[37] = 50
+    indices = lttb_indices(x, y, 10)
+    assert len(indices) == 10
+    assert indices[0] == 0 and indices[-1] == 99
+    assert 37 in indices
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_lttb_indices_without_reduction():
+    x = np.arange(5, dtype=float)
+    assert lttb_indices(x, x, 10).tolist() == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.parametrize('points', [1, 2, 3, 5, 6, 7, 50, 200])
+def test_lttb_returns_at_most_points_items(points):
+    items = prices(1000)
+    result = lttb(items, points)
+    assert 1 <= len(result) <= points
+    dates = [item['date'] for item in result]
+    assert dates == sorted(dates)
+
+
+def test_lttb_short_history_unchanged():
+    items = prices(10)
+    assert lttb(items, 10) is items
+
+
+def test_lttb_rejects_empty_budget():
+    with pytest.raises(ValueError):
+        lttb(prices(10), 0)
+
+
+def test_aggregate_keeps_last_day_of_period():
+    items = prices(62, start=datetime(2021, 1, 1))
+    monthly = aggregate(items, 'monthly')
+    assert [item['date'] for item in monthly] == [datetime(2021, 1, 31), datetime(2021, 2, 28), datetime(2021, 3, 3)]
+    with pytest.raises(ValueError):
+        aggregate(items, 'daily')
+
+
+def test_downsample_history_leaves_dividends_intact():
+    data = {'ticker': 'T', 'dividend': [{'date': datetime(2020, 1, 1), 'dividend': 1.0}]}
+    assert downsample_history(data, 'dividend', points=1) is data
+    data = {'ticker': 'T', 'price': list(reversed(prices(500)))}
+    result = downsample_history(data, 'price', points=40, resolution='weekly')
+    assert result['ticker'] == 'T' and len(result['price']) <= 40
@@ -0,0 +1,73 @@
+import gzip
+import json
+import os
+from datetime import datetime
+import pytest
+from flask import Flask
+from payloads import MANIFEST, PayloadStore, history_path, materialize
+
+
+@pytest.mark.parametrize('args, path', [
+    ({'type': 'price'}, 'history/AAA/price-5.json'),
+    ({'type': 'price', 'range': 'all'}, 'history/AAA/price-5.json'),
+    ({'type': 'dividend', 'range': '10'}, 'history/AAA/dividend-10.json'),
+    ({'type': 'price', 'range': '05'}, 'history/AAA/price-5.json'),
+    ({'type': 'price', 'range': '3'}, None),
+    ({'type': 'price', 'range': '-1'}, None),
+    ({'type': 'price', 'format': 'columnar'}, None),
+    ({'type': 'price', 'points': '100'}, None),
+    ({'type': 'volume'}, None)
+])
+def test_history_path(args, path):
+    assert history_path('AAA', args) == path
+
+
+class FakeDB:
+    def __init__(self, version):
+        self.version = version
+        self.served = 0
+
+    def get_data_version(self):
+        return self.version
+
+    def get_companies(self):
+        return [{'ticker': 'AAA'}]
+
+
+def fake_app(db):
+    app = Flask(__name__)
+
+    @app.route('/<path:path>')
+    def page(path):
+        db.served += 1
+        return 'run {0}'.format(db.served)
+    return app
+
+
+def read(store, name, version):
+    with gzip.open(store.path(name, version)) as f:
+        return f.read().decode('utf-8')
+
+
+def test_rerun_on_the_same_version_switches_directories(tmp_path):
+    version = datetime(2020, 5, 4, 18, 30)
+    db = FakeDB(version)
+    app = fake_app(db)
+    directory = str(tmp_path)
+    count = materialize(app, db, directory)
+    store = PayloadStore(directory, manifest_interval=-1)
+    first = store.manifest()['path']
+    assert count == 1 + 2 + 2 * 4
+    assert read(store, 'companies.json', version) == 'run 1'
+
+    materialize(app, db, directory)
+    second = store.manifest()['path']
+    assert second != first
+    assert read(store, 'companies.json', version) == 'run {0}'.format(count + 1)
+    # The previous directory is kept for requests still reading it
+    assert os.path.isdir(os.path.join(directory, first))
+
+    materialize(app, db, directory)
+    assert sorted(os.listdir(directory)) == sorted([second, store.manifest()['path'], MANIFEST])
+    with open(os.path.join(directory, MANIFEST)) as f:
+        assert json.load(f)['version'] == str(version)
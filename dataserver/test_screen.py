@@ -0,0 +1,90 @@
+import pytest
+from screen import CompanyIndex, ScreenError, parse_query, field_value
+
+COMPANIES = [
+    {'_id': 1, 'ticker': 'AAA', 'name': 'Alpha', 'category': 'champion', 'industry': 'Utilities',
+     'divYield': 3.5, 'payout': 60, 'yieldStats': {'5y': {'zScore': 1.2}}},
+    {'_id': 2, 'ticker': 'BBB', 'name': 'Beta', 'category': 'contender', 'industry': 'Banks',
+     'divYield': 1.5, 'payout': 30, 'yieldStats': {'5y': {'zScore': -0.5}}},
+    {'_id': 3, 'ticker': 'CCC', 'name': 'Gamma', 'category': 'champion', 'industry': 'Banks',
+     'divYield': 5.0, 'payout': None},
+    {'_id': 4, 'ticker': 'DDD', 'name': 'delta', 'category': 'challenger', 'industry': 'Utilities',
+     'divYield': 'n/a', 'payout': 80},
+]
+
+
+@pytest.fixture
+def index():
+    return CompanyIndex(COMPANIES, version=1)
+
+
+def tickers(result):
+    return [item['ticker'] for item in result['items']]
+
+
+def test_field_value():
+    assert field_value(COMPANIES[0], 'yieldStats.5y.zScore') == 1.2
+    assert field_value(COMPANIES[2], 'yieldStats.5y.zScore') is None
+    assert field_value({'a': 1}, 'a.b') is None
+
+
+def test_default_query_sorts_by_ticker_without_ids(index):
+    result = index.screen()
+    assert tickers(result) == ['AAA', 'BBB', 'CCC', 'DDD']
+    assert result['total'] == 4
+    assert all('_id' not in item for item in result['items'])
+
+
+def test_ranges_are_inclusive_and_skip_missing_values(index):
+    assert tickers(index.screen(ranges={'divYield': (1.5, 3.5)})) == ['AAA', 'BBB']
+    assert tickers(index.screen(ranges={'divYield': (3, None)})) == ['AAA', 'CCC']
+    assert tickers(index.screen(ranges={'payout': (None, 70)})) == ['AAA', 'BBB']
+    assert tickers(index.screen(ranges={'yieldStats.5y.zScore': (0, None)})) == ['AAA']
+
+
+def test_categories_are_case_insensitive(index):
+    assert tickers(index.screen(categories={'category': ['Champion']})) == ['AAA', 'CCC']
+    assert tickers(index.screen(categories={'category': ['champion'], 'industry': ['banks']})) == ['CCC']
+
+
+def test_descending_sort_keeps_missing_values_last(index):
+    assert tickers(index.screen(sort=[('divYield', True)])) == ['CCC', 'AAA', 'BBB', 'DDD']
+    assert tickers(index.screen(sort=[('payout', False)])) == ['BBB', 'AAA', 'DDD', 'CCC']
+    assert tickers(index.screen(sort=[('category', False), ('divYield', True)])) == ['DDD', 'CCC', 'AAA', 'BBB']
+    # Text sort ignores case
+    assert tickers(index.screen(sort=[('name', True)])) == ['CCC', 'DDD', 'BBB', 'AAA']
+
+
+def test_paging_and_projection(index):
+    result = index.screen(fields=('ticker', 'divYield'), offset=1, limit=2)
+    assert result['items'] == [{'ticker': 'BBB', 'divYield': 1.5}, {'ticker': 'CCC', 'divYield': 5.0}]
+    assert (result['total'], result['offset'], result['limit']) == (4, 1, 2)
+
+
+def test_parse_query():
+    query = parse_query({
+        'min_divYield': '2', 'max_payout': '70', 'category': 'champion, contender',
+        'sort': '-divYield,ticker', 'fields': 'ticker,name', 'offset': '10', 'limit': '20'
+    })
+    assert query == {
+        'ranges': {'divYield': (2.0, None), 'payout': (None, 70.0)},
+        'categories': {'category': ['champion', 'contender']},
+        'sort': [('divYield', True), ('ticker', False)],
+        'fields': ['ticker', 'name'],
+        'offset': 10,
+        'limit': 20
+    }
+
+
+@pytest.mark.parametrize('args', [
+    {'min_divYield': 'high'},
+    {'min_unknown': '1'},
+    {'sort': 'secret'},
+    {'limit': '0'},
+    {'limit': '501'},
+    {'offset': '-1'},
+    {'offset': 'x'},
+])
+def test_parse_query_rejects_invalid_arguments(args):
+    with pytest.raises(ScreenError):
+        parse_query(args)